@@ -0,0 +1,381 @@
+"""
+Benchmark harness for the NA Trend Report rollover implementations.
+
+Generates a synthetic 'NA Trend Report.xlsx' with the four QDS sheets and a
+matching drop of QDS-*.csv exports, runs every engine on its own copy of the
+data, and records wall time, peak RSS and the row count of every QDS sheet in
+the workbook the engine produced. Each engine gets the CSV layout it expects
+(processed-*.csv with a preamble line, new_data_csv/<sheet>.csv, ...).
+
+Usage:
+    python benchmark_trend.py --rows 10000 50000 --columns 20 --days 30
+    python benchmark_trend.py --rows 1000000 --engines trend-po-csv trend_store --report bench.csv
+
+The expected row count of a sheet is its history minus the oldest day plus
+the new rows; the synthetic rows are all distinct, so every correct engine
+should produce exactly that.
+"""
+
+import sys
+import subprocess
+import importlib
+import os
+import re
+import csv
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+from datetime import datetime
+
+# ==========================
+# 1. Setup and Dependencies
+# ==========================
+
+# List of required packages
+required_packages = [
+    'numpy',
+    'pandas',
+    'pyarrow'
+]
+
+# Function to install missing packages
+def install_packages(packages):
+    for package in packages:
+        try:
+            importlib.import_module(package)
+        except ImportError:
+            print(f"Package '{package}' not found. Installing...")
+            subprocess.check_call([sys.executable, "-m", "pip", "install", package])
+
+# Install missing packages
+install_packages(required_packages)
+
+# Now import the installed packages
+import numpy as np
+import pyarrow as pa
+
+from xlsx_stream import StreamingWorkbookWriter, WorkbookReader
+from qds_schema import SCHEMA_FILENAME
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+EXCEL_FILENAME = 'NA Trend Report.xlsx'
+
+# Mapping of CSV filename patterns to sheet names
+pattern_to_sheet = {
+    'QDS-above-70-crossed-40d': 'QDS above 70 G40',
+    'QDS-0-69-crossed-40d': 'QDS below 70 G40',
+    'QDS-0-69-less-40d': 'QDS below 70 L40',
+    'QDS-above-70-less-40d': 'QDS above 70 L40',
+}
+sheets_to_process = list(pattern_to_sheet.values())
+
+# How each engine is run:
+#   script  - file in this repository
+#   args    - command line arguments
+#   setup   - untimed commands run first (same script)
+#   layout  - where and how the QDS-*.csv drop is written (see write_csv_drop)
+#   output  - 'in_place' rewrites NA Trend Report.xlsx, 'final' writes *_Final_<timestamp>.xlsx
+ENGINES = {
+    'process':           {'script': 'process.py', 'layout': 'processed', 'output': 'in_place'},
+    'process_enh':       {'script': 'process_enh.py', 'layout': 'processed', 'output': 'in_place'},
+    'process_fs_v':      {'script': 'process_fs_v.py', 'layout': 'processed', 'output': 'in_place'},
+    'process_tnd':       {'script': 'process_tnd.py', 'layout': 'processed', 'output': 'in_place'},
+    'process_new_logic': {'script': 'process_new_logic.py', 'layout': 'preamble', 'output': 'in_place'},
+    'process-dask':      {'script': 'process-dask.py', 'layout': 'preamble', 'output': 'in_place'},
+    'trend-po-csv':      {'script': 'trend-po-csv.py', 'layout': 'new_data_dir', 'output': 'final'},
+    'trend-po-csv_budget': {'script': 'trend-po-csv.py', 'args': ['--memory-budget', '1G'],
+                            'layout': 'new_data_dir', 'output': 'final'},
+    'trend-nelogic':     {'script': 'trend-nelogic.py', 'layout': 'plain', 'output': 'final'},
+    'terend1':           {'script': 'terend1.py', 'layout': 'plain', 'output': 'final'},
+    'trend_store':       {'script': 'trend_store.py', 'args': ['run'], 'setup': [['import']],
+                          'layout': 'plain', 'output': 'final'},
+    'trend_engine':      {'script': 'trend_engine.py', 'layout': 'plain', 'output': 'final'},
+    'trend_engine_pandas': {'script': 'trend_engine.py', 'args': ['--backend', 'pandas'],
+                            'layout': 'plain', 'output': 'final'},
+    'trend_engine_polars': {'script': 'trend_engine.py', 'args': ['--backend', 'polars'],
+                            'layout': 'plain', 'output': 'final'},
+}
+
+# ==========================
+# 2. Synthetic Data
+# ==========================
+
+APPLICATIONS = np.array([f"APP-{i:04d}" for i in range(400)])
+OWNERS = np.array([f"team-{i:02d}@example.com" for i in range(60)])
+SEVERITIES = np.array(['Low', 'Medium', 'High', 'Critical'])
+STATUSES = np.array(['Open', 'In Progress', 'Risk Accepted', 'Reopened'])
+
+def synthetic_table(rows, columns, dates, first_id, rng):
+    """
+    Returns an Arrow table shaped like a QDS sheet: a date column, a unique
+    finding id, and a mix of low-cardinality text and integer columns up to
+    ``columns`` columns in total.
+
+    Parameters:
+        rows (int): Number of rows.
+        columns (int): Total number of columns (at least 3).
+        dates (np.ndarray): datetime64[D] date of every row.
+        first_id (int): First finding id, so history and new rows never collide.
+        rng (np.random.Generator): Random source.
+    """
+    data = {
+        'Date': pa.array(dates.astype('datetime64[D]'), type=pa.date32()),
+        'Finding ID': pa.array([f"F{i:09d}" for i in range(first_id, first_id + rows)]),
+        'Application': pa.array(APPLICATIONS[rng.integers(0, len(APPLICATIONS), rows)]),
+    }
+    pools = [OWNERS, SEVERITIES, STATUSES]
+    for i in range(max(columns - len(data), 0)):
+        if i % 2 == 0:
+            pool = pools[(i // 2) % len(pools)]
+            data[f"Text {i + 1}"] = pa.array(pool[rng.integers(0, len(pool), rows)])
+        else:
+            data[f"Value {i + 1}"] = pa.array(rng.integers(0, 100000, rows))
+    return pa.table(data)
+
+def generate_report(workdir, rows, columns, days, new_rows, seed=0):
+    """
+    Writes a synthetic workbook and one CSV table per QDS sheet.
+
+    Returns:
+        csv_tables (dict): {pattern: pa.Table} of the new rows, dated the day after the history.
+        expected_rows (dict): {sheet name: rows expected after the rollover}.
+    """
+    rng = np.random.default_rng(seed)
+    start = np.datetime64('2024-01-01')
+    csv_tables = {}
+    expected_rows = {}
+    with StreamingWorkbookWriter(os.path.join(workdir, EXCEL_FILENAME)) as writer:
+        for n, (pattern, sheet_name) in enumerate(pattern_to_sheet.items()):
+            # Rows are spread evenly over the days and kept in date order, as in the real report
+            dates = start + np.sort(rng.integers(0, days, rows)).astype('timedelta64[D]')
+            table = synthetic_table(rows, columns, dates, n * 10 * rows, rng)
+            writer.write_sheet(sheet_name, table)
+            new_dates = np.full(new_rows, start + np.timedelta64(days, 'D'))
+            csv_tables[pattern] = synthetic_table(new_rows, columns, new_dates, n * 10 * rows + rows, rng)
+            expected_rows[sheet_name] = rows - int((dates == dates.min()).sum()) + new_rows
+    return csv_tables, expected_rows
+
+def write_csv_drop(workdir, csv_tables, layout):
+    """
+    Writes the CSV drop in the layout an engine reads. Dates are written as
+    MM/DD/YYYY, as delcsv.py leaves them.
+
+    The synthetic columns are declared in a qds_schema.json next to the
+    drop, as a team would declare their own columns.
+
+    Layouts:
+        plain         <pattern>.csv with a header row
+        preamble      <pattern>.csv with one line before the header (read with skiprows=1)
+        processed     processed-<pattern>.csv with one line before the header
+        new_data_dir  new_data_csv/<sheet name>.csv with a header row
+    """
+    for pattern, table in csv_tables.items():
+        df = table.to_pandas()
+        df['Date'] = df['Date'].map(lambda d: d.strftime('%m/%d/%Y'))
+        if layout == 'new_data_dir':
+            os.makedirs(os.path.join(workdir, 'new_data_csv'), exist_ok=True)
+            path = os.path.join(workdir, 'new_data_csv', f"{pattern_to_sheet[pattern]}.csv")
+        elif layout == 'processed':
+            path = os.path.join(workdir, f"processed-{pattern}.csv")
+        else:
+            path = os.path.join(workdir, f"{pattern}.csv")
+        with open(path, 'w', encoding='utf-8', newline='') as fh:
+            if layout in ('preamble', 'processed'):
+                fh.write(f"Report generated {datetime.now():%m/%d/%Y %H:%M}\n")
+            df.to_csv(fh, index=False)
+
+    columns = next(iter(csv_tables.values())).column_names
+    declared = {col: 'category' if col.startswith('Text ') else 'number' for col in columns if col.startswith(('Text ', 'Value '))}
+    with open(os.path.join(workdir, SCHEMA_FILENAME), 'w', encoding='utf-8') as fh:
+        json.dump(declared, fh, indent=2)
+
+# ==========================
+# 3. Measurement
+# ==========================
+
+ROW_TAG_RE = re.compile(rb'<row[\s>/]')
+
+def count_sheet_rows(excel_path, sheet_name, chunk_size=1 << 22):
+    """
+    Counts the data rows of a sheet by scanning its XML for <row> tags,
+    without parsing any cells. The header row is not counted.
+    """
+    with WorkbookReader(excel_path) as reader:
+        part = reader.sheet_part(sheet_name)
+    count = 0
+    tail = b''
+    with zipfile.ZipFile(excel_path) as zf, zf.open(part) as stream:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            data = tail + chunk
+            # A tag cut off at the end of the chunk is carried over to the next one
+            cut = data.rfind(b'<', len(data) - 5)
+            if cut == -1:
+                cut = len(data)
+            count += len(ROW_TAG_RE.findall(data, 0, cut))
+            tail = data[cut:]
+        count += len(ROW_TAG_RE.findall(tail))
+    return max(count - 1, 0)
+
+def run_timed(command, cwd, timeout):
+    """
+    Runs a command and returns (exit code, wall seconds, peak RSS in MB).
+    Peak RSS comes from wait4() and is the largest single process of the
+    engine, worker processes included; it is None where wait4() is missing.
+    """
+    log_path = os.path.join(cwd, 'benchmark_stdout.log')
+    with open(log_path, 'ab') as log:
+        started = time.perf_counter()
+        proc = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            deadline = started + timeout
+            while True:
+                pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+                if pid:
+                    break
+                if time.perf_counter() > deadline:
+                    proc.kill()
+                    pid, status, usage = os.wait4(proc.pid, 0)
+                    break
+                time.sleep(0.05)
+            wall = time.perf_counter() - started
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in kilobytes on Linux and bytes on macOS
+            scale = 1 if sys.platform == 'darwin' else 1024
+            return proc.returncode, wall, usage.ru_maxrss * scale / 2**20
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        return proc.returncode, time.perf_counter() - started, None
+
+def find_output(workdir, output):
+    """
+    Returns the workbook an engine produced, or None.
+    """
+    if output == 'in_place':
+        return os.path.join(workdir, EXCEL_FILENAME)
+    finals = sorted(f for f in os.listdir(workdir) if '_Final_' in f and f.endswith('.xlsx'))
+    return os.path.join(workdir, finals[-1]) if finals else None
+
+def run_engine(name, spec, source_dir, csv_tables, expected_rows, timeout, keep):
+    """
+    Runs one engine on a private copy of the generated workbook and returns its result row.
+    """
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    try:
+        shutil.copy2(os.path.join(source_dir, EXCEL_FILENAME), workdir)
+        write_csv_drop(workdir, csv_tables, spec['layout'])
+        script = os.path.join(REPO_DIR, spec['script'])
+        for setup_args in spec.get('setup', []):
+            subprocess.run([sys.executable, script] + setup_args, cwd=workdir,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+        code, wall, rss = run_timed([sys.executable, script] + spec.get('args', []), workdir, timeout)
+        result = {'engine': name, 'exit_code': code, 'wall_s': round(wall, 2),
+                  'peak_rss_mb': None if rss is None else round(rss, 1)}
+
+        output_path = find_output(workdir, spec['output']) if code == 0 else None
+        ok = output_path is not None and os.path.isfile(output_path)
+        for sheet_name in sheets_to_process:
+            rows = None
+            if ok:
+                try:
+                    rows = count_sheet_rows(output_path, sheet_name)
+                except (KeyError, zipfile.BadZipFile):
+                    pass
+            result[sheet_name] = rows
+            ok = ok and rows == expected_rows[sheet_name]
+        result['correct'] = ok
+        if keep:
+            result['workdir'] = workdir
+        return result
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+# ==========================
+# 4. Report
+# ==========================
+
+REPORT_FIELDS = ['rows', 'columns', 'days', 'new_rows', 'engine', 'exit_code', 'wall_s', 'peak_rss_mb',
+                 'correct'] + sheets_to_process
+
+def print_report(results):
+    """
+    Prints the results as an aligned table, fastest correct engine first per size.
+    """
+    header = ['rows', 'engine', 'exit', 'wall s', 'peak MB', 'correct', 'rows per QDS sheet']
+    lines = []
+    for r in sorted(results, key=lambda r: (r['rows'], not r['correct'], r['wall_s'])):
+        counts = '/'.join('-' if r[s] is None else str(r[s]) for s in sheets_to_process)
+        lines.append([str(r['rows']), r['engine'], str(r['exit_code']), f"{r['wall_s']:.2f}",
+                      '-' if r['peak_rss_mb'] is None else f"{r['peak_rss_mb']:.0f}",
+                      'yes' if r['correct'] else 'NO', counts])
+    widths = [max(len(row[i]) for row in lines + [header]) for i in range(len(header))]
+    for row in [header] + lines:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+def write_report(results, path):
+    """
+    Writes the results as CSV for comparing runs over time.
+    """
+    with open(path, 'w', encoding='utf-8', newline='') as fh:
+        writer = csv.DictWriter(fh, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+# ==========================
+# 5. Main Execution Flow
+# ==========================
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the NA Trend Report rollover engines.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000],
+                        help="History rows per QDS sheet; several sizes run one after another")
+    parser.add_argument('--columns', type=int, default=20, help="Columns per sheet (default: 20)")
+    parser.add_argument('--days', type=int, default=30, help="Days of history (default: 30)")
+    parser.add_argument('--new-rows', type=int, default=None,
+                        help="Rows per QDS-*.csv (default: one day's worth of history)")
+    parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES), default=sorted(ENGINES))
+    parser.add_argument('--timeout', type=float, default=3600, help="Seconds before an engine is killed")
+    parser.add_argument('--report', default=None, help="Also write the results to this CSV file")
+    parser.add_argument('--keep', action='store_true', help="Keep each engine's working directory")
+    args = parser.parse_args()
+
+    results = []
+    for rows in args.rows:
+        new_rows = args.new_rows or max(rows // args.days, 1)
+        source_dir = tempfile.mkdtemp(prefix='bench_source_')
+        try:
+            print(f"\nGenerating {len(sheets_to_process)} sheets x {rows} rows x {args.columns} columns "
+                  f"over {args.days} days, {new_rows} new rows per CSV...")
+            started = time.perf_counter()
+            csv_tables, expected_rows = generate_report(source_dir, rows, args.columns, args.days, new_rows)
+            print(f"Generated in {time.perf_counter() - started:.1f}s")
+
+            for name in args.engines:
+                print(f"Running {name}...")
+                result = run_engine(name, ENGINES[name], source_dir, csv_tables, expected_rows,
+                                    args.timeout, args.keep)
+                result.update(rows=rows, columns=args.columns, days=args.days, new_rows=new_rows)
+                results.append(result)
+                print(f"  exit {result['exit_code']}, {result['wall_s']:.2f}s, "
+                      f"correct: {'yes' if result['correct'] else 'NO'}")
+        finally:
+            shutil.rmtree(source_dir, ignore_errors=True)
+
+    print()
+    print_report(results)
+    if args.report:
+        write_report(results, args.report)
+        print(f"\nReport written to '{args.report}'")
+
+if __name__ == "__main__":
+    main()
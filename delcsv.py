@@ -1,7 +1,12 @@
 import os
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+from qds_schema import RAW_PREAMBLE_ROWS, RAW_BLOCK_SIZE, DATE_HEADER, CSV_PARSE_OPTIONS, is_raw_export, raw_export_columns
+
 # Define the patterns to search in filenames
 patterns = [
     "QDS-above-70-crossed-40d",
@@ -10,27 +15,64 @@ patterns = [
     "QDS-above-70-less-40d"
 ]
 
-# Define columns to be dropped (M to P, W to AD, AG to AL, AN to AQ are 12, 15-29, 32-37, 39-42 in zero-based index)
-cols_to_drop = list(range(12, 16)) + list(range(22, 30)) + list(range(32, 38)) + list(range(39, 43))
-
 # Get today's date in MM/DD/YYYY format
 today_date = datetime.now().strftime('%m/%d/%Y')
 
-# Scan for CSV files in the current directory that match the patterns
-for file in os.listdir():
-    if file.endswith('.csv') and any(pattern in file for pattern in patterns):
-        print(f"Processing file: {file}")
-        # Read the CSV file, skipping the first 4 rows, with low_memory=False to handle mixed types
-        df = pd.read_csv(file, skiprows=4, low_memory=False)
-        
-        # Drop the specified columns
-        df.drop(df.columns[cols_to_drop], axis=1, inplace=True)
-        
-        # Insert the new column with today's date at the start of the dataframe
-        df.insert(0, 'Date', today_date)
-        
-        # Save the modified file (overwrite the original file)
-        df.to_csv(file, index=False)
-        print(f"File overwritten and saved: {file}")
-
-print("Processing complete.")
+def trim_file(file):
+    """
+    Rewrites one export with only the kept columns and today's date in front.
+    The trend scripts also read raw exports directly (qds_schema.read_export),
+    so this is only needed for other consumers of the trimmed CSVs.
+    Only the kept columns are parsed, as text, and the file is streamed in
+    blocks into a temporary file that replaces the original once complete,
+    so a crash never leaves a truncated CSV.
+
+    Returns:
+        rows (int): Number of data rows written, or None if the file was already trimmed.
+    """
+    if not is_raw_export(file):
+        return None
+    names, kept = raw_export_columns(file)
+
+    reader = pacsv.open_csv(
+        file,
+        read_options=pacsv.ReadOptions(skip_rows=RAW_PREAMBLE_ROWS + 1, column_names=names, block_size=RAW_BLOCK_SIZE),
+        parse_options=CSV_PARSE_OPTIONS,
+        convert_options=pacsv.ConvertOptions(
+            include_columns=kept,
+            column_types={name: pa.string() for name in kept},
+            strings_can_be_null=True,
+        ),
+    )
+    schema = pa.schema([(DATE_HEADER, pa.string())] + [(name, pa.string()) for name in kept])
+    tmp_path = f"{file}.tmp"
+    rows = 0
+    try:
+        with pacsv.CSVWriter(tmp_path, schema, write_options=pacsv.WriteOptions(quoting_style='needed')) as writer:
+            for batch in reader:
+                date = pa.array([today_date] * batch.num_rows, type=pa.string())
+                writer.write_batch(pa.RecordBatch.from_arrays([date] + batch.columns, schema=schema))
+                rows += batch.num_rows
+        os.replace(tmp_path, file)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return rows
+
+if __name__ == '__main__':
+    # Scan for CSV files in the current directory that match the patterns
+    files = [file for file in os.listdir()
+             if file.endswith('.csv') and any(pattern in file for pattern in patterns)]
+
+    # Arrow parses and writes outside the GIL, so threads process the files in parallel
+    with ThreadPoolExecutor(max_workers=max(len(files), 1)) as pool:
+        futures = {pool.submit(trim_file, file): file for file in files}
+        for future in as_completed(futures):
+            file = futures[future]
+            rows = future.result()
+            if rows is None:
+                print(f"File already processed, skipped: {file}")
+            else:
+                print(f"File overwritten and saved: {file} ({rows} rows)")
+
+    print("Processing complete.")
@@ -2,13 +2,18 @@ import sys
 from site import getusersitepackages
 sys.path.append(getusersitepackages())
 
-import pandas as pd
 import dask.dataframe as dd
+import pyarrow as pa
+import pyarrow.compute as pc
 from tqdm import tqdm
 import glob
 import os
 import time
 
+from xlsx_stream import StreamingWorkbookWriter
+from xlsx_cache import load_sheets
+from trend_dates import normalise_date_series
+
 # Start the timer
 start_time = time.time()
 
@@ -31,16 +36,21 @@ parquet_dir = os.path.join(current_dir, 'parquet_files')
 os.makedirs(parquet_dir, exist_ok=True)
 
 # Step 1: Convert Excel sheets to Parquet files using Dask
+# Sheets come from the conversion cache, which is keyed on the workbook's
+# content, so only sheets that changed since the last run are parsed again.
+# parquet_files/<sheet> is rewritten every run because steps 2-3 modify it.
 print("Converting Excel sheets to Parquet files...")
+# One process: this script has no __main__ guard for worker processes to import
+sheet_tables = load_sheets(excel_file, sheets_to_process)
 for sheet_name in tqdm(sheets_to_process, desc='Converting Sheets'):
     parquet_path = os.path.join(parquet_dir, sheet_name)
-    if not os.path.exists(parquet_path):
-        # Read the Excel sheet into a pandas DataFrame
-        df = pd.read_excel(excel_file, sheet_name=sheet_name, dtype=str)
-        # Convert the pandas DataFrame to a Dask DataFrame
-        ddf = dd.from_pandas(df, npartitions=1)
-        # Write the Dask DataFrame to Parquet
-        ddf.to_parquet(parquet_path, write_index=False)
+    # Cast to text to keep the previous dtype=str behaviour; empty cells stay missing
+    table = sheet_tables.pop(sheet_name)
+    df = pa.table([pc.cast(col, pa.string()) for col in table.columns], names=table.column_names).to_pandas()
+    # Convert the pandas DataFrame to a Dask DataFrame
+    ddf = dd.from_pandas(df, npartitions=1)
+    # Write the Dask DataFrame to Parquet
+    ddf.to_parquet(parquet_path, write_index=False, overwrite=True)
 
 # Step 2: Process Parquet files with Dask
 print("Processing Parquet files with Dask...")
@@ -50,7 +60,7 @@ for sheet_name in tqdm(sheets_to_process, desc='Processing Parquet Files'):
 
     # Delete rows with the oldest date in the first column
     first_col = ddf.columns[0]
-    ddf[first_col] = dd.to_datetime(ddf[first_col], errors='coerce')
+    ddf[first_col] = ddf[first_col].map_partitions(normalise_date_series, meta=(first_col, 'datetime64[ns]'))
     oldest_date = ddf[first_col].min().compute()
     ddf = ddf[ddf[first_col] != oldest_date]
 
@@ -83,14 +93,15 @@ for sheet_name in tqdm(sheets_to_process, desc='Appending Data'):
         ddf_main.to_parquet(parquet_path, write_index=False, overwrite=True)
 
 # Step 4: Recombine Parquet files into Excel workbook
+# Partitions are computed and streamed into the sheet one at a time
 print("Recombining Parquet files into Excel workbook...")
-with pd.ExcelWriter(excel_file, engine='openpyxl', mode='w') as writer:
+with StreamingWorkbookWriter(excel_file) as writer:
     for sheet_name in tqdm(sheets_to_process, desc='Writing to Excel'):
         parquet_path = os.path.join(parquet_dir, sheet_name)
         if os.path.exists(parquet_path):
             ddf = dd.read_parquet(parquet_path, dtype=str)
-            df = ddf.compute()
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
+            partitions = (ddf.get_partition(i).compute() for i in range(ddf.npartitions))
+            writer.write_sheet(sheet_name, partitions, columns=list(ddf.columns))
 
 # Calculate and display the total execution time
 end_time = time.time()
@@ -1,40 +1,9 @@
-import pandas as pd
 import os
-from openpyxl import load_workbook
+from xlsx_stream import patch_workbook
+from qds_schema import read_export
 
-# Load the Excel file
+# The workbook patched in place
 excel_file = "NA Trend Report.xlsx"
-wb = load_workbook(excel_file)
-
-# Get all sheet names
-sheet_names = wb.sheetnames
-
-# Delete rows with the oldest date from each sheet
-for sheet_name in sheet_names:
-    sheet = wb[sheet_name]
-    # Skip if the sheet is empty or only contains headers
-    if sheet.max_row < 2:
-        continue
-    
-    # Collect dates from the first column
-    dates = [sheet.cell(row=i, column=1).value for i in range(2, sheet.max_row + 1)]
-    # Filter only valid dates and find the oldest one
-    dates = [d for d in dates if isinstance(d, (pd.Timestamp, pd.datetime))]
-    
-    if dates:
-        oldest_date = min(dates)
-        
-        # Delete all rows with the oldest date in the first column
-        rows_to_delete = []
-        for row in range(2, sheet.max_row + 1):
-            if sheet.cell(row=row, column=1).value == oldest_date:
-                rows_to_delete.append(row)
-        
-        for row in reversed(rows_to_delete):  # Reverse to avoid shifting
-            sheet.delete_rows(row)
-
-# Save the workbook after deleting the rows
-wb.save(excel_file)
 
 # CSV to tab mapping
 csv_to_tab = {
@@ -44,24 +13,25 @@ csv_to_tab = {
     'QDS-above-70-less-40d': 'QDS above 70 L40'
 }
 
-# Find all processed CSV files in the current directory
-csv_files = [f for f in os.listdir() if f.startswith('processed') and f.endswith('.csv')]
-
-for csv_file in csv_files:
-    for pattern, tab_name in csv_to_tab.items():
-        if pattern in csv_file:
-            # Load the CSV, skipping the header
-            csv_data = pd.read_csv(csv_file, skiprows=1)
-            
-            # Load the relevant sheet from the Excel file
-            sheet = wb[tab_name]
-            
-            # Append the CSV data to the sheet
-            for row in csv_data.itertuples(index=False):
-                sheet.append(list(row))
-            
-            print(f"Data from {csv_file} appended to sheet {tab_name}")
-            break  # Stop after finding the matching tab
-
-# Save the workbook after copying data
-wb.save(excel_file)
+# Find all processed CSV files in the current directory; a tab without one takes
+# the raw QDS export itself, which is trimmed, dated and typed while it is read
+csv_files = sorted(f for f in os.listdir() if f.endswith('.csv'))
+
+# Collect the CSV data to append to each tab
+appends = {}
+for pattern, tab_name in csv_to_tab.items():
+    matched = [f for f in csv_files if pattern in f]
+    processed = [f for f in matched if f.startswith('processed')]
+    for csv_file in processed or matched:
+        # Load the CSV (processed files have one line before the header) with the
+        # declared column types; dates are real dates so the next run can roll them over
+        csv_data = read_export(csv_file, skip_rows=1 if csv_file in processed else 0)
+        appends.setdefault(tab_name, []).append(csv_data)
+
+# Patch the workbook in place: only the QDS sheet parts are rewritten (oldest date
+# removed, CSV rows appended); all other sheets, formatting and pivots are kept as is
+results = patch_workbook(excel_file, list(csv_to_tab.values()), appends)
+
+for tab_name, result in results.items():
+    print(f"Deleted {result['rows_deleted']} rows dated {result['oldest_date']} and appended "
+          f"{result['rows_appended']} rows to sheet {tab_name}")
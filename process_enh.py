@@ -1,53 +1,10 @@
-import pandas as pd
 import os
-from openpyxl import load_workbook
+from xlsx_stream import patch_workbook
+from qds_schema import read_export
 
 # Load the Excel file
 excel_file = "NA Trend Report.xlsx"
-print(f"Loading Excel file: {excel_file}")
-wb = load_workbook(excel_file)
-
-# Get all sheet names
-sheet_names = wb.sheetnames
-print(f"Found sheets: {sheet_names}")
-
-# Delete rows with the oldest date from each sheet
-for sheet_name in sheet_names:
-    print(f"\nProcessing sheet: {sheet_name}")
-    sheet = wb[sheet_name]
-    
-    # Skip if the sheet is empty or only contains headers
-    if sheet.max_row < 2:
-        print(f"Skipping sheet {sheet_name}, no data.")
-        continue
-    
-    # Collect dates from the first column
-    dates = [sheet.cell(row=i, column=1).value for i in range(2, sheet.max_row + 1)]
-    
-    # Filter only valid dates and find the oldest one
-    dates = [d for d in dates if isinstance(d, (pd.Timestamp, pd.datetime))]
-    
-    if dates:
-        oldest_date = min(dates)
-        print(f"Oldest date found in sheet {sheet_name}: {oldest_date}")
-        
-        # Delete all rows with the oldest date in the first column
-        rows_to_delete = []
-        for row in range(2, sheet.max_row + 1):
-            if sheet.cell(row=row, column=1).value == oldest_date:
-                rows_to_delete.append(row)
-        
-        if rows_to_delete:
-            print(f"Deleting {len(rows_to_delete)} rows from sheet {sheet_name} with the date {oldest_date}")
-        else:
-            print(f"No rows to delete in sheet {sheet_name}")
-        
-        for row in reversed(rows_to_delete):  # Reverse to avoid shifting
-            sheet.delete_rows(row)
-
-# Save the workbook after deleting the rows
-print(f"Saving changes to Excel file after deleting rows with the oldest date.")
-wb.save(excel_file)
+print(f"Patching Excel file: {excel_file}")
 
 # CSV to tab mapping
 csv_to_tab = {
@@ -57,31 +14,37 @@ csv_to_tab = {
     'QDS-above-70-less-40d': 'QDS above 70 L40'
 }
 
-# Find all processed CSV files in the current directory
-csv_files = [f for f in os.listdir() if f.startswith('processed') and f.endswith('.csv')]
-print(f"\nFound processed CSV files: {csv_files}")
-
-for csv_file in csv_files:
-    print(f"\nProcessing CSV file: {csv_file}")
-    for pattern, tab_name in csv_to_tab.items():
-        if pattern in csv_file:
-            print(f"Pattern '{pattern}' matched, appending data to tab: {tab_name}")
-            
-            # Load the CSV, skipping the header
-            csv_data = pd.read_csv(csv_file, skiprows=1)
-            
-            # Load the relevant sheet from the Excel file
-            sheet = wb[tab_name]
-            
-            # Append the CSV data to the sheet
-            for row in csv_data.itertuples(index=False):
-                sheet.append(list(row))
-            
-            print(f"Data from {csv_file} appended to sheet {tab_name}")
-            break  # Stop after finding the matching tab
-
-# Save the workbook after copying data
-print(f"\nSaving changes to Excel file after appending data from CSV files.")
-wb.save(excel_file)
+# Find all processed CSV files in the current directory; a tab without one takes
+# the raw QDS export itself, which is trimmed, dated and typed while it is read
+csv_files = sorted(f for f in os.listdir() if f.endswith('.csv'))
+print(f"\nFound CSV files: {csv_files}")
+
+# Collect the CSV data to append to each tab
+appends = {}
+for pattern, tab_name in csv_to_tab.items():
+    matched = [f for f in csv_files if pattern in f]
+    processed = [f for f in matched if f.startswith('processed')]
+    for csv_file in processed or matched:
+        print(f"\nPattern '{pattern}' matched {csv_file}, queuing data for tab: {tab_name}")
+
+        # Load the CSV (processed files have one line before the header) with the
+        # declared column types; dates are real dates so the next run can roll them over
+        csv_data = read_export(csv_file, skip_rows=1 if csv_file in processed else 0)
+
+        appends.setdefault(tab_name, []).append(csv_data)
+        print(f"Queued {csv_data.num_rows} rows from {csv_file} for sheet {tab_name}")
+
+# Patch the workbook in place. Only the four QDS sheet parts of the xlsx are
+# regenerated (oldest date removed, new rows appended); every other part, including
+# other sheets, formatting, charts and pivots, is streamed through unchanged.
+print(f"\nRewriting QDS sheets in {excel_file}...")
+results = patch_workbook(excel_file, list(csv_to_tab.values()), appends)
+
+for tab_name, result in results.items():
+    if result['oldest_date'] is None:
+        print(f"No dates found in sheet {tab_name}, no rows deleted.")
+    else:
+        print(f"Deleted {result['rows_deleted']} rows from sheet {tab_name} with the date {result['oldest_date']}")
+    print(f"Appended {result['rows_appended']} rows to sheet {tab_name}; it now has {result['rows']} rows.")
 
 print("\nScript completed successfully.")
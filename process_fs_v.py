@@ -2,6 +2,7 @@ import pandas as pd
 import os
 from openpyxl import load_workbook
 from tqdm import tqdm  # For progress bar
+from qds_schema import read_export
 
 # Load the Excel file using pandas for specific sheets
 excel_file = "NA Trend Report.xlsx"
@@ -39,24 +40,27 @@ csv_to_tab = {
     'QDS-above-70-less-40d': 'QDS above 70 L40'
 }
 
-# Find all processed CSV files in the current directory
-csv_files = [f for f in os.listdir() if f.startswith('processed') and f.endswith('.csv')]
+# Find all processed CSV files in the current directory; a tab without one takes
+# the raw QDS export itself, which is trimmed, dated and typed while it is read
+csv_files = sorted(f for f in os.listdir() if f.endswith('.csv'))
+selected = []
+for pattern, tab_name in csv_to_tab.items():
+    matched = [f for f in csv_files if pattern in f]
+    processed = [f for f in matched if f.startswith('processed')]
+    selected.extend((csv_file, tab_name, 1 if csv_file in processed else 0) for csv_file in processed or matched)
 
-print(f"Found {len(csv_files)} processed CSV files. Appending data to sheets...")
+print(f"Found {len(selected)} CSV files. Appending data to sheets...")
 
 # Append CSV data to respective sheets with progress bar
-for csv_file in tqdm(csv_files, desc="Processing CSV files"):
-    for pattern, tab_name in csv_to_tab.items():
-        if pattern in csv_file:
-            # Load the CSV data
-            print(f"Appending data from {csv_file} to {tab_name}...")
-            csv_data = pd.read_csv(csv_file, skiprows=1)
-            
-            # Append the CSV data to the corresponding sheet
-            sheets[tab_name] = pd.concat([sheets[tab_name], csv_data], ignore_index=True)
-            
-            print(f"Data from {csv_file} appended to sheet {tab_name}")
-            break  # Stop after finding the matching tab
+for csv_file, tab_name, skip_rows in tqdm(selected, desc="Processing CSV files"):
+    # Load the CSV data (processed files have one line before the header)
+    print(f"Appending data from {csv_file} to {tab_name}...")
+    csv_data = read_export(csv_file, skip_rows=skip_rows).to_pandas(date_as_object=False)
+
+    # Append the CSV data to the corresponding sheet
+    sheets[tab_name] = pd.concat([sheets[tab_name], csv_data], ignore_index=True)
+
+    print(f"Data from {csv_file} appended to sheet {tab_name}")
 
 print("All CSV data has been appended successfully.")
 
@@ -4,6 +4,11 @@ from tqdm import tqdm
 import glob
 import time
 
+from xlsx_stream import StreamingWorkbookWriter
+from xlsx_cache import load_sheets
+from qds_schema import apply_schema, read_export
+from trend_journal import StageJournal
+
 # Get the current working directory
 current_dir = os.getcwd()
 print(f"Current working directory: {current_dir}")
@@ -20,30 +25,12 @@ pattern_to_sheet = {
 excel_file = os.path.join(current_dir, 'NA Trend Report.xlsx')
 sheets_to_process = list(pattern_to_sheet.values())
 
-# Create a directory to store CSV files
-csv_dir = os.path.join(current_dir, 'temp_csv_files')
-os.makedirs(csv_dir, exist_ok=True)
-
-def convert_sheet_to_csv(sheet_name):
-    # Convert a sheet to CSV
-    df = pd.read_excel(excel_file, sheet_name=sheet_name)
-    csv_path = os.path.join(csv_dir, f"{sheet_name}.csv")
-    df.to_csv(csv_path, index=False)
-
-def process_csv_file(sheet_name):
-    csv_path = os.path.join(csv_dir, f"{sheet_name}.csv")
-    df = pd.read_csv(csv_path, low_memory=False)  # Set low_memory=False
+# Each stage reads the previous stage's output from the journal next to the
+# workbook and records its own output there, instead of rewriting shared
+# intermediate files in place. A rerun after a crash resumes at the failed stage.
 
-    # Delete rows with the oldest date in the first column
-    first_col = df.columns[0]
-    oldest_date = df[first_col].min()
-    df = df[df[first_col] != oldest_date]
-
-    # Save the cleaned CSV back
-    df.to_csv(csv_path, index=False)
-
-def append_csv_data(sheet_name):
-    # Match CSV files based on patterns and append data
+def find_csv_files(sheet_name):
+    # Match CSV files based on patterns
     matched_files = []
     for pattern, target_sheet in pattern_to_sheet.items():
         if target_sheet == sheet_name:
@@ -53,55 +40,74 @@ def append_csv_data(sheet_name):
                 if pattern in os.path.basename(csv_file):
                     matched_files.append(csv_file)
             break
+    return sorted(matched_files)
 
-    if matched_files:
-        # Read the main CSV file
-        csv_path = os.path.join(csv_dir, f"{sheet_name}.csv")
-        df_main = pd.read_csv(csv_path, low_memory=False)  # Set low_memory=False
+def delete_oldest_date(journal, sheet_name, table):
+    # Declared QDS column types, as the CSV reader applies them
+    df = apply_schema(table).to_pandas(date_as_object=False)
 
-        # Append data from matched CSV files
-        for csv_file in matched_files:
-            df_csv = pd.read_csv(csv_file, skiprows=1, low_memory=False)  # Set low_memory=False
-            df_main = pd.concat([df_main, df_csv], ignore_index=True)
+    # Delete rows with the oldest date in the first column
+    first_col = df.columns[0]
+    oldest_date = df[first_col].min()
+    df = df[df[first_col] != oldest_date]
+
+    journal.record(sheet_name, 'rollover', {'rows': df}, oldest_date=oldest_date)
+
+def append_csv_data(journal, sheet_name):
+    matched_files = find_csv_files(sheet_name)
+
+    # Start from the rolled-over sheet
+    df_main = journal.load(sheet_name, 'rollover').to_pandas(date_as_object=False)
 
-        # Save the combined data back to CSV
-        df_main.to_csv(csv_path, index=False)
+    # Append data from matched CSV files
+    for csv_file in matched_files:
+        df_csv = read_export(csv_file, skip_rows=1).to_pandas(date_as_object=False)
+        df_main = pd.concat([df_main, df_csv], ignore_index=True)
 
-def recombine_csv_to_excel():
-    # Combine all CSV files back into an Excel workbook
-    with pd.ExcelWriter(excel_file, engine='openpyxl', mode='w') as writer:
+    journal.record(sheet_name, 'append', {'rows': df_main}, uses_inputs=True,
+                   csv_files=[os.path.basename(f) for f in matched_files])
+
+def recombine_to_excel(journal):
+    # Combine the appended sheets into a new workbook in the journal; each
+    # sheet is memory-mapped from the journal and streamed in batches
+    staged_file = journal.staging_path(excel_file)
+    with StreamingWorkbookWriter(staged_file) as writer:
         for sheet_name in sheets_to_process:
-            csv_path = os.path.join(csv_dir, f"{sheet_name}.csv")
-            if os.path.exists(csv_path):
-                df = pd.read_csv(csv_path, low_memory=False)  # Set low_memory=False
-                df.to_excel(writer, sheet_name=sheet_name, index=False)
+            if journal.done(sheet_name, 'append'):
+                writer.write_sheet(sheet_name, journal.load(sheet_name, 'append', memory_map=True))
+    return staged_file
 
 if __name__ == '__main__':
     # Start the timer
     start_time = time.time()
 
-    # Step 1: Convert sheets to CSV files
-    print("Converting Excel sheets to CSV files...")
-    for sheet_name in tqdm(sheets_to_process, desc='Converting Sheets'):
-        convert_sheet_to_csv(sheet_name)
-
-    # Step 2: Process CSV files (delete oldest date)
-    print("Processing CSV files (deleting oldest date)...")
-    for sheet_name in tqdm(sheets_to_process, desc='Processing CSVs'):
-        process_csv_file(sheet_name)
-
-    # Step 3: Append data from other CSV files
-    print("Appending data from other CSV files...")
+    all_csv_files = sorted({f for sheet_name in sheets_to_process for f in find_csv_files(sheet_name)})
+    journal = StageJournal(excel_file, inputs=all_csv_files)
+    if journal.already_completed:
+        # The workbook was already rolled over with these CSV files; rerunning would delete another day
+        print("The workbook was already updated with these CSV files. Nothing to do.")
+        raise SystemExit(0)
+
+    # Step 1: Delete the oldest date from each sheet
+    # Sheets unchanged since the last conversion are loaded from the cache
+    print("Deleting the oldest date from each sheet...")
+    pending = [s for s in sheets_to_process if not journal.done(s, 'rollover')]
+    sheet_tables = load_sheets(excel_file, pending, max_workers=len(pending)) if pending else {}
+    for sheet_name in tqdm(pending, desc='Processing Sheets'):
+        delete_oldest_date(journal, sheet_name, sheet_tables.pop(sheet_name))
+
+    # Step 2: Append data from the CSV files
+    print("Appending data from CSV files...")
     for sheet_name in tqdm(sheets_to_process, desc='Appending Data'):
-        append_csv_data(sheet_name)
-
-    # Step 4: Recombine CSV files into Excel workbook
-    print("Recombining CSV files into Excel workbook...")
-    recombine_csv_to_excel()
-
-    # Optional: Remove temporary CSV files
-    # import shutil
-    # shutil.rmtree(csv_dir)
+        if not journal.done(sheet_name, 'append'):
+            append_csv_data(journal, sheet_name)
+
+    # Step 3: Recombine the sheets into the Excel workbook
+    print("Recombining sheets into Excel workbook...")
+    # The replacement is recorded before the workbook is swapped, so a crash
+    # right after the swap does not make the next run delete another day
+    staged_file = recombine_to_excel(journal)
+    journal.publish(staged_file, excel_file)
 
     # Calculate and display the total execution time
     end_time = time.time()
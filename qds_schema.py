@@ -0,0 +1,432 @@
+"""
+Declared column types for the QDS exports and the NA Trend Report sheets.
+
+Instead of letting each reader guess types (pandas' low_memory inference,
+Polars' infer_schema_length, a Float64 cast attempted on every column), every
+QDS column is declared once here as one of:
+
+    date      normalised by trend_dates.normalise_dates (MM/DD/YYYY, ISO,
+              DD-MM-YYYY text and real Excel dates)
+    number    parsed as float64 after removing thousands separators
+    category  dictionary-encoded text, for repeated values such as
+              application, host and owner names
+    text      plain text; the default for columns not declared
+
+The first column of a QDS sheet or export is always the date column,
+whatever its header. The declarations can be extended or overridden without
+code changes with a ``qds_schema.json`` file in the working directory that
+maps column names to one of the types above.
+
+read_csv() applies the schema while the CSV is parsed with Arrow's
+multi-threaded reader (categories are dictionary-encoded by the reader
+itself, nothing is inferred), and apply_schema() brings tables read from a
+workbook to the same types. read_raw_export() ingests a raw QDS export as
+downloaded, doing delcsv.py's work (skip the report preamble, drop the unused
+columns, stamp the export date) in the same streaming pass, and read_export()
+accepts either kind of file. Polars and pandas callers convert the result with
+pl.from_arrow() / Table.to_pandas(), which keep the dictionaries as
+Categorical columns.
+
+Usage:
+    table = read_csv('QDS-above-70-crossed-40d.csv')
+    table = apply_schema(read_workbook('NA Trend Report.xlsx')['QDS above 70 G40'])
+    table = read_export('QDS-above-70-crossed-40d.csv')   # raw or trimmed
+"""
+
+import os
+import csv
+import json
+import logging
+from datetime import date
+from functools import lru_cache
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
+from trend_dates import normalise_dates, parse_date_text
+
+DATE = 'date'
+NUMBER = 'number'
+CATEGORY = 'category'
+TEXT = 'text'
+KINDS = (DATE, NUMBER, CATEGORY, TEXT)
+
+SCHEMA_FILENAME = 'qds_schema.json'
+
+# Thousands separators and padding removed before numbers are parsed
+NUMBER_NOISE = r'[,\s]'
+
+# Declared types of the QDS export columns (after delcsv.py has dropped the
+# unused ones). Columns not listed here are read as text.
+QDS_SCHEMA = {
+    'Date': DATE,
+    # Scores and counts, exported with thousands separators
+    'QDS': NUMBER,
+    'TruRisk Score': NUMBER,
+    'ARS': NUMBER,
+    'ACS': NUMBER,
+    'CVSS Base': NUMBER,
+    'CVSS3.1 Base': NUMBER,
+    'Times Detected': NUMBER,
+    # Repeated values: a handful of distinct values over millions of rows
+    'QID': CATEGORY,
+    'Application': CATEGORY,
+    'Host': CATEGORY,
+    'DNS': CATEGORY,
+    'NetBIOS': CATEGORY,
+    'OS': CATEGORY,
+    'Owner': CATEGORY,
+    'Severity': CATEGORY,
+    'QDS Severity': CATEGORY,
+    'Status': CATEGORY,
+    'Vuln Status': CATEGORY,
+    'Type': CATEGORY,
+    'Category': CATEGORY,
+    'Protocol': CATEGORY,
+    'Ticket State': CATEGORY,
+    'PCI Vuln': CATEGORY,
+    'Title': CATEGORY,
+}
+
+ARROW_TYPES = {
+    DATE: pa.date32(),
+    NUMBER: pa.float64(),
+    CATEGORY: pa.dictionary(pa.int32(), pa.string()),
+    TEXT: pa.string(),
+}
+
+# ==========================
+# 1. Registry
+# ==========================
+
+def load_schema(path=None):
+    """
+    Returns the declared schema: QDS_SCHEMA updated with the overrides in
+    ``path`` (default: qds_schema.json in the working directory), if present.
+    """
+    schema = dict(QDS_SCHEMA)
+    path = path or os.path.join(os.getcwd(), SCHEMA_FILENAME)
+    if os.path.isfile(path):
+        with open(path, encoding='utf-8') as fh:
+            overrides = json.load(fh)
+        unknown = {col: kind for col, kind in overrides.items() if kind not in KINDS}
+        if unknown:
+            raise ValueError(f"Unknown column types in '{path}': {unknown}. Use one of {KINDS}.")
+        schema.update(overrides)
+        logging.info(f"Loaded {len(overrides)} column type overrides from '{path}'.")
+    return schema
+
+@lru_cache(maxsize=None)
+def _default_schema(cwd):
+    return load_schema(os.path.join(cwd, SCHEMA_FILENAME))
+
+def default_schema():
+    """
+    Returns the schema for the working directory, loaded once per process.
+    """
+    return _default_schema(os.getcwd())
+
+def column_kinds(columns, schema=None):
+    """
+    Returns the declared type of each column; the first column is always a date.
+    """
+    schema = schema if schema is not None else default_schema()
+    return [DATE if i == 0 else schema.get(col, TEXT) for i, col in enumerate(columns)]
+
+def arrow_schema(columns, schema=None):
+    """
+    Returns the Arrow schema that apply_schema() and read_csv() produce for ``columns``.
+    """
+    return pa.schema([(col, ARROW_TYPES[kind]) for col, kind in zip(columns, column_kinds(columns, schema))])
+
+# ==========================
+# 2. Column Conversion
+# ==========================
+
+def parse_dates(array, name=''):
+    """
+    Converts a column to date32 with the shared date normalisation; values
+    that are not dates become null and are reported.
+    """
+    return normalise_dates(array, name=name)
+
+def parse_numbers(array):
+    """
+    Converts a column to float64, removing thousands separators from text.
+    Returns the array and the number of non-empty values that were not numbers
+    (those become null).
+    """
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    if pa.types.is_integer(array.type) or pa.types.is_floating(array.type) or pa.types.is_null(array.type):
+        return pc.cast(array, pa.float64()), 0
+    text = pc.replace_substring_regex(pc.cast(array, pa.string()), NUMBER_NOISE, '')
+    text = pc.if_else(pc.equal(text, ''), pa.scalar(None, pa.string()), text)
+    valid = pc.match_substring_regex(text, r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')
+    rejected = pc.sum(pc.invert(valid)).as_py() or 0
+    numbers = pc.cast(pc.if_else(valid, text, pa.scalar(None, pa.string())), pa.float64())
+    return numbers, rejected
+
+def to_category(array):
+    """
+    Converts a column to dictionary-encoded text.
+    """
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    return pc.dictionary_encode(pc.cast(array, pa.string())).cast(ARROW_TYPES[CATEGORY])
+
+def to_text(array):
+    """
+    Converts a column to plain text.
+    """
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    return pc.cast(array, pa.string())
+
+def conform_column(array, kind, name=''):
+    """
+    Converts one column to its declared type. Arrays that already have the
+    declared type are returned unchanged.
+    """
+    if array.type == ARROW_TYPES[kind]:
+        return array
+    if kind == DATE:
+        return parse_dates(array, name)
+    if kind == NUMBER:
+        numbers, rejected = parse_numbers(array)
+        if rejected:
+            logging.warning(f"Column '{name}': {rejected} values are not numbers and were left empty.")
+        return numbers
+    if kind == CATEGORY:
+        return to_category(array)
+    return to_text(array)
+
+def apply_schema(table, schema=None, columns=None):
+    """
+    Converts a table (a workbook sheet or an untyped CSV) to the declared types.
+
+    Parameters:
+        table (pa.Table): The table to convert.
+        schema (dict): Column types; defaults to default_schema().
+        columns (list): Align to these columns: the first column is always the
+            date column whatever its header, missing columns are filled with
+            nulls and extra columns are dropped.
+
+    Returns:
+        table (pa.Table): The converted table.
+    """
+    names = table.column_names
+    if columns is None:
+        columns = names
+    kinds = column_kinds(columns, schema)
+    target = arrow_schema(columns, schema)
+    by_name = dict(zip(names[1:], table.columns[1:]))
+    arrays = [parse_dates(table.column(0), names[0])]
+    for field, kind in list(zip(target, kinds))[1:]:
+        if field.name in by_name:
+            arrays.append(conform_column(by_name[field.name], kind, field.name))
+        else:
+            logging.warning(f"Column '{field.name}' missing in new data. Filled with nulls.")
+            arrays.append(pa.nulls(table.num_rows, type=field.type))
+    extra = set(names[1:]) - set(columns)
+    if extra:
+        logging.warning(f"Dropping columns not present in the sheet: {sorted(extra)}")
+    return pa.Table.from_arrays(arrays, schema=target)
+
+# ==========================
+# 3. CSV Reading
+# ==========================
+
+# Exported descriptions can span lines, in raw and trimmed exports alike
+CSV_PARSE_OPTIONS = pacsv.ParseOptions(newlines_in_values=True)
+
+def read_header(csv_path, skip_rows=0):
+    """
+    Returns the header row of a CSV file.
+    """
+    with open(csv_path, newline='', encoding='utf-8-sig') as fh:
+        reader = csv.reader(fh)
+        for _ in range(skip_rows):
+            next(reader, None)
+        return next(reader, [])
+
+def read_csv(csv_path, skip_rows=0, schema=None, columns=None):
+    """
+    Reads a QDS CSV with Arrow's multi-threaded reader and the declared types.
+    Text and category columns are typed by the reader itself; date and
+    number columns are read as text and parsed in one vectorised pass each.
+
+    Parameters:
+        csv_path (str): Path to the CSV file.
+        skip_rows (int): Rows before the header (4 for raw QDS exports).
+        schema (dict): Column types; defaults to default_schema().
+        columns (list): Optional sheet columns to align to, as in apply_schema().
+
+    Returns:
+        table (pa.Table): The typed table.
+    """
+    header = read_header(csv_path, skip_rows)
+    kinds = column_kinds(header, schema)
+    column_types = {
+        name: ARROW_TYPES[CATEGORY] if kind == CATEGORY else pa.string()
+        for name, kind in zip(header, kinds)
+    }
+    table = pacsv.read_csv(
+        csv_path,
+        read_options=pacsv.ReadOptions(skip_rows=skip_rows),
+        parse_options=CSV_PARSE_OPTIONS,
+        convert_options=pacsv.ConvertOptions(column_types=column_types, strings_can_be_null=True),
+    )
+    return apply_schema(table, schema, columns)
+
+# ==========================
+# 4. Raw QDS Exports
+# ==========================
+
+# Lines of report preamble before the header row of a raw QDS export
+RAW_PREAMBLE_ROWS = 4
+
+# Columns dropped from raw exports (M to P, W to AD, AG to AL, AN to AQ are 12-15, 22-29, 32-37, 39-42 in zero-based index)
+RAW_DROPPED_COLUMNS = list(range(12, 16)) + list(range(22, 30)) + list(range(32, 38)) + list(range(39, 43))
+
+# Header of the date column stamped in front of the kept columns
+DATE_HEADER = 'Date'
+
+# Bytes parsed per batch; bounds memory whatever the size of the export
+RAW_BLOCK_SIZE = 16 << 20
+
+def unique_names(header):
+    """
+    Makes repeated header names unique the way pandas does ('Port', 'Port.1').
+    """
+    seen = {}
+    names = []
+    for name in header:
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+def is_raw_export(csv_path, skip_rows=0):
+    """
+    Returns True if the file is a raw QDS export as downloaded, False if it
+    was already trimmed (by delcsv.py or an earlier script): a trimmed file has
+    the Date column first, after ``skip_rows`` rows, and a date in its first row.
+    """
+    with open(csv_path, newline='', encoding='utf-8-sig') as fh:
+        reader = csv.reader(fh)
+        for _ in range(skip_rows):
+            next(reader, None)
+        header = next(reader, [])
+        first_row = next(reader, [])
+    if not header or header[0].strip() == DATE_HEADER:
+        return False
+    return not (first_row and parse_date_text(first_row[0]))
+
+def raw_export_columns(csv_path):
+    """
+    Returns the unique header names of a raw export and the names of the kept columns.
+    """
+    names = unique_names(read_header(csv_path, RAW_PREAMBLE_ROWS))
+    drop = set(RAW_DROPPED_COLUMNS)
+    return names, [name for i, name in enumerate(names) if i not in drop]
+
+def raw_export_schema(csv_path, schema=None):
+    """
+    Returns the Arrow schema of the batches iter_raw_export() yields for an
+    export, from its header alone.
+    """
+    _, kept = raw_export_columns(csv_path)
+    return arrow_schema([DATE_HEADER] + kept, schema)
+
+def iter_raw_export(csv_path, export_date=None, schema=None):
+    """
+    Streams a raw QDS export as typed record batches in one pass: the
+    preamble is skipped, only the kept columns are parsed, the export date is
+    stamped as the first column and every column gets its declared type.
+
+    Parameters:
+        csv_path (str): Path to the raw export.
+        export_date (date): Date stamped on the rows; defaults to today, as in delcsv.py.
+        schema (dict): Column types; defaults to default_schema().
+
+    Yields:
+        batch (pa.RecordBatch): Up to RAW_BLOCK_SIZE bytes of the export.
+    """
+    names, kept = raw_export_columns(csv_path)
+    columns = [DATE_HEADER] + kept
+    kinds = column_kinds(columns, schema)
+    target = arrow_schema(columns, schema)
+    reader = pacsv.open_csv(
+        csv_path,
+        read_options=pacsv.ReadOptions(skip_rows=RAW_PREAMBLE_ROWS + 1, column_names=names, block_size=RAW_BLOCK_SIZE),
+        parse_options=CSV_PARSE_OPTIONS,
+        convert_options=pacsv.ConvertOptions(
+            include_columns=kept,
+            column_types={
+                name: ARROW_TYPES[CATEGORY] if kind == CATEGORY else pa.string()
+                for name, kind in zip(kept, kinds[1:])
+            },
+            strings_can_be_null=True,
+        ),
+    )
+    stamp = pa.scalar(export_date or date.today(), type=pa.date32())
+    rejected = {}
+    for batch in reader:
+        arrays = [pa.repeat(stamp, batch.num_rows)]
+        for name, kind, array in zip(kept, kinds[1:], batch.columns):
+            if kind == NUMBER:
+                array, count = parse_numbers(array)
+                rejected[name] = rejected.get(name, 0) + count
+            elif kind == DATE:
+                array = parse_dates(array, name)
+            arrays.append(array)
+        yield pa.RecordBatch.from_arrays(arrays, schema=target)
+    for name, count in rejected.items():
+        if count:
+            logging.warning(f"Column '{name}': {count} values are not numbers and were left empty.")
+
+def read_raw_export(csv_path, export_date=None, schema=None, columns=None):
+    """
+    Reads a raw QDS export straight into the declared types, without the
+    intermediate CSV written by delcsv.py. See iter_raw_export().
+
+    Parameters:
+        csv_path (str): Path to the raw export.
+        export_date (date): Date stamped on the rows; defaults to today.
+        schema (dict): Column types; defaults to default_schema().
+        columns (list): Optional sheet columns to align to, as in apply_schema().
+
+    Returns:
+        table (pa.Table): The typed table.
+    """
+    _, kept = raw_export_columns(csv_path)
+    target = arrow_schema([DATE_HEADER] + kept, schema)
+    table = pa.Table.from_batches(iter_raw_export(csv_path, export_date, schema), schema=target)
+    if columns is not None:
+        table = apply_schema(table, schema, columns)
+    return table
+
+def read_export(csv_path, skip_rows=0, schema=None, columns=None, export_date=None):
+    """
+    Reads a QDS export whether it is raw, as downloaded, or was already
+    trimmed by delcsv.py. Raw exports go through read_raw_export() and trimmed
+    files through read_csv() with ``skip_rows``.
+
+    Returns:
+        table (pa.Table): The typed table.
+    """
+    if is_raw_export(csv_path, skip_rows):
+        logging.info(f"Ingesting raw export '{csv_path}' directly.")
+        return read_raw_export(csv_path, export_date, schema, columns)
+    return read_csv(csv_path, skip_rows, schema, columns)
@@ -4,10 +4,10 @@ import importlib
 import os
 import glob
 import logging
+import argparse
 from datetime import datetime
 import shutil
 from tqdm import tqdm
-import gc  # For garbage collection
 
 # List of required packages
 required_packages = [
@@ -32,7 +32,13 @@ install_packages(required_packages)
 
 # Now import the installed packages
 import polars as pl
+from polars.io.plugins import register_io_source
 import pandas as pd
+from xlsx_stream import StreamingWorkbookWriter, WorkbookReader
+from xlsx_cache import cache_sheets
+from qds_schema import column_kinds, is_raw_export, iter_raw_export, raw_export_schema, DATE, NUMBER, CATEGORY, NUMBER_NOISE
+from trend_dates import normalise_dates
+from trend_telemetry import RunTelemetry, stage, PROFILERS
 
 # Setup logging
 logging.basicConfig(
@@ -42,186 +48,212 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# Mapping of CSV filename patterns to sheet names
+pattern_to_sheet = {
+    'QDS-above-70-crossed-40d': 'QDS above 70 G40',
+    'QDS-0-69-crossed-40d': 'QDS below 70 G40',
+    'QDS-0-69-less-40d': 'QDS below 70 L40',
+    'QDS-above-70-less-40d': 'QDS above 70 L40'
+}
+
 def map_csv_to_sheet(csv_filename):
     """
     Maps a CSV filename to the corresponding Excel sheet name based on predefined patterns.
     """
     basename = os.path.splitext(csv_filename)[0]
-    mapping = {
-        'QDS-above-70-crossed-40d': 'QDS above 70 G40',
-        'QDS-0-69-crossed-40d': 'QDS below 70 G40',
-        'QDS-0-69-less-40d': 'QDS below 70 L40',
-        'QDS-above-70-less-40d': 'QDS above 70 L40'
-    }
-    return mapping.get(basename, None)
-
-def read_excel_sheets(excel_path):
+    return pattern_to_sheet.get(basename, None)
+
+# ==========================
+# Lazy Inputs
+# ==========================
+#
+# Nothing below reads data until save_final_excel() runs the plans. Sheets are
+# scanned from their Arrow files in the conversion cache (see xlsx_cache.py)
+# and CSVs with scan_csv (raw exports through a lazy source over their
+# batches), so Polars can push projections and filters down to the scans and
+# run each sheet's plan on its streaming engine.
+
+def scan_excel_sheets(excel_path, max_workers=4):
     """
-    Reads all sheets from the Excel file into a dictionary of Polars DataFrames using openpyxl in read-only mode.
+    Returns {sheet name: LazyFrame} for every sheet of the Excel file.
+    Sheets unchanged since the last run are scanned from the conversion cache
+    as is; changed sheets are parsed first, concurrently in up to
+    ``max_workers`` processes.
     """
     try:
-        from openpyxl import load_workbook
-        print(f"Opening Excel file '{excel_path}' with openpyxl...")
-        logging.info(f"Opening Excel file '{excel_path}' with openpyxl...")
-        wb = load_workbook(excel_path, read_only=True, data_only=True)
-        print("Excel file opened successfully.")
-        sheet_names = wb.sheetnames
+        print(f"Opening Excel file '{excel_path}'...")
+        logging.info(f"Opening Excel file '{excel_path}'...")
+        with WorkbookReader(excel_path) as reader:
+            sheet_names = reader.sheet_names
         print(f"Found sheets: {sheet_names}")
         logging.info(f"Found sheets: {sheet_names}")
-        polars_dict = {}
-        for sheet_name in tqdm(sheet_names, desc="Reading Excel Sheets"):
-            print(f"Reading sheet: {sheet_name}")
-            sheet_start_time = datetime.now()
-            ws = wb[sheet_name]
-
-            # Extract data using generator to minimize memory usage
-            data = ws.values
-            # Get the first line as columns header
-            columns = next(data)
-            # Convert the rest of the data into a list of tuples
-            data_rows = list(data)
-
-            # Create Polars DataFrame
-            df = pl.DataFrame(data_rows, columns=columns)
-
-            # Optional: Drop any completely empty columns (if any)
-            df = df.drop_nulls(subset=df.columns)
-
-            polars_dict[sheet_name] = df
-            sheet_end_time = datetime.now()
-            elapsed_time = sheet_end_time - sheet_start_time
-            print(f"Finished reading sheet: {sheet_name} in {elapsed_time}")
-            logging.info(f"Finished reading sheet: {sheet_name} in {elapsed_time}")
-            # Free memory
-            del ws
-            gc.collect()
-        print("Completed reading all Excel sheets.")
-        wb.close()
-        return polars_dict
+
+        paths = cache_sheets(excel_path, sheet_names, max_workers=max_workers)
+        logging.info(f"Prepared {len(sheet_names)} sheets for scanning.")
+        return {sheet_name: pl.scan_ipc(paths[sheet_name]) for sheet_name in sheet_names}
     except Exception as e:
         logging.error(f"Error reading Excel file '{excel_path}': {e}")
         sys.exit(f"Error reading Excel file '{excel_path}': {e}")
 
-def read_csv_file(csv_path):
+def scan_raw_export(csv_path):
     """
-    Reads a CSV file into a Polars DataFrame with all columns as strings.
-    Logs any malformed rows or read errors.
+    Returns a LazyFrame over a raw QDS export. Only the header is read here;
+    the export is parsed batch by batch by iter_raw_export() (preamble
+    skipped, unused columns dropped, date stamped, typed) when the plan runs.
     """
-    try:
-        print(f"Reading CSV file: {csv_path}")
-        df = pl.read_csv(
-            csv_path,
-            try_parse_dates=False,  # Disable automatic date parsing
-            ignore_errors=False,     # Do not ignore errors to capture bad rows
-            low_memory=False,        # Disable low_memory to improve type inference
-            n_threads=4,             # Utilize all available cores
-            infer_schema_length=1000,  # Infer schema from first 1000 rows
-            dtype={"Date": pl.Utf8},   # Ensure Date column is read as string
+    schema = pl.from_arrow(raw_export_schema(csv_path).empty_table()).schema
+
+    def read_batches(with_columns, predicate, n_rows, batch_size):
+        for batch in iter_raw_export(csv_path):
+            df = pl.from_arrow(batch)
+            if with_columns is not None:
+                df = df.select(with_columns)
+            if predicate is not None:
+                df = df.filter(predicate)
+            if n_rows is not None:
+                df = df.head(n_rows)
+                n_rows -= df.height
+            yield df
+            if n_rows == 0:
+                return
+
+    return register_io_source(read_batches, schema=schema)
+
+def scan_csv_file(csv_path):
+    """
+    Returns a LazyFrame over a CSV file. Every column is scanned as text and
+    converted by conform_columns(), so no schema inference pass runs.
+    A raw QDS export is scanned with scan_raw_export() instead.
+    """
+    if is_raw_export(csv_path):
+        print(f"Scanning raw export: {csv_path}")
+        logging.info(f"Scanning raw export '{csv_path}'.")
+        return scan_raw_export(csv_path)
+    print(f"Scanning CSV file: {csv_path}")
+    logging.info(f"Scanning CSV file '{csv_path}'.")
+    return pl.scan_csv(csv_path, infer_schema=False, low_memory=False)
+
+# ==========================
+# Column Expressions
+# ==========================
+
+# Polars types of the declared column types; text is pl.String
+POLARS_TYPES = {DATE: pl.Date, NUMBER: pl.Float64, CATEGORY: pl.Categorical}
+
+def _as_text(column, dtype):
+    # Categorical and numeric columns are converted through their text
+    if dtype == pl.String:
+        return column
+    return column.cast(pl.String)
+
+def declared_expression(name, kind, dtype):
+    """
+    Returns the expression converting column ``name`` of type ``dtype`` to its
+    declared type (see qds_schema.py). Columns that already have the declared
+    type are passed through.
+    """
+    column = pl.col(name)
+    if kind == DATE:
+        if dtype == pl.Date:
+            return column
+        if dtype.is_temporal():
+            return column.cast(pl.Date)
+        # Each batch's distinct values are parsed once by the shared date normalisation
+        return column.map_batches(
+            lambda batch: pl.Series(batch.name, normalise_dates(batch.to_arrow(), name=name)),
+            return_dtype=pl.Date,
+            is_elementwise=True,
         )
-        logging.info(f"Successfully read CSV file '{csv_path}' with {df.height} rows and {df.width} columns.")
-        print(f"Successfully read CSV file: {csv_path} with {df.height} rows and {df.width} columns.")
-        return df
-    except pl.errors.ParseError as pe:
-        logging.error(f"Parse error in file '{csv_path}': {pe}")
-    except Exception as e:
-        logging.error(f"Unexpected error reading CSV file '{csv_path}': {e}")
-    return None
-
-def parse_columns(df, date_column='Date'):
+    if kind == NUMBER:
+        if dtype == pl.Float64:
+            return column
+        if dtype.is_numeric():
+            return column.cast(pl.Float64)
+        text = _as_text(column, dtype).str.replace_all(NUMBER_NOISE, '')
+        return text.cast(pl.Float64, strict=False)
+    if kind == CATEGORY:
+        if dtype == pl.Categorical:
+            return column
+        return _as_text(column, dtype).cast(pl.Categorical)
+    return _as_text(column, dtype)
+
+def conform_columns(lf, columns=None):
     """
-    Parses columns to their appropriate data types.
-    Specifically handles the Date column and attempts to parse numerical columns.
-    Logs any parsing errors.
+    Converts every column of a LazyFrame to its declared type in one
+    projection, replacing a cast per column. With ``columns`` the frame is
+    aligned to a sheet: its first column is taken as the date column whatever
+    its header, missing columns are filled with nulls and extra columns are dropped.
     """
-    try:
-        # Parse the Date column
-        if date_column in df.columns:
-            df = df.with_column(
-                pl.col(date_column).str.strptime(pl.Date, fmt="%Y-%m-%d", strict=False).alias(date_column)
-            )
-            logging.info(f"Parsed '{date_column}' column to Date type.")
+    schema = lf.collect_schema()
+    names = schema.names()
+    if columns is None:
+        columns = names
+    source = {columns[0]: names[0]}
+    source.update({name: name for name in names[1:]})
+    missing = [col for col in columns[1:] if col not in source]
+    if missing:
+        logging.warning(f"Columns {missing} missing in new data. Filled with nulls.")
+    extra = set(names[1:]) - set(columns)
+    if extra:
+        logging.warning(f"Dropping columns not present in the sheet: {sorted(extra)}")
+
+    expressions = []
+    for col, kind in zip(columns, column_kinds(columns)):
+        if col in source:
+            expression = declared_expression(source[col], kind, schema[source[col]])
         else:
-            logging.warning(f"Date column '{date_column}' not found in DataFrame.")
-        
-        # Attempt to parse other columns to numeric where possible
-        numeric_columns = [col for col in df.columns if col != date_column]
-        for col in numeric_columns:
-            # Attempt to parse to Float
-            df = df.with_column(
-                pl.col(col).str.strip().str.replace(',', '').cast(pl.Float64, strict=False)
-            )
-        logging.info("Completed parsing columns to appropriate data types.")
-        return df
-    except Exception as e:
-        logging.error(f"Error parsing columns: {e}")
-        return df  # Return DataFrame even if parsing fails
+            expression = pl.lit(None, dtype=POLARS_TYPES.get(kind, pl.String))
+        expressions.append(expression.alias(col))
+    return lf.select(expressions)
+
+# ==========================
+# Query Plan
+# ==========================
 
-def merge_data(excel_df, csv_df, date_column='Date'):
+def remove_oldest_rows(lf, sheet_name, date_column):
     """
-    Merges CSV DataFrame into Excel DataFrame based on the date column.
+    Adds the filter removing the rows with the oldest date to a sheet's plan.
+    Only the date column is read to find the oldest date; rows without a
+    valid date are kept.
     """
-    try:
-        # Ensure the date column is in datetime format
-        if date_column in excel_df.columns:
-            excel_df = excel_df.with_column(
-                pl.col(date_column).cast(pl.Date, strict=False)
-            )
-        else:
-            logging.warning(f"Date column '{date_column}' not found in Excel DataFrame.")
-        
-        if date_column in csv_df.columns:
-            csv_df = csv_df.with_column(
-                pl.col(date_column).cast(pl.Date, strict=False)
-            )
-        else:
-            logging.warning(f"Date column '{date_column}' not found in CSV DataFrame.")
-        
-        # Perform a join on the date column
-        merged_df = excel_df.join(csv_df, on=date_column, how='outer')
-        
-        logging.info("Successfully merged CSV data into Excel sheet.")
-        print("Successfully merged CSV data into Excel sheet.")
-        return merged_df
-    except Exception as e:
-        logging.error(f"Error merging data: {e}")
-        return excel_df  # Return original if merge fails
-
-def remove_oldest_rows(excel_sheets_dict, date_column='Date'):
+    with stage('rollover', sheet=sheet_name):
+        min_date = lf.select(pl.col(date_column).min()).collect().item()
+    if min_date is None:
+        logging.warning(f"No valid dates found in sheet '{sheet_name}'. Skipping removal of oldest rows.")
+        print(f"No valid dates found in sheet '{sheet_name}'. Skipping removal of oldest rows.")
+        return lf
+    logging.info(f"Removing rows with date '{min_date}' from sheet '{sheet_name}'.")
+    print(f"Removing rows with date '{min_date}' from sheet '{sheet_name}'.")
+    date = pl.col(date_column)
+    return lf.filter(date.is_null() | (date != min_date))
+
+def build_sheet_plan(sheet_name, sheet_lf, csv_paths, date_column='Date'):
     """
-    Removes rows with the oldest date from each sheet.
+    Builds the lazy plan of one sheet: declared column types, the
+    oldest-date filter, the CSV data appended and duplicate rows removed.
     """
-    for sheet_name, df in excel_sheets_dict.items():
-        try:
-            print(f"Processing sheet '{sheet_name}' to remove oldest rows...")
-            # Check if date column exists
-            if date_column not in df.columns:
-                logging.warning(f"Date column '{date_column}' not found in sheet '{sheet_name}'. Skipping removal of oldest rows.")
-                continue
-            
-            # Ensure the date column is of Date type
-            if df[date_column].dtype != pl.Date:
-                df = df.with_column(
-                    pl.col(date_column).cast(pl.Date, strict=False)
-                )
-            
-            # Find the minimum date, ignoring nulls
-            min_date_series = df.select(pl.col(date_column).min()).to_series()
-            min_date = min_date_series.drop_nulls().to_list()[0] if min_date_series.drop_nulls().to_list() else None
-            
-            if min_date:
-                # Filter out rows with the minimum date
-                df_filtered = df.filter(pl.col(date_column) != min_date)
-                excel_sheets_dict[sheet_name] = df_filtered
-                logging.info(f"Removed rows with date '{min_date}' from sheet '{sheet_name}'.")
-                print(f"Removed rows with date '{min_date}' from sheet '{sheet_name}'.")
-            else:
-                logging.warning(f"No valid dates found in sheet '{sheet_name}'. Skipping removal of oldest rows.")
-        except Exception as e:
-            logging.error(f"Error removing oldest rows in sheet '{sheet_name}': {e}")
-
-def save_final_excel(excel_sheets_dict, original_excel_path):
+    qds_sheet = sheet_name in pattern_to_sheet.values()
+    if qds_sheet:
+        sheet_lf = conform_columns(sheet_lf)
+        date_column = sheet_lf.collect_schema().names()[0]
+    if date_column not in sheet_lf.collect_schema().names():
+        logging.warning(f"Date column '{date_column}' not found in sheet '{sheet_name}'. Skipping removal of oldest rows.")
+        return sheet_lf
+    plan = remove_oldest_rows(sheet_lf, sheet_name, date_column)
+    if csv_paths:
+        columns = sheet_lf.collect_schema().names()
+        csv_lfs = [conform_columns(scan_csv_file(csv_path), columns) for csv_path in csv_paths]
+        plan = pl.concat([plan] + csv_lfs, how='vertical')
+    if qds_sheet:
+        plan = plan.unique(maintain_order=True)
+    return plan
+
+def save_final_excel(plans, original_excel_path, streaming=True):
     """
-    Saves the final Excel file with a timestamp and creates a backup of the original.
+    Runs the plans and saves the final Excel file with a timestamp, after
+    creating a backup of the original. With streaming=True each plan runs on
+    Polars' streaming engine and its batches go straight into the xlsx writer;
+    otherwise the frames are collected and written with pandas and openpyxl.
     """
     try:
         # Create backup
@@ -231,37 +263,41 @@ def save_final_excel(excel_sheets_dict, original_excel_path):
         shutil.copy2(original_excel_path, backup_path)
         logging.info(f"Backup created at '{backup_path}'")
         print(f"Backup of the original Excel file created at '{backup_path}'")
-        
-        # Convert Polars DataFrames to pandas DataFrames
-        pandas_dict = {}
-        print("Converting Polars DataFrames to pandas DataFrames...")
-        for sheet, df in excel_sheets_dict.items():
-            pandas_df = df.to_pandas()
-            pandas_dict[sheet] = pandas_df
-            logging.info(f"Converted sheet '{sheet}' to pandas DataFrame.")
-            # Free memory
-            del df
-            gc.collect()
-        
-        # Save to new Excel with timestamp
+
         final_excel_path = f"{os.path.splitext(original_excel_path)[0]}_Final_{timestamp}.xlsx"
         print(f"Saving merged data to '{final_excel_path}'...")
-        with pd.ExcelWriter(final_excel_path, engine='openpyxl') as writer:
-            for sheet, df in pandas_dict.items():
-                df.to_excel(writer, sheet_name=sheet, index=False)
-                logging.info(f"Saved sheet '{sheet}' to final Excel file.")
-                # Free memory
-                del df
-                gc.collect()
+        if streaming:
+            with StreamingWorkbookWriter(final_excel_path) as writer:
+                for sheet, plan in tqdm(plans.items(), desc="Writing Sheets"):
+                    # The streaming plan reads, appends and dedupes while it writes
+                    with stage('write', sheet=sheet) as st:
+                        batches = (df.to_arrow() for df in plan.collect_batches(engine='streaming'))
+                        rows = st.rows_out = writer.write_sheet(sheet, batches, columns=plan.collect_schema().names())
+                    logging.info(f"Saved sheet '{sheet}' with {rows} rows to final Excel file.")
+        else:
+            with pd.ExcelWriter(final_excel_path, engine='openpyxl') as writer:
+                for sheet, plan in tqdm(plans.items(), desc="Writing Sheets"):
+                    with stage('write', sheet=sheet) as st:
+                        df = plan.collect(engine='streaming').to_pandas()
+                        df.to_excel(writer, sheet_name=sheet, index=False)
+                        st.rows_out = len(df)
+                    logging.info(f"Saved sheet '{sheet}' with {len(df)} rows to final Excel file.")
+                    del df
         logging.info(f"Final Excel file saved at '{final_excel_path}'")
         print(f"Final Excel file saved at '{final_excel_path}'")
     except Exception as e:
         logging.error(f"Error saving final Excel file: {e}")
         print(f"Error saving final Excel file: {e}")
+        raise
 
 def main():
-    # Start overall timer
-    overall_start = datetime.now()
+    parser = argparse.ArgumentParser(description="Roll the NA Trend Report over with the CSV exports in the current directory.")
+    parser.add_argument('--profile', choices=PROFILERS, default=None,
+                        help="Profile the stages; the run record keeps the slowest stage's profile.")
+    parser.add_argument('--telemetry', default=None,
+                        help="Run record file the stage timings are appended to (default: trend_runs.jsonl).")
+    args = parser.parse_args()
+    telemetry = RunTelemetry('terend1.py', record_path=args.telemetry, profile=args.profile)
 
     # Define current working directory
     cwd = os.getcwd()
@@ -269,86 +305,59 @@ def main():
     excel_file = os.path.join(cwd, 'NA Trend Report.xlsx')
     csv_pattern = os.path.join(cwd, "*.csv")
 
-    # Check if Excel file exists
-    if not os.path.isfile(excel_file):
-        logging.error(f"Excel file '{excel_file}' not found in the current directory.")
-        sys.exit(f"Excel file '{excel_file}' not found in the current directory.")
-
-    # Read Excel sheets
-    print("Reading Excel file...")
-    excel_start = datetime.now()
-    excel_sheets = read_excel_sheets(excel_file)
-    excel_end = datetime.now()
-    elapsed_excel = excel_end - excel_start
-    print(f"Excel file read in {elapsed_excel}")
-    logging.info(f"Excel file '{excel_file}' read in {elapsed_excel}")
-
-    # Find all CSV files matching the pattern
-    csv_files = glob.glob(csv_pattern)
-
-    # Exclude the Excel file if it has a .csv extension
-    csv_files = [f for f in csv_files if os.path.basename(f) != 'NA Trend Report.xlsx']
-
-    if not csv_files:
-        logging.error("No CSV files found in the current directory.")
-        sys.exit("No CSV files found.")
-
-    # Process each CSV file
-    print("Processing CSV files...")
-    for csv_file in tqdm(csv_files, desc="CSV Files"):
-        sheet_name = map_csv_to_sheet(os.path.basename(csv_file))
-        if not sheet_name:
-            logging.warning(f"No mapping found for CSV file '{csv_file}'. Skipping.")
-            print(f"No mapping found for CSV file '{csv_file}'. Skipping.")
-            continue
-
-        if sheet_name not in excel_sheets:
-            logging.warning(f"Sheet '{sheet_name}' not found in Excel file. Skipping CSV '{csv_file}'.")
-            print(f"Sheet '{sheet_name}' not found in Excel file. Skipping CSV '{csv_file}'.")
-            continue
-
-        csv_df = read_csv_file(csv_file)
-        if csv_df is None:
-            logging.error(f"Failed to read CSV file '{csv_file}'. Skipping.")
-            print(f"Failed to read CSV file '{csv_file}'. Skipping.")
-            continue
-
-        # Parse columns to handle mixed data types
-        csv_df = parse_columns(csv_df)
-
-        # Merge CSV data into the corresponding Excel sheet
-        merged_df = merge_data(excel_sheets[sheet_name], csv_df)
-        excel_sheets[sheet_name] = merged_df
-        logging.info(f"Merged CSV file '{csv_file}' into sheet '{sheet_name}'.")
-        print(f"Merged CSV file '{csv_file}' into sheet '{sheet_name}'.")
-        # Free memory
-        del csv_df
-        del merged_df
-        gc.collect()
-
-    # Remove oldest rows
-    print("Removing oldest rows from each sheet...")
-    remove_start = datetime.now()
-    remove_oldest_rows(excel_sheets)
-    remove_end = datetime.now()
-    elapsed_remove = remove_end - remove_start
-    print(f"Oldest rows removed in {elapsed_remove}")
-    logging.info(f"Oldest rows removed in {elapsed_remove}")
-
-    # Save final Excel file
-    print("Saving final Excel file...")
-    save_start = datetime.now()
-    save_final_excel(excel_sheets, excel_file)
-    save_end = datetime.now()
-    elapsed_save = save_end - save_start
-    print(f"Final Excel file saved in {elapsed_save}")
-    logging.info(f"Final Excel file saved in {elapsed_save}")
-
-    # End overall timer
-    overall_end = datetime.now()
-    total_time = overall_end - overall_start
-    print(f"Script completed in {total_time}")
-    logging.info(f"Script completed in {total_time}")
+    status = 'error'
+    try:
+        # Check if Excel file exists
+        if not os.path.isfile(excel_file):
+            logging.error(f"Excel file '{excel_file}' not found in the current directory.")
+            sys.exit(f"Excel file '{excel_file}' not found in the current directory.")
+
+        # Scan Excel sheets
+        print("Reading Excel file...")
+        with stage('read workbook') as st:
+            excel_sheets = scan_excel_sheets(excel_file)
+        print(f"Excel file prepared in {st.record['wall_s']} s")
+        logging.info(f"Excel file '{excel_file}' prepared in {st.record['wall_s']} s")
+
+        # Find all CSV files matching the pattern
+        csv_files = glob.glob(csv_pattern)
+
+        if not csv_files:
+            logging.error("No CSV files found in the current directory.")
+            sys.exit("No CSV files found.")
+
+        # Assign each CSV file to its sheet
+        sheet_csvs = {}
+        for csv_file in csv_files:
+            sheet_name = map_csv_to_sheet(os.path.basename(csv_file))
+            if not sheet_name:
+                logging.warning(f"No mapping found for CSV file '{csv_file}'. Skipping.")
+                print(f"No mapping found for CSV file '{csv_file}'. Skipping.")
+                continue
+            if sheet_name not in excel_sheets:
+                logging.warning(f"Sheet '{sheet_name}' not found in Excel file. Skipping CSV '{csv_file}'.")
+                print(f"Sheet '{sheet_name}' not found in Excel file. Skipping CSV '{csv_file}'.")
+                continue
+            sheet_csvs.setdefault(sheet_name, []).append(csv_file)
+
+        # Build one lazy plan per sheet
+        print("Building query plans...")
+        with stage('plan') as st:
+            plans = {
+                sheet_name: build_sheet_plan(sheet_name, lf, sorted(sheet_csvs.get(sheet_name, [])))
+                for sheet_name, lf in excel_sheets.items()
+            }
+        print(f"Query plans built in {st.record['wall_s']} s")
+        logging.info(f"Query plans built in {st.record['wall_s']} s")
+
+        # Run the plans and save the final Excel file
+        print("Saving final Excel file...")
+        save_final_excel(plans, excel_file)
+        status = 'ok'
+    finally:
+        record = telemetry.finish(status=status, workbook=excel_file)
+    print(f"Script completed in {record['wall_s']} s")
+    logging.info(f"Script completed in {record['wall_s']} s")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,163 @@
+import os
+import csv
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pytest
+
+import trend_journal
+from trend_journal import StageJournal
+from xlsx_stream import StreamingWorkbookWriter, WorkbookReader
+
+SHEET = 'QDS above 70 G40'
+
+class Crash(Exception):
+    pass
+
+def write_workbook(path, dates):
+    table = pa.table({'Date': pa.array(dates, type=pa.string()), 'Value': pa.array(range(len(dates)))})
+    with StreamingWorkbookWriter(str(path)) as writer:
+        writer.write_sheet(SHEET, table)
+
+def read_dates(path):
+    with WorkbookReader(str(path)) as reader:
+        return reader.read_sheet(SHEET)['Date'].cast(pa.string()).to_pylist()
+
+def write_csv(path, dates):
+    with open(path, 'w', newline='') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(['Date', 'Value'])
+        writer.writerows((d, 100 + i) for i, d in enumerate(dates))
+
+def read_csv(path):
+    with open(path, newline='') as fh:
+        rows = list(csv.DictReader(fh))
+    return pa.table({
+        'Date': pa.array([r['Date'] for r in rows], type=pa.string()),
+        'Value': pa.array([int(r['Value']) for r in rows], type=pa.int64()),
+    })
+
+def nightly_run(excel_path, csv_path, crash_after=None):
+    """
+    A rollover the way the trend scripts run it: drop the oldest date, append
+    the export, and replace the workbook through the journal.
+    """
+    journal = StageJournal(str(excel_path), inputs=[str(csv_path)])
+    if journal.already_completed:
+        return journal
+
+    if journal.done(SHEET, 'rollover'):
+        table = journal.load(SHEET, 'rollover')
+    else:
+        with WorkbookReader(str(excel_path)) as reader:
+            table = reader.read_sheet(SHEET)
+        table = table.set_column(0, 'Date', table['Date'].cast(pa.string()))
+        oldest = pc.min(table['Date']).as_py()
+        table = table.filter(pc.not_equal(table['Date'], oldest))
+        journal.record(SHEET, 'rollover', {'rows': table}, oldest_date=oldest)
+    if crash_after == 'rollover':
+        raise Crash()
+
+    if journal.done(SHEET, 'append'):
+        table = journal.load(SHEET, 'append')
+    else:
+        table = pa.concat_tables([table, read_csv(csv_path).cast(table.schema)])
+        journal.record(SHEET, 'append', {'rows': table}, uses_inputs=True)
+    if crash_after == 'append':
+        raise Crash()
+
+    staged_path = journal.staging_path(str(excel_path))
+    with StreamingWorkbookWriter(staged_path) as writer:
+        writer.write_sheet(SHEET, table)
+    journal.publish(staged_path, str(excel_path))
+    return journal
+
+@pytest.fixture
+def report(tmp_path):
+    excel_path = tmp_path / 'NA Trend Report.xlsx'
+    csv_path = tmp_path / 'QDS-above-70-crossed-40d.csv'
+    write_workbook(excel_path, ['2024-01-01', '2024-01-01', '2024-01-02', '2024-01-03'])
+    write_csv(csv_path, ['2024-01-04', '2024-01-04'])
+    return excel_path, csv_path
+
+EXPECTED = ['2024-01-02', '2024-01-03', '2024-01-04', '2024-01-04']
+
+@pytest.mark.parametrize('crash_after', ['rollover', 'append'])
+def test_resumed_stage_does_not_drop_a_second_day(report, crash_after):
+    excel_path, csv_path = report
+    with pytest.raises(Crash):
+        nightly_run(excel_path, csv_path, crash_after=crash_after)
+
+    journal = nightly_run(excel_path, csv_path)
+
+    assert journal.resumed
+    assert read_dates(excel_path) == EXPECTED
+
+def test_crash_before_the_staged_workbook_is_renamed(report, monkeypatch):
+    excel_path, csv_path = report
+    real_replace = os.replace
+
+    def replace(src, dst):
+        if os.fspath(dst) == str(excel_path):
+            raise Crash()
+        real_replace(src, dst)
+
+    monkeypatch.setattr(trend_journal.os, 'replace', replace)
+    with pytest.raises(Crash):
+        nightly_run(excel_path, csv_path)
+    monkeypatch.undo()
+    assert read_dates(excel_path)[0] == '2024-01-01'
+
+    journal = nightly_run(excel_path, csv_path)
+
+    assert journal.already_completed
+    assert read_dates(excel_path) == EXPECTED
+
+def test_crash_after_the_staged_workbook_is_renamed(report, monkeypatch):
+    excel_path, csv_path = report
+
+    def complete(self, output_path):
+        raise Crash()
+
+    monkeypatch.setattr(StageJournal, 'complete', complete)
+    with pytest.raises(Crash):
+        nightly_run(excel_path, csv_path)
+    monkeypatch.undo()
+    assert read_dates(excel_path) == EXPECTED
+
+    journal = nightly_run(excel_path, csv_path)
+
+    assert journal.already_completed
+    assert read_dates(excel_path) == EXPECTED
+
+def test_changed_exports_redo_only_the_append(report):
+    excel_path, csv_path = report
+    with pytest.raises(Crash):
+        nightly_run(excel_path, csv_path, crash_after='append')
+    write_csv(csv_path, ['2024-01-04', '2024-01-04', '2024-01-04'])
+
+    journal = nightly_run(excel_path, csv_path)
+
+    assert journal.resumed
+    assert read_dates(excel_path) == ['2024-01-02', '2024-01-03', '2024-01-04', '2024-01-04', '2024-01-04']
+
+def test_completed_run_with_the_same_exports_does_nothing(report):
+    excel_path, csv_path = report
+    nightly_run(excel_path, csv_path)
+    written = trend_journal.file_fingerprint(str(excel_path))
+
+    journal = nightly_run(excel_path, csv_path)
+
+    assert journal.already_completed
+    assert trend_journal.file_fingerprint(str(excel_path)) == written
+    assert read_dates(excel_path) == EXPECTED
+
+def test_new_exports_after_a_completed_run_start_a_new_night(report):
+    excel_path, csv_path = report
+    nightly_run(excel_path, csv_path)
+    write_csv(csv_path, ['2024-01-05'])
+
+    journal = nightly_run(excel_path, csv_path)
+
+    assert not journal.already_completed and not journal.resumed
+    assert read_dates(excel_path) == ['2024-01-03', '2024-01-04', '2024-01-04', '2024-01-05']
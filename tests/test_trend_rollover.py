@@ -0,0 +1,55 @@
+import pandas as pd
+
+from trend_rollover import apply_plan, date_histogram, describe_plan, plan_rollover
+
+DAYS = pd.to_datetime(['2024-01-01', '2024-01-02', '2024-01-03'])
+
+def histogram(*counts):
+    return pd.Series(counts, index=DAYS[:len(counts)], dtype='int64')
+
+def test_nothing_dropped_when_the_new_rows_fit():
+    plan = plan_rollover(histogram(3, 3, 3), 9, 1, row_limit=10)
+    assert plan['days_dropped'] == []
+    assert plan['rows_dropped'] == 0
+    assert plan['rows_after'] == 10
+    assert plan['fits']
+
+def test_exactly_one_day_dropped_when_it_makes_room():
+    plan = plan_rollover(histogram(3, 3, 3), 9, 4, row_limit=10)
+    assert plan['days_dropped'] == [DAYS[0]]
+    assert plan['rows_dropped'] == 3
+    assert plan['rows_after'] == 10
+    assert plan['fits']
+
+def test_excess_inside_a_day_drops_that_whole_day():
+    plan = plan_rollover(histogram(3, 3, 3), 9, 5, row_limit=10)
+    assert plan['days_dropped'] == [DAYS[0], DAYS[1]]
+    assert plan['rows_dropped'] == 6
+    assert plan['rows_after'] == 8
+
+def test_undated_rows_count_but_are_never_dropped():
+    plan = plan_rollover(histogram(2, 2), 10, 4, row_limit=10)
+    assert plan['days_dropped'] == [DAYS[0], DAYS[1]]
+    assert plan['rows_dropped'] == 4
+    assert plan['rows_after'] == 10
+    assert plan['fits']
+
+def test_reports_when_even_every_day_is_not_enough():
+    plan = plan_rollover(histogram(2, 2), 4, 20, row_limit=10)
+    assert plan['days_dropped'] == [DAYS[0], DAYS[1]]
+    assert plan['rows_after'] == 20
+    assert not plan['fits']
+
+def test_accepts_a_dict_of_day_counts():
+    plan = plan_rollover({DAYS[0]: 3, DAYS[1]: 3}, 6, 5, row_limit=10)
+    assert plan['days_dropped'] == [DAYS[0]]
+
+def test_apply_plan_keeps_undated_rows():
+    df = pd.DataFrame({'Date': [DAYS[0], DAYS[1], pd.NaT, DAYS[2]], 'Value': [1, 2, 3, 4]})
+    counts = date_histogram(df['Date'])
+    assert list(counts) == [1, 1, 1]
+
+    plan = plan_rollover(counts, len(df), 2, row_limit=4)
+    assert plan['days_dropped'] == [DAYS[0], DAYS[1]]
+    assert list(apply_plan(df, 'Date', plan)['Value']) == [3, 4]
+    assert describe_plan(plan).startswith('Rollover plan: 2 days dropped (01/01/2024 to 01/02/2024)')
@@ -0,0 +1,159 @@
+import re
+import datetime
+import zipfile
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+import pyarrow as pa
+
+from xlsx_stream import NS_MAIN, WorkbookReader, patch_workbook, rebase_sheet_ranges
+
+WORKBOOK = (
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>'
+)
+WORKBOOK_RELS = (
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/></Relationships>'
+)
+
+def write_shared_strings_workbook(path, rows, styles_xml=None, row_style=None):
+    """
+    Writes a one-sheet workbook the way Excel does, with every text cell in
+    the shared-strings table. None leaves the cell out. ``row_style`` is the
+    style index of the first cell of every data row.
+    """
+    strings = []
+    sheet_rows = []
+    for r, row in enumerate(rows, start=1):
+        cells = []
+        for c, value in enumerate(row):
+            if value is None:
+                continue
+            ref = f'{"ABCDEFGHIJKLMNOPQRSTUVWXYZ"[c]}{r}'
+            if isinstance(value, str):
+                if value not in strings:
+                    strings.append(value)
+                cells.append(f'<c r="{ref}" t="s"><v>{strings.index(value)}</v></c>')
+            else:
+                s_attr = f' s="{row_style}"' if row_style is not None and r > 1 and c == 0 else ''
+                cells.append(f'<c r="{ref}"{s_attr}><v>{value}</v></c>')
+        sheet_rows.append(f'<row r="{r}">{"".join(cells)}</row>')
+    sheet = (
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        f'<sheetData>{"".join(sheet_rows)}</sheetData></worksheet>'
+    )
+    shared = (
+        '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        + ''.join(f'<si><t>{escape(s)}</t></si>' for s in strings)
+        + '</sst>'
+    )
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('xl/workbook.xml', WORKBOOK)
+        zf.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS)
+        zf.writestr('xl/worksheets/sheet1.xml', sheet)
+        zf.writestr('xl/sharedStrings.xml', shared)
+        if styles_xml is not None:
+            zf.writestr('xl/styles.xml', styles_xml)
+
+def test_blank_text_column_in_one_batch(tmp_path):
+    path = tmp_path / 'blank.xlsx'
+    rows = [['Host', 'Score']]
+    rows += [['web01', 1], ['web02', 2], ['web01', 3]]
+    rows += [[None, 4], [None, 5], [None, 6]]
+    rows += [['db01', 7]]
+    write_shared_strings_workbook(path, rows)
+
+    with WorkbookReader(str(path), batch_size=3) as reader:
+        table = reader.read_sheet('Sheet1')
+
+    assert pa.types.is_dictionary(table['Host'].type)
+    assert table['Host'].to_pylist() == ['web01', 'web02', 'web01', None, None, None, 'db01']
+    assert table['Score'].to_pylist() == [1, 2, 3, 4, 5, 6, 7]
+
+def test_no_empty_batch_after_full_last_batch(tmp_path):
+    path = tmp_path / 'exact.xlsx'
+    rows = [['Host', 'Score']] + [[f'host{i}', i] for i in range(6)]
+    write_shared_strings_workbook(path, rows)
+
+    with WorkbookReader(str(path), batch_size=3) as reader:
+        batches = list(reader.iter_batches('Sheet1'))
+        table = reader.read_sheet('Sheet1')
+
+    assert [b.num_rows for b in batches] == [3, 3]
+    assert table.num_rows == 6
+    assert pa.types.is_dictionary(table['Host'].type)
+
+def test_header_only_sheet_keeps_column_names(tmp_path):
+    path = tmp_path / 'header.xlsx'
+    write_shared_strings_workbook(path, [['Host', 'Score']])
+
+    with WorkbookReader(str(path), batch_size=3) as reader:
+        batches = list(reader.iter_batches('Sheet1'))
+
+    assert len(batches) == 1
+    assert batches[0].num_rows == 0
+    assert batches[0].schema.names == ['Host', 'Score']
+
+def test_rebase_sheet_ranges_follows_a_growing_sheet():
+    xml = b'<autoFilter ref="A1:C5"/><conditionalFormatting sqref="B2:B5">'
+    rebased = rebase_sheet_ranges(xml, 2, 5, 8)
+    assert rebased == b'<autoFilter ref="A1:C8"/><conditionalFormatting sqref="B2:B8">'
+
+def test_rebase_sheet_ranges_follows_a_shrinking_sheet():
+    xml = b'<autoFilter ref="A1:C5"/><conditionalFormatting sqref="B2:B5">'
+    rebased = rebase_sheet_ranges(xml, 2, 5, 4)
+    assert rebased == b'<autoFilter ref="A1:C4"/><conditionalFormatting sqref="B2:B4">'
+
+def test_rebase_sheet_ranges_keeps_ranges_beyond_the_data():
+    xml = b'<autoFilter ref="A1:C100"/>'
+    assert rebase_sheet_ranges(xml, 2, 5, 4) == xml
+    assert rebase_sheet_ranges(xml, 2, 5, 120) == b'<autoFilter ref="A1:C120"/>'
+
+def styles_xml(*num_fmt_ids):
+    xfs = ''.join(f'<xf numFmtId="{i}" fontId="0" fillId="0" borderId="0" xfId="0"/>' for i in num_fmt_ids)
+    return (
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        f'<cellXfs count="{len(num_fmt_ids)}">{xfs}</cellXfs></styleSheet>'
+    )
+
+def appended_cells(path):
+    """
+    Returns the patched styles.xml's cell formats and the first two cells of
+    the last row of the sheet as (style, value) pairs.
+    """
+    with zipfile.ZipFile(path) as zf:
+        cell_xfs = ET.fromstring(zf.read('xl/styles.xml')).find(f'{NS_MAIN}cellXfs')
+        last_row = re.findall(rb'<row\b.*?</row>', zf.read('xl/worksheets/sheet1.xml'))[-1]
+    formats = [int(xf.get('numFmtId')) for xf in cell_xfs]
+    assert int(cell_xfs.get('count')) == len(formats)
+    cells = re.findall(rb'<c(?: s="(\d+)")?><v>([^<]*)</v></c>', last_row)
+    return formats, [(int(style) if style else None, value.decode()) for style, value in cells]
+
+def test_patch_adds_date_styles_to_a_foreign_styles_xml(tmp_path):
+    path = tmp_path / 'foreign.xlsx'
+    write_shared_strings_workbook(path, [['Date', 'Seen'], [45295, 45295.5]], styles_xml=styles_xml(0))
+    new_rows = pa.table({
+        'Date': pa.array([datetime.date(2024, 1, 6)]),
+        'Seen': pa.array([datetime.datetime(2024, 1, 6, 12)], type=pa.timestamp('us')),
+    })
+
+    patch_workbook(str(path), ['Sheet1'], appends={'Sheet1': new_rows}, drop_oldest=False)
+
+    formats, cells = appended_cells(path)
+    assert formats == [0, 14, 22]
+    assert cells == [(1, '45297'), (2, '45297.5')]
+
+def test_patch_reuses_the_workbook_date_style(tmp_path):
+    path = tmp_path / 'dated.xlsx'
+    write_shared_strings_workbook(path, [['Date'], [45295]], styles_xml=styles_xml(0, 164, 14), row_style=2)
+
+    patch_workbook(str(path), ['Sheet1'], appends={'Sheet1': pa.table({'Date': [datetime.date(2024, 1, 6)]})},
+                   drop_oldest=False)
+
+    formats, cells = appended_cells(path)
+    assert formats == [0, 164, 14, 22]
+    assert cells == [(2, '45297')]
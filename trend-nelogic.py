@@ -17,6 +17,7 @@ import gc  # For garbage collection
 required_packages = [
     'pandas',
     'openpyxl',
+    'pyarrow',  # Streaming xlsx writer
     'tqdm'
 ]
 
@@ -35,6 +36,12 @@ install_packages(required_packages)
 # Now import the installed packages
 import pandas as pd
 import openpyxl
+from xlsx_stream import StreamingWorkbookWriter, WorkbookReader
+from trend_rowindex import RowHashIndex, row_index_dir, commit_row_indexes
+from qds_schema import read_export
+from trend_dates import normalise_date_series
+from trend_journal import StageJournal
+from trend_ingest import IngestManifest, workbook_digest
 
 # Setup logging at the very beginning to capture all events
 logging.basicConfig(
@@ -92,37 +99,76 @@ def handle_duplicate_columns(df):
         return df
 
 # ==========================
-# 4. Process Excel Sheets
+# 4. Stage Journal
 # ==========================
 
-def find_and_delete_oldest_date_rows(excel_path):
+def journal_outputs(df, row_index=None):
+    """
+    Returns the outputs recorded for a completed stage: the sheet's rows and,
+    if there is one, its row-hash index at that point.
+    """
+    outputs = {'rows': df}
+    if row_index is not None:
+        outputs['index'] = row_index.to_table()
+    return outputs
+
+def resume_sheet(journal, sheet, stage, processed_sheets, row_indexes=None):
+    """
+    Loads a sheet and its row-hash index from the output of a completed stage.
+    """
+    processed_sheets[sheet] = journal.load(sheet, stage).to_pandas()
+    if row_indexes is not None and 'index' in journal.state['stages'][sheet][stage]['outputs']:
+        row_indexes[sheet] = RowHashIndex.from_table(journal.load(sheet, stage, 'index'))
+    print(f"Sheet '{sheet}': '{stage}' already completed by the interrupted run. Reusing its result.")
+    logging.info(f"Sheet '{sheet}': '{stage}' already completed by the interrupted run ({journal.info(sheet, stage)}). Reusing its result.")
+
+# ==========================
+# 5. Process Excel Sheets
+# ==========================
+
+def find_and_delete_oldest_date_rows(excel_path, row_indexes=None, journal=None):
     """
     Processes each sheet in the Excel file by deleting rows with the oldest date in the first column.
     Also removes duplicate rows.
     Handles duplicate column headers by renaming them to ensure uniqueness.
     Prints and logs the details of deletions.
     Returns a dictionary of processed DataFrames.
+    If ``row_indexes`` is a dict it is filled with each sheet's row-hash index.
+    A sheet whose index matches the workbook was deduplicated by the previous
+    run and is not rehashed; otherwise it is deduplicated in full and indexed.
+    With a ``journal``, each processed sheet is recorded as its 'rollover'
+    stage, and sheets already recorded by an interrupted run are loaded from
+    the journal instead of being read and rolled over again.
     """
     try:
-        # Load the Excel file
-        xl = pd.ExcelFile(excel_path, engine='openpyxl')
-        sheet_names = xl.sheet_names
+        with WorkbookReader(excel_path) as reader:
+            sheet_names = reader.sheet_names
         logging.info(f"Found sheets: {sheet_names}")
         print(f"Found sheets: {sheet_names}")
 
         processed_sheets = {}
+        # The workbook is only loaded if a sheet still has to be read
+        xl = None
 
         for sheet in tqdm(sheet_names, desc="Processing Excel Sheets"):
+            if journal is not None and journal.done(sheet, 'rollover'):
+                resume_sheet(journal, sheet, 'rollover', processed_sheets, row_indexes)
+                continue
+
             print(f"\nProcessing sheet: {sheet}")
             logging.info(f"Processing sheet: {sheet}")
 
             # Read the sheet into a DataFrame
+            if xl is None:
+                xl = pd.ExcelFile(excel_path, engine='openpyxl')
             df = xl.parse(sheet_name=sheet)
 
             if df.empty:
                 print(f"Sheet '{sheet}' is empty. Skipping.")
                 logging.warning(f"Sheet '{sheet}' is empty. Skipping.")
                 processed_sheets[sheet] = df
+                if journal is not None:
+                    journal.record(sheet, 'rollover', journal_outputs(df))
                 continue
 
             # Handle duplicate column headers by renaming them
@@ -134,10 +180,16 @@ def find_and_delete_oldest_date_rows(excel_path):
             logging.info(f"Identified date column: '{date_column}'")
 
             # Convert the first column to datetime
-            df[date_column] = pd.to_datetime(df[date_column], errors='coerce')
+            df[date_column] = normalise_date_series(df[date_column])
+
+            # The index has to match the sheet as it was read, before any rows change
+            row_index = None
+            if row_indexes is not None:
+                row_index = RowHashIndex.load(row_index_dir(excel_path), sheet, excel_path, rows=df.shape[0])
 
             # Find the oldest date
             oldest_date = df[date_column].min()
+            num_rows_deleted = 0
             if pd.isnull(oldest_date):
                 print(f"No valid dates found in sheet '{sheet}'. Skipping deletion.")
                 logging.warning(f"No valid dates found in sheet '{sheet}'. Skipping deletion.")
@@ -154,7 +206,15 @@ def find_and_delete_oldest_date_rows(excel_path):
 
             # Remove duplicate rows
             initial_row_count = df.shape[0]
-            df.drop_duplicates(inplace=True)
+            if row_index is not None:
+                # Already deduplicated last run; only forget the deleted day
+                row_index.drop_before(df[date_column].min())
+            elif row_indexes is not None:
+                df, row_index = RowHashIndex.build(df, date_column)
+            else:
+                df.drop_duplicates(inplace=True)
+            if row_index is not None:
+                row_indexes[sheet] = row_index
             final_row_count = df.shape[0]
             duplicates_removed = initial_row_count - final_row_count
 
@@ -164,6 +224,9 @@ def find_and_delete_oldest_date_rows(excel_path):
 
             # Assign the processed DataFrame to the dictionary
             processed_sheets[sheet] = df
+            if journal is not None:
+                journal.record(sheet, 'rollover', journal_outputs(df, row_index),
+                               oldest_date=oldest_date, rows_deleted=num_rows_deleted)
 
             # Log the current state
             logging.info(f"Sheet '{sheet}' now has {df.shape[0]} rows and {df.shape[1]} columns.")
@@ -180,14 +243,17 @@ def find_and_delete_oldest_date_rows(excel_path):
         sys.exit(1)
 
 # ==========================
-# 5. Process CSV Files
+# 6. Process CSV Files
 # ==========================
 
-def append_csv_to_excel_sheet(processed_sheets, csv_path, excel_path):
+def append_csv_to_excel_sheet(processed_sheets, csv_path, excel_path, row_indexes=None, ingest=None):
     """
     Appends data from a CSV file to the corresponding Excel sheet.
     Handles missing values, inconsistent data types, and special characters.
     Provides console feedback and logs the operations.
+    With the sheet's row-hash index in ``row_indexes``, CSV rows the sheet
+    already holds are dropped too, hashing only the CSV rows.
+    With an IngestManifest in ``ingest``, the parsed export is archived as Parquet.
     """
     try:
         csv_filename = os.path.basename(csv_path)
@@ -206,8 +272,9 @@ def append_csv_to_excel_sheet(processed_sheets, csv_path, excel_path):
         print(f"\nAppending CSV '{csv_filename}' to sheet '{sheet_name}'")
         logging.info(f"Appending CSV '{csv_filename}' to sheet '{sheet_name}'")
 
-        # Read the CSV file
-        df_csv = pd.read_csv(csv_path, encoding='utf-8')
+        # Read the raw or trimmed export with the declared QDS column types (see qds_schema.py)
+        table = read_export(csv_path)
+        df_csv = table.to_pandas(date_as_object=False)
 
         if df_csv.empty:
             print(f"CSV file '{csv_filename}' is empty. Skipping.")
@@ -222,30 +289,21 @@ def append_csv_to_excel_sheet(processed_sheets, csv_path, excel_path):
         print(f"Identified date column in CSV: '{date_column}'")
         logging.info(f"Identified date column in CSV: '{date_column}'")
 
-        # Convert the date column to datetime
-        df_csv[date_column] = pd.to_datetime(df_csv[date_column], errors='coerce')
-
         # Handle missing values
         # For numerical columns, fill missing values with the mean
         # For categorical/text columns, fill missing values with 'Unknown'
         for col in df_csv.columns:
             if pd.api.types.is_numeric_dtype(df_csv[col]):
                 mean_val = df_csv[col].mean()
-                df_csv[col].fillna(mean_val, inplace=True)
+                df_csv[col] = df_csv[col].fillna(mean_val)
             elif pd.api.types.is_datetime64_any_dtype(df_csv[col]):
-                df_csv[col].fillna(pd.Timestamp('1970-01-01'), inplace=True)
+                df_csv[col] = df_csv[col].fillna(pd.Timestamp('1970-01-01'))
+            elif isinstance(df_csv[col].dtype, pd.CategoricalDtype):
+                if 'Unknown' not in df_csv[col].cat.categories:
+                    df_csv[col] = df_csv[col].cat.add_categories(['Unknown'])
+                df_csv[col] = df_csv[col].fillna('Unknown')
             else:
-                df_csv[col].fillna('Unknown', inplace=True)
-
-        # Remove duplicate rows
-        initial_row_count = df_csv.shape[0]
-        df_csv.drop_duplicates(inplace=True)
-        final_row_count = df_csv.shape[0]
-        duplicates_removed = initial_row_count - final_row_count
-
-        if duplicates_removed > 0:
-            print(f"Removed {duplicates_removed} duplicate rows from CSV '{csv_filename}'.")
-            logging.info(f"Removed {duplicates_removed} duplicate rows from CSV '{csv_filename}'.")
+                df_csv[col] = df_csv[col].fillna('Unknown')
 
         # Align CSV columns with Excel sheet columns
         excel_columns = processed_sheets[sheet_name].columns.tolist()
@@ -260,14 +318,32 @@ def append_csv_to_excel_sheet(processed_sheets, csv_path, excel_path):
                 print(f"Column '{col}' missing in CSV '{csv_filename}'. Filled with 'Unknown'.")
         df_csv = df_csv[excel_columns]  # Reorder columns to match Excel sheet
 
+        # Remove duplicate rows
+        initial_row_count = df_csv.shape[0]
+        row_index = (row_indexes or {}).get(sheet_name)
+        if row_index is not None:
+            df_csv = row_index.drop_known(df_csv, excel_columns[0])
+        else:
+            df_csv.drop_duplicates(inplace=True)
+        final_row_count = df_csv.shape[0]
+        duplicates_removed = initial_row_count - final_row_count
+
+        if duplicates_removed > 0:
+            print(f"Removed {duplicates_removed} duplicate rows from CSV '{csv_filename}'.")
+            logging.info(f"Removed {duplicates_removed} duplicate rows from CSV '{csv_filename}'.")
+
         # Append the CSV data to the corresponding Excel sheet DataFrame
         processed_sheets[sheet_name] = pd.concat([processed_sheets[sheet_name], df_csv], ignore_index=True)
 
+        # Archive the export as parsed; it counts as ingested once the workbook is saved
+        if ingest is not None:
+            ingest.archive(csv_path, table, sheet_name)
+
         print(f"Appended {df_csv.shape[0]} rows from CSV '{csv_filename}' to sheet '{sheet_name}'.")
         logging.info(f"Appended {df_csv.shape[0]} rows from CSV '{csv_filename}' to sheet '{sheet_name}'.")
 
         # Clear memory
-        del df_csv
+        del df_csv, table
         gc.collect()
 
     except Exception as e:
@@ -275,13 +351,16 @@ def append_csv_to_excel_sheet(processed_sheets, csv_path, excel_path):
         print(f"Error appending CSV '{csv_path}' to Excel sheet: {e}")
 
 # ==========================
-# 6. Save the Updated Excel File
+# 7. Save the Updated Excel File
 # ==========================
 
-def save_to_new_excel(processed_sheets, original_excel_path):
+def save_to_new_excel(processed_sheets, original_excel_path, streaming=True):
     """
     Saves the processed DataFrames to a new Excel file with a timestamp.
     Creates a backup of the original Excel file.
+    With streaming=True rows are serialised straight into the sheet XML in
+    bounded batches instead of building an openpyxl cell for every value.
+    Returns the path of the new Excel file.
     """
     try:
         # Create backup of the original Excel file
@@ -295,14 +374,22 @@ def save_to_new_excel(processed_sheets, original_excel_path):
         new_excel_path = f"{os.path.splitext(original_excel_path)[0]}_Final_{timestamp}.xlsx"
 
         # Write all processed sheets to the new Excel file
-        with pd.ExcelWriter(new_excel_path, engine='openpyxl') as writer:
-            for sheet_name, df in processed_sheets.items():
-                df.to_excel(writer, sheet_name=sheet_name, index=False)
-                print(f"Saved sheet '{sheet_name}' with {df.shape[0]} rows.")
-                logging.info(f"Saved sheet '{sheet_name}' with {df.shape[0]} rows.")
+        if streaming:
+            with StreamingWorkbookWriter(new_excel_path) as writer:
+                for sheet_name, df in processed_sheets.items():
+                    writer.write_sheet(sheet_name, df)
+                    print(f"Saved sheet '{sheet_name}' with {df.shape[0]} rows.")
+                    logging.info(f"Saved sheet '{sheet_name}' with {df.shape[0]} rows.")
+        else:
+            with pd.ExcelWriter(new_excel_path, engine='openpyxl') as writer:
+                for sheet_name, df in processed_sheets.items():
+                    df.to_excel(writer, sheet_name=sheet_name, index=False)
+                    print(f"Saved sheet '{sheet_name}' with {df.shape[0]} rows.")
+                    logging.info(f"Saved sheet '{sheet_name}' with {df.shape[0]} rows.")
 
         print(f"\nFinal Excel file saved at '{new_excel_path}'")
         logging.info(f"Final Excel file saved at '{new_excel_path}'")
+        return new_excel_path
 
     except Exception as e:
         logging.error(f"Error saving the new Excel file: {e}")
@@ -310,7 +397,7 @@ def save_to_new_excel(processed_sheets, original_excel_path):
         sys.exit(1)
 
 # ==========================
-# 7. Main Execution Flow
+# 8. Main Execution Flow
 # ==========================
 
 def main():
@@ -330,30 +417,64 @@ def main():
             logging.error(f"Excel file '{excel_filename}' not found in the current directory.")
             sys.exit(1)
 
+        # Find all CSV files in the current directory
+        csv_pattern = os.path.join(cwd, "*.csv")
+        csv_files = glob.glob(csv_pattern)
+
+        # Exports already in this workbook are recognised by their content hash
+        # and skipped without being parsed (see trend_ingest.py)
+        ingest = IngestManifest()
+        source_digest = workbook_digest(excel_path)
+        csv_files, skipped = ingest.split(csv_files, source_digest)
+        for csv_file, entry in skipped:
+            print(f"Skipping '{os.path.basename(csv_file)}': already ingested on {entry['ingested']} ({entry['rows']} rows).")
+            logging.info(f"Skipping '{csv_file}': already ingested on {entry['ingested']} as '{entry['file']}' ({entry['rows']} rows dated {entry['dates']}).")
+
+        # Completed stages of an interrupted run over the same workbook are reused
+        journal = StageJournal(excel_path, inputs=csv_files)
+
         # Step 1: Process Excel sheets by deleting oldest date rows and removing duplicates
         print("\n--- Step 1: Processing Excel Sheets ---")
         logging.info("Starting Step 1: Processing Excel Sheets")
-        processed_sheets = find_and_delete_oldest_date_rows(excel_path)
+        row_indexes = {}
+        processed_sheets = find_and_delete_oldest_date_rows(excel_path, row_indexes, journal)
 
         # Step 2: Process each CSV file and append data to the corresponding Excel sheet
         print("\n--- Step 2: Processing CSV Files ---")
         logging.info("Starting Step 2: Processing CSV Files")
 
-        # Find all CSV files in the current directory
-        csv_pattern = os.path.join(cwd, "*.csv")
-        csv_files = glob.glob(csv_pattern)
-
         if not csv_files:
-            print("No CSV files found in the current directory.")
-            logging.warning("No CSV files found in the current directory.")
+            print("No new CSV files found in the current directory.")
+            logging.warning("No new CSV files found in the current directory.")
         else:
-            for csv_file in tqdm(csv_files, desc="Appending CSV Files"):
-                append_csv_to_excel_sheet(processed_sheets, csv_file, excel_path)
+            # Each sheet's CSVs are appended as one 'append' stage
+            sheet_csvs = {}
+            for csv_file in sorted(csv_files):
+                sheet_csvs.setdefault(map_csv_to_sheet(os.path.basename(csv_file)), []).append(csv_file)
+            for sheet_name, sheet_csv_files in tqdm(sheet_csvs.items(), desc="Appending CSV Files"):
+                if sheet_name in processed_sheets and journal.done(sheet_name, 'append'):
+                    resume_sheet(journal, sheet_name, 'append', processed_sheets, row_indexes)
+                    continue
+                for csv_file in sheet_csv_files:
+                    append_csv_to_excel_sheet(processed_sheets, csv_file, excel_path, row_indexes, ingest)
+                if sheet_name in processed_sheets:
+                    journal.record(sheet_name, 'append',
+                                   journal_outputs(processed_sheets[sheet_name], row_indexes.get(sheet_name)),
+                                   uses_inputs=True, csv_files=[os.path.basename(f) for f in sheet_csv_files])
 
         # Step 3: Save the processed data to a new Excel file
         print("\n--- Step 3: Saving the Updated Excel File ---")
         logging.info("Starting Step 3: Saving the Updated Excel File")
-        save_to_new_excel(processed_sheets, excel_path)
+        index_dir = row_index_dir(excel_path)
+        for sheet_name, row_index in row_indexes.items():
+            row_index.save(index_dir, sheet_name)
+        new_excel_path = save_to_new_excel(processed_sheets, excel_path)
+
+        # The staged row-hash indexes now describe the saved workbook
+        commit_row_indexes(index_dir, new_excel_path, {s: df.shape[0] for s, df in processed_sheets.items()})
+        journal.complete(new_excel_path)
+        ingest.commit(csv_files, source_digest, workbook_digest(new_excel_path),
+                      workbook=os.path.basename(new_excel_path))
 
         # Final message
         print("\nData processing completed successfully.")
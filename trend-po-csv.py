@@ -6,6 +6,10 @@ import glob
 import logging
 from datetime import datetime
 import shutil
+import tempfile
+import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 import gc  # For garbage collection
 
@@ -17,7 +21,7 @@ import gc  # For garbage collection
 required_packages = [
     'pandas',
     'tqdm',
-    'openpyxl'
+    'pyarrow'  # Streaming xlsx writer
 ]
 
 # Function to install missing packages
@@ -34,18 +38,41 @@ install_packages(required_packages)
 
 # Now import the installed packages
 import pandas as pd
-import openpyxl
+import pyarrow as pa
+import pyarrow.compute as pc
+from xlsx_stream import StreamingWorkbookWriter, WorkbookReader, write_ipc, read_ipc, DEFAULT_BATCH_SIZE
+from trend_rowindex import RowHashIndex, row_index_dir, commit_row_indexes
+from trend_rollover import date_histogram, plan_rollover, describe_plan, apply_plan, EXCEL_ROW_LIMIT
+from qds_schema import read_export
+from trend_dates import normalise_date_series
+from trend_telemetry import RunTelemetry, stage, collect_stages, add_stages, active_profile, current_rss, PROFILERS
 
-# Setup logging to capture detailed information
-logging.basicConfig(
-    filename='data_processing_pandas.log',
-    filemode='w',  # Overwrite log file each run
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Number of sheets processed in parallel worker processes (1 = one after another)
+PARALLEL_WORKERS = 4
 
-logging.info("Pandas-Based Data Processing Script Started.")
-print("Pandas-Based Data Processing Script Started.")
+# --memory-budget mode: rough in-memory cost of one sheet cell as a pandas
+# chunk, including the Arrow copy it is read from, the decoded strings held
+# while the chunk's dictionaries are compacted for spilling (about 30 bytes a
+# cell) and the filtered copy
+BYTES_PER_CELL = 130
+# Share of the budget left after start-up that one chunk may use; the rest
+# covers the output serialisation, the row index and allocator slack
+CHUNK_SHARE = 0.25
+MIN_CHUNK_ROWS = 1000
+
+# Setup logging to capture detailed information.
+# Worker processes started with 'spawn' re-import this script as '__mp_main__';
+# they must not truncate the log the parent is writing to.
+if __name__ == "__main__":
+    logging.basicConfig(
+        filename='data_processing_pandas.log',
+        filemode='w',  # Overwrite log file each run
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    logging.info("Pandas-Based Data Processing Script Started.")
+    print("Pandas-Based Data Processing Script Started.")
 
 # ==========================
 # 2. Define Helper Functions
@@ -65,7 +92,7 @@ def delete_oldest_date_rows(df, date_column):
     """
     # Convert date column to datetime if not already
     if not pd.api.types.is_datetime64_any_dtype(df[date_column]):
-        df[date_column] = pd.to_datetime(df[date_column], format='%m/%d/%Y', errors='coerce')
+        df[date_column] = normalise_date_series(df[date_column])
     
     # Find the oldest date
     oldest_date = df[date_column].min()
@@ -90,45 +117,42 @@ def append_new_data(existing_df, new_df, date_column, excel_row_limit=1048576):
     """
     Appends new data to the existing DataFrame. If appending exceeds the Excel row limit,
     deletes the oldest date rows until there is enough space.
+    The rows per date are counted once and the exact cutoff date is planned
+    up front, so the sheet is filtered a single time whatever the overflow.
     
     Parameters:
         existing_df (pd.DataFrame): The existing DataFrame.
         new_df (pd.DataFrame): The new DataFrame to append.
         date_column (str): The name of the date column.
-        excel_row_limit (int): Maximum number of rows allowed in Excel.
+        excel_row_limit (int): Maximum number of rows allowed in Excel, including the header row.
         
     Returns:
         updated_df (pd.DataFrame): The updated DataFrame after appending.
     """
     # Ensure date columns are datetime
     if not pd.api.types.is_datetime64_any_dtype(existing_df[date_column]):
-        existing_df[date_column] = pd.to_datetime(existing_df[date_column], format='%m/%d/%Y', errors='coerce')
+        existing_df[date_column] = normalise_date_series(existing_df[date_column])
     if not pd.api.types.is_datetime64_any_dtype(new_df[date_column]):
-        new_df[date_column] = pd.to_datetime(new_df[date_column], format='%m/%d/%Y', errors='coerce')
-    
-    # Calculate total rows after appending
-    total_rows = len(existing_df) + len(new_df)
-    
-    # Delete oldest date rows until within limit
-    while total_rows > excel_row_limit:
-        # Find the oldest date
-        oldest_date = existing_df[date_column].min()
-        if pd.isna(oldest_date):
-            print("No valid dates to delete. Cannot append more data.")
-            logging.error("No valid dates to delete. Cannot append more data.")
-            break
-        
-        # Delete rows with the oldest date
-        initial_row_count = len(existing_df)
-        existing_df = existing_df[existing_df[date_column] != oldest_date]
-        final_row_count = len(existing_df)
-        rows_deleted = initial_row_count - final_row_count
-        
-        print(f"Deleted {rows_deleted} rows with the oldest date '{oldest_date.strftime('%m/%d/%Y')}' to make space.")
-        logging.info(f"Deleted {rows_deleted} rows with the oldest date '{oldest_date.strftime('%m/%d/%Y')}' to make space.")
-        
-        # Update total rows
-        total_rows = len(existing_df) + len(new_df)
+        new_df[date_column] = normalise_date_series(new_df[date_column])
+    
+    # Plan the rollover from one per-date histogram and report it before changing anything
+    plan = plan_rollover(
+        date_histogram(existing_df[date_column]),
+        len(existing_df),
+        len(new_df),
+        row_limit=excel_row_limit - 1,
+    )
+    print(describe_plan(plan))
+    logging.info(describe_plan(plan))
+    if not plan['fits']:
+        print("No valid dates to delete. Cannot append more data.")
+        logging.error("No valid dates to delete. Cannot append more data.")
+    
+    # Delete the planned oldest days with a single filter
+    if plan['days_dropped']:
+        existing_df = apply_plan(existing_df, date_column, plan)
+        print(f"Deleted {plan['rows_dropped']} rows with {len(plan['days_dropped'])} oldest dates to make space.")
+        logging.info(f"Deleted {plan['rows_dropped']} rows with {len(plan['days_dropped'])} oldest dates to make space.")
     
     # Append the new data
     updated_df = pd.concat([existing_df, new_df], ignore_index=True)
@@ -137,11 +161,185 @@ def append_new_data(existing_df, new_df, date_column, excel_row_limit=1048576):
     
     return updated_df
 
+def read_new_data(new_data_dir, sheet, columns):
+    """
+    Reads the new data CSV of a sheet and aligns it to the sheet's columns.
+    
+    Parameters:
+        new_data_dir (str): Directory containing new CSV files to append.
+        sheet (str): The sheet name.
+        columns (list): The sheet's columns; the first one is the date column.
+        
+    Returns:
+        new_df (pd.DataFrame): The new rows, or None if there are none.
+    """
+    new_csv_path = os.path.join(new_data_dir, f"{sheet}.csv")
+    if not os.path.exists(new_csv_path):
+        print(f"No new data CSV found for sheet '{sheet}'. No data appended.")
+        logging.warning(f"No new data CSV found for sheet '{sheet}'. No data appended.")
+        return None
+    
+    # Raw or trimmed export; declared QDS column types are applied while parsing (see qds_schema.py)
+    new_df = read_export(new_csv_path).to_pandas(date_as_object=False)
+    if new_df.empty:
+        print(f"New data CSV for sheet '{sheet}' is empty. No data appended.")
+        logging.warning(f"New data CSV for sheet '{sheet}' is empty. No data appended.")
+        return None
+    
+    # Ensure column alignment
+    missing_cols = set(columns) - set(new_df.columns)
+    for col in missing_cols:
+        new_df[col] = "Unknown"
+    
+    # Reorder new_df columns to match the sheet
+    new_df = new_df[list(columns)]
+    
+    date_column = columns[0]
+    if not pd.api.types.is_datetime64_any_dtype(new_df[date_column]):
+        new_df[date_column] = normalise_date_series(new_df[date_column])
+    return new_df
+
 # ==========================
 # 3. Main Processing Functions
 # ==========================
 
-def process_excel_file(excel_path, new_data_dir, final_excel_path):
+def process_sheet(df, sheet, new_data_dir, excel_path):
+    """
+    Deletes the oldest date rows of one sheet, appends its new data CSV and
+    removes duplicate rows.
+    Duplicates are found with the sheet's persistent row-hash index, so only
+    the new CSV rows are hashed; the whole sheet is deduplicated only when the
+    index is missing or belongs to another workbook. The updated index is
+    staged next to the report and committed once the workbook is saved.
+    
+    Parameters:
+        df (pd.DataFrame): The sheet's current data.
+        sheet (str): The sheet name.
+        new_data_dir (str): Directory containing new CSV files to append.
+        excel_path (str): Path to the original Excel file.
+        
+    Returns:
+        df (pd.DataFrame): The processed sheet.
+    """
+    if df.empty:
+        print(f"Sheet '{sheet}' is empty. Skipping.")
+        logging.warning(f"Sheet '{sheet}' is empty. Skipping.")
+        return df
+    
+    # Assume the first column is the date column
+    date_column = df.columns[0]
+    
+    # The index has to match the sheet as it was read, before any rows change
+    index_dir = row_index_dir(excel_path)
+    row_index = RowHashIndex.load(index_dir, sheet, excel_path, rows=len(df))
+    
+    # Delete oldest date rows
+    with stage('rollover', sheet=sheet, rows_in=len(df)) as st:
+        df, deleted_date = delete_oldest_date_rows(df, date_column)
+        st.rows_out = len(df)
+    
+    duplicates_removed = 0
+    if row_index is None:
+        # No usable index yet: deduplicate the whole sheet once and index it
+        initial_row_count = len(df)
+        with stage('dedupe', sheet=sheet, rows_in=initial_row_count) as st:
+            df, row_index = RowHashIndex.build(df, date_column)
+            st.rows_out = len(df)
+        duplicates_removed += initial_row_count - len(df)
+    
+    # Append new data if available
+    with stage('read CSVs', sheet=sheet) as st:
+        new_df = read_new_data(new_data_dir, sheet, df.columns)
+        st.rows_out = 0 if new_df is None else len(new_df)
+    if new_df is not None:
+        # Only the new rows are checked against the index
+        initial_row_count = len(new_df)
+        with stage('dedupe', sheet=sheet, rows_in=initial_row_count) as st:
+            new_df = row_index.drop_known(new_df, date_column)
+            st.rows_out = len(new_df)
+        duplicates_removed += initial_row_count - len(new_df)
+
+        # Append new data, ensuring Excel row limit
+        with stage('append', sheet=sheet, rows_in=len(df) + len(new_df)) as st:
+            df = append_new_data(df, new_df, date_column)
+            st.rows_out = len(df)
+    
+    if duplicates_removed > 0:
+        print(f"Removed {duplicates_removed} duplicate rows from sheet '{sheet}'.")
+        logging.info(f"Removed {duplicates_removed} duplicate rows from sheet '{sheet}'.")
+    
+    # Forget the hashes of every day deleted above, including days dropped to stay under the row limit
+    row_index.drop_before(df[date_column].min())
+    row_index.save(index_dir, sheet)
+    
+    return df
+
+def process_sheet_worker(excel_path, sheet, new_data_dir, ipc_path, profile=None):
+    """
+    Process-pool entry point: reads, processes and saves one sheet in its own
+    process. The result is written to an Arrow IPC file instead of being
+    pickled back to the parent.
+    
+    Returns:
+        rows (int): Number of rows written to ``ipc_path``.
+        telemetry (dict): The worker's stage timings, for add_stages().
+    """
+    logging.basicConfig(
+        filename='data_processing_pandas.log',
+        filemode='a',  # Workers started with 'spawn' append to the parent's log
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    with collect_stages(profile) as telemetry:
+        with stage('read workbook', sheet=sheet) as st:
+            with WorkbookReader(excel_path) as reader:
+                df = reader.read_sheet(sheet).to_pandas()
+            st.rows_out = len(df)
+        df = process_sheet(df, sheet, new_data_dir, excel_path)
+        rows = write_ipc(df, ipc_path)
+    return rows, telemetry.result()
+
+def process_sheets_parallel(excel_path, sheet_names, new_data_dir, final_excel_path, max_workers):
+    """
+    Processes every sheet in its own worker process and streams the results,
+    memory-mapped from the workers' Arrow IPC files, into the final workbook.
+    
+    Parameters:
+        excel_path (str): Path to the original Excel file.
+        sheet_names (list): Sheets to process.
+        new_data_dir (str): Directory containing new CSV files to append.
+        final_excel_path (str): Path to save the final Excel file.
+        max_workers (int): Number of worker processes.
+        
+    Returns:
+        sheet_rows (dict): Number of rows saved per sheet.
+    """
+    with tempfile.TemporaryDirectory(prefix='trend_sheets_') as ipc_dir:
+        ipc_paths = {sheet: os.path.join(ipc_dir, f"{i}.arrow") for i, sheet in enumerate(sheet_names)}
+        profile = active_profile()
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(sheet_names))) as pool:
+            futures = {
+                pool.submit(process_sheet_worker, excel_path, sheet, new_data_dir, ipc_paths[sheet], profile): sheet
+                for sheet in sheet_names
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing Sheets"):
+                rows, telemetry = future.result()
+                add_stages(telemetry)
+        
+        # Sheets are written in workbook order; each table only maps its file
+        sheet_rows = {}
+        with StreamingWorkbookWriter(final_excel_path) as writer:
+            for sheet in sheet_names:
+                table = read_ipc(ipc_paths[sheet], memory_map=True)
+                with stage('write', sheet=sheet, rows_in=table.num_rows) as st:
+                    st.rows_out = writer.write_sheet(sheet, table)
+                logging.info(f"Saved sheet '{sheet}' with {table.num_rows} rows.")
+                print(f"Saved sheet '{sheet}' with {table.num_rows} rows.")
+                sheet_rows[sheet] = table.num_rows
+                del table
+    return sheet_rows
+
+def process_excel_file(excel_path, new_data_dir, final_excel_path, max_workers=PARALLEL_WORKERS, memory_budget=None):
     """
     Processes the Excel file by deleting oldest date rows and appending new data.
     
@@ -149,81 +347,50 @@ def process_excel_file(excel_path, new_data_dir, final_excel_path):
         excel_path (str): Path to the original Excel file.
         new_data_dir (str): Directory containing new CSV files to append.
         final_excel_path (str): Path to save the final Excel file.
+        max_workers (int): Sheets processed in parallel worker processes.
+        memory_budget (int): If set, bytes of memory the run should stay under;
+            sheets are then processed one at a time in chunks.
     """
     try:
-        # Read the Excel file
-        excel_file = pd.ExcelFile(excel_path, engine='openpyxl')
-        sheet_names = excel_file.sheet_names
+        # Open the Excel file once; shared strings are decoded once for all sheets
+        reader = WorkbookReader(excel_path)
+        sheet_names = reader.sheet_names
         logging.info(f"Found sheets: {sheet_names}")
         print(f"Found sheets: {sheet_names}")
         
         # Dictionary to hold processed DataFrames
         processed_dfs = {}
         
-        for sheet in tqdm(sheet_names, desc="Processing Sheets"):
-            # Read each sheet into a DataFrame
-            df = pd.read_excel(excel_path, sheet_name=sheet, engine='openpyxl')
-            
-            if df.empty:
-                print(f"Sheet '{sheet}' is empty. Skipping.")
-                logging.warning(f"Sheet '{sheet}' is empty. Skipping.")
-                processed_dfs[sheet] = df
-                continue
-            
-            # Assume the first column is the date column
-            date_column = df.columns[0]
-            
-            # Delete oldest date rows
-            df, deleted_date = delete_oldest_date_rows(df, date_column)
-            
-            # Append new data if available
-            new_csv_path = os.path.join(new_data_dir, f"{sheet}.csv")
-            if os.path.exists(new_csv_path):
-                new_df = pd.read_csv(new_csv_path, encoding='utf-8')
+        if memory_budget:
+            reader.close()
+            sheet_rows = process_sheets_chunked(excel_path, sheet_names, new_data_dir, final_excel_path, memory_budget)
+        elif max_workers <= 1 or len(sheet_names) <= 1:
+            for sheet in tqdm(sheet_names, desc="Processing Sheets"):
+                # Stream each sheet's XML once into Arrow, then hand it to pandas
+                with stage('read workbook', sheet=sheet) as st:
+                    df = reader.read_sheet(sheet).to_pandas()
+                    st.rows_out = len(df)
+                processed_dfs[sheet] = process_sheet(df, sheet, new_data_dir, excel_path)
                 
-                if new_df.empty:
-                    print(f"New data CSV for sheet '{sheet}' is empty. No data appended.")
-                    logging.warning(f"New data CSV for sheet '{sheet}' is empty. No data appended.")
-                else:
-                    # Ensure column alignment
-                    missing_cols = set(df.columns) - set(new_df.columns)
-                    for col in missing_cols:
-                        new_df[col] = "Unknown"
-                    
-                    # Reorder new_df columns to match df
-                    new_df = new_df[df.columns]
-                    
-                    # Handle data types if necessary
-                    # (Assuming data types are consistent; otherwise, add type conversion here)
-                    
-                    # Append new data, ensuring Excel row limit
-                    df = append_new_data(df, new_df, date_column)
-            else:
-                print(f"No new data CSV found for sheet '{sheet}'. No data appended.")
-                logging.warning(f"No new data CSV found for sheet '{sheet}'. No data appended.")
-            
-            # Remove duplicate rows
-            initial_row_count = len(df)
-            df.drop_duplicates(inplace=True)
-            final_row_count = len(df)
-            duplicates_removed = initial_row_count - final_row_count
-            if duplicates_removed > 0:
-                print(f"Removed {duplicates_removed} duplicate rows from sheet '{sheet}'.")
-                logging.info(f"Removed {duplicates_removed} duplicate rows from sheet '{sheet}'.")
+                # Clear memory
+                del df
+                gc.collect()
+            reader.close()
             
-            # Assign the processed DataFrame to the dictionary
-            processed_dfs[sheet] = df
-            
-            # Clear memory
-            del df
-            gc.collect()
+            # Write all processed DataFrames to a new Excel file, streaming rows in batches
+            with StreamingWorkbookWriter(final_excel_path) as writer:
+                for sheet, df in processed_dfs.items():
+                    with stage('write', sheet=sheet, rows_in=len(df)) as st:
+                        st.rows_out = writer.write_sheet(sheet, df)
+                    logging.info(f"Saved sheet '{sheet}' with {len(df)} rows.")
+                    print(f"Saved sheet '{sheet}' with {len(df)} rows.")
+            sheet_rows = {sheet: len(df) for sheet, df in processed_dfs.items()}
+        else:
+            reader.close()
+            sheet_rows = process_sheets_parallel(excel_path, sheet_names, new_data_dir, final_excel_path, max_workers)
         
-        # Write all processed DataFrames to a new Excel file
-        with pd.ExcelWriter(final_excel_path, engine='openpyxl') as writer:
-            for sheet, df in processed_dfs.items():
-                df.to_excel(writer, sheet_name=sheet, index=False)
-                logging.info(f"Saved sheet '{sheet}' with {len(df)} rows.")
-                print(f"Saved sheet '{sheet}' with {len(df)} rows.")
+        # The staged row-hash indexes now describe the saved workbook
+        commit_row_indexes(row_index_dir(excel_path), final_excel_path, sheet_rows)
         
         print(f"\nFinal Excel file saved at '{final_excel_path}'")
         logging.info(f"Final Excel file saved at '{final_excel_path}'")
@@ -233,11 +400,246 @@ def process_excel_file(excel_path, new_data_dir, final_excel_path):
         print(f"Error processing Excel file: {e}")
         sys.exit(1)
 
+# ==========================
+# 3b. Memory-Budgeted Mode
+# ==========================
+#
+# With --memory-budget each sheet is streamed in row chunks sized from the
+# budget: the first pass spills the chunks to Arrow IPC files and counts the
+# rows per date, the rollover is planned from those counts, and the second pass
+# filters the spilled chunks and streams them into the workbook. Only one chunk,
+# the new CSV rows and the row-hash index (16 bytes per row) are held at a time.
+
+def parse_size(text):
+    """
+    Parses a memory size such as '6G', '512M' or '1500000000' into bytes.
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', str(text), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid memory size '{text}'. Use e.g. 6G or 512M.")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMGT'.index(unit.upper() or ' '))
+
+def chunk_rows_for_budget(memory_budget, columns):
+    """
+    Returns the number of sheet rows processed per chunk for a memory budget.
+    """
+    usable = memory_budget - (current_rss() or 0)
+    if usable <= 0:
+        print(f"Memory budget is below this process's start-up memory. Using {MIN_CHUNK_ROWS}-row chunks.")
+        logging.warning(f"Memory budget is below this process's start-up memory. Using {MIN_CHUNK_ROWS}-row chunks.")
+        return MIN_CHUNK_ROWS
+    return max(MIN_CHUNK_ROWS, int(usable * CHUNK_SHARE / (max(columns, 1) * BYTES_PER_CELL)))
+
+def compact_batch(batch):
+    """
+    Decodes and re-encodes a chunk's dictionary columns, so its spilled file
+    holds only the strings the chunk uses instead of the workbook's whole
+    shared-strings table.
+    """
+    columns = [
+        pc.dictionary_encode(column.cast(column.type.value_type)) if pa.types.is_dictionary(column.type) else column
+        for column in batch.columns
+    ]
+    return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+def spill_sheet(reader, sheet, spill_dir):
+    """
+    First pass: streams a sheet into one Arrow IPC file per chunk and counts its rows per date.
+    
+    Returns:
+        files (list): Spilled chunk files, in sheet order.
+        columns (list): The sheet's columns.
+        day_counts (pd.Series): Rows per date, oldest date first.
+        rows (int): Number of rows in the sheet.
+    """
+    files = []
+    columns = None
+    day_counts = pd.Series(dtype='int64')
+    rows = 0
+    for i, batch in enumerate(reader.iter_batches(sheet)):
+        columns = columns or batch.schema.names
+        if batch.num_rows == 0:
+            continue
+        path = os.path.join(spill_dir, f"{i:06d}.arrow")
+        write_ipc(compact_batch(batch), path)
+        files.append(path)
+        dates = normalise_date_series(pd.Series(batch.column(0).to_pandas(), name=columns[0]))
+        day_counts = day_counts.add(date_histogram(dates), fill_value=0)
+        rows += batch.num_rows
+    return files, columns or [], day_counts.astype('int64').sort_index(), rows
+
+def iter_spilled(files, date_column):
+    """
+    Yields the spilled chunks as pandas DataFrames with the date column normalised.
+    """
+    for path in files:
+        df = read_ipc(path, memory_map=True).to_pandas()
+        df[date_column] = normalise_date_series(df[date_column])
+        yield df
+
+def dedupe_spilled(files, date_column, oldest_date, spill_dir):
+    """
+    Full-cost path when the sheet has no valid row index: deletes the oldest
+    date and deduplicates the spilled chunks against each other, building
+    the index chunk by chunk.
+    
+    Returns:
+        files (list): The deduplicated chunk files.
+        day_counts (pd.Series): Rows per date after deduplication.
+        rows (int): Rows left.
+        row_index (RowHashIndex): The index of the rows left.
+        duplicates_removed (int): Duplicate rows dropped.
+    """
+    row_index = RowHashIndex.empty()
+    deduped = []
+    day_counts = pd.Series(dtype='int64')
+    rows = duplicates_removed = 0
+    for i, df in enumerate(iter_spilled(files, date_column)):
+        if oldest_date is not None:
+            df = df[df[date_column] != oldest_date]
+        initial_row_count = len(df)
+        df = row_index.drop_known(df, date_column)
+        duplicates_removed += initial_row_count - len(df)
+        path = os.path.join(spill_dir, f"dedup-{i:06d}.arrow")
+        write_ipc(df, path)
+        os.remove(files[i])
+        deduped.append(path)
+        day_counts = day_counts.add(date_histogram(df[date_column]), fill_value=0)
+        rows += len(df)
+    return deduped, day_counts.astype('int64').sort_index(), rows, row_index, duplicates_removed
+
+def process_sheet_chunked(reader, sheet, new_data_dir, excel_path, writer, spill_dir):
+    """
+    Memory-budgeted counterpart of process_sheet(): the same rollover, row
+    limit and duplicate handling, streamed in chunks from the workbook into
+    ``writer``.
+    
+    Returns:
+        rows (int): Number of rows written for the sheet.
+    """
+    with stage('read workbook', sheet=sheet) as st:
+        files, columns, day_counts, rows = spill_sheet(reader, sheet, spill_dir)
+        st.rows_out = rows
+    if rows == 0:
+        print(f"Sheet '{sheet}' is empty. Skipping.")
+        logging.warning(f"Sheet '{sheet}' is empty. Skipping.")
+        return writer.write_sheet(sheet, [], columns=columns)
+    date_column = columns[0]
+    
+    # The index has to match the sheet as it was read, before any rows change
+    index_dir = row_index_dir(excel_path)
+    row_index = RowHashIndex.load(index_dir, sheet, excel_path, rows=rows)
+    
+    oldest_date = day_counts.index[0] if len(day_counts) else None
+    if oldest_date is None:
+        print(f"No valid dates found in column '{date_column}'. No rows deleted.")
+        logging.warning(f"No valid dates found in column '{date_column}'. No rows deleted.")
+    else:
+        print(f"Deleting {day_counts.iloc[0]} rows with the oldest date '{oldest_date.strftime('%m/%d/%Y')}'.")
+        logging.info(f"Deleting {day_counts.iloc[0]} rows with the oldest date '{oldest_date.strftime('%m/%d/%Y')}'.")
+    
+    duplicates_removed = 0
+    if row_index is None:
+        # No usable index yet: deduplicate the whole sheet once and index it
+        with stage('dedupe', sheet=sheet, rows_in=rows) as st:
+            files, day_counts, rows, row_index, duplicates_removed = dedupe_spilled(
+                files, date_column, oldest_date, spill_dir
+            )
+            st.rows_out = rows
+    elif oldest_date is not None:
+        rows -= int(day_counts.iloc[0])
+        day_counts = day_counts.iloc[1:]
+    
+    with stage('read CSVs', sheet=sheet) as st:
+        new_df = read_new_data(new_data_dir, sheet, columns)
+        st.rows_out = 0 if new_df is None else len(new_df)
+    if new_df is not None:
+        # Only the new rows are checked against the index
+        initial_row_count = len(new_df)
+        with stage('dedupe', sheet=sheet, rows_in=initial_row_count) as st:
+            new_df = row_index.drop_known(new_df, date_column)
+            st.rows_out = len(new_df)
+        duplicates_removed += initial_row_count - len(new_df)
+    new_rows = 0 if new_df is None else len(new_df)
+    
+    # Plan the row limit from the per-date counts; one cutoff covers the oldest date too
+    plan = plan_rollover(day_counts, rows, new_rows, row_limit=EXCEL_ROW_LIMIT - 1)
+    print(describe_plan(plan))
+    logging.info(describe_plan(plan))
+    if not plan['fits']:
+        print("No valid dates to delete. Cannot append more data.")
+        logging.error("No valid dates to delete. Cannot append more data.")
+    cutoff = plan['days_dropped'][-1] if plan['days_dropped'] else oldest_date
+    
+    def output_chunks():
+        for df in iter_spilled(files, date_column):
+            if cutoff is not None:
+                df = df[~(df[date_column] <= cutoff)]
+            yield df
+        if new_rows:
+            yield new_df
+    
+    # The rollover filter and the append run as the chunks are written
+    with stage('write', sheet=sheet, rows_in=rows + new_rows) as st:
+        rows_written = st.rows_out = writer.write_sheet(sheet, output_chunks(), columns=columns)
+    
+    if duplicates_removed > 0:
+        print(f"Removed {duplicates_removed} duplicate rows from sheet '{sheet}'.")
+        logging.info(f"Removed {duplicates_removed} duplicate rows from sheet '{sheet}'.")
+    
+    # Forget the hashes of every day deleted above
+    kept_days = day_counts.index if cutoff is None else day_counts.index[day_counts.index > cutoff]
+    kept_dates = list(kept_days[:1])
+    if new_rows:
+        kept_dates.append(new_df[date_column].min())
+    row_index.drop_before(min((d for d in kept_dates if pd.notna(d)), default=pd.NaT))
+    row_index.save(index_dir, sheet)
+    return rows_written
+
+def process_sheets_chunked(excel_path, sheet_names, new_data_dir, final_excel_path, memory_budget):
+    """
+    Processes the sheets one at a time in chunks sized from ``memory_budget``
+    and streams them into the final workbook.
+    
+    Returns:
+        sheet_rows (dict): Number of rows saved per sheet.
+    """
+    with WorkbookReader(excel_path) as probe:
+        columns = max((probe.estimate_shape(sheet)[1] for sheet in sheet_names), default=1)
+    chunk_rows = chunk_rows_for_budget(memory_budget, columns)
+    print(f"Memory budget {memory_budget / 1024 ** 3:.1f} GiB: processing sheets in chunks of {chunk_rows} rows.")
+    logging.info(f"Memory budget {memory_budget} bytes: processing sheets in chunks of {chunk_rows} rows.")
+    
+    sheet_rows = {}
+    with WorkbookReader(excel_path, batch_size=chunk_rows) as reader, \
+            StreamingWorkbookWriter(final_excel_path, batch_size=min(chunk_rows, DEFAULT_BATCH_SIZE)) as writer:
+        for sheet in tqdm(sheet_names, desc="Processing Sheets"):
+            with tempfile.TemporaryDirectory(prefix='trend_spill_') as spill_dir:
+                sheet_rows[sheet] = process_sheet_chunked(reader, sheet, new_data_dir, excel_path, writer, spill_dir)
+            logging.info(f"Saved sheet '{sheet}' with {sheet_rows[sheet]} rows.")
+            print(f"Saved sheet '{sheet}' with {sheet_rows[sheet]} rows.")
+            gc.collect()
+    return sheet_rows
+
 # ==========================
 # 4. Main Execution Flow
 # ==========================
 
 def main():
+    parser = argparse.ArgumentParser(description="NA Trend Report rollover with pandas.")
+    parser.add_argument('--memory-budget', type=parse_size, default=None, metavar='SIZE',
+                        help="Keep peak memory under SIZE (e.g. 6G) by processing sheets in chunks")
+    parser.add_argument('--workers', type=int, default=PARALLEL_WORKERS,
+                        help=f"Sheets processed in parallel processes (default: {PARALLEL_WORKERS}, 1 = one after another for low-memory hosts)")
+    parser.add_argument('--profile', choices=PROFILERS, default=None,
+                        help="Profile the stages; the run record keeps the slowest stage's profile")
+    parser.add_argument('--telemetry', default=None, metavar='PATH',
+                        help="Run record file the stage timings are appended to (default: trend_runs.jsonl)")
+    args = parser.parse_args()
+    telemetry = RunTelemetry('trend-po-csv.py', record_path=args.telemetry, profile=args.profile)
+    status = 'error'
+    
     try:
         # Define current working directory
         cwd = os.getcwd()
@@ -267,12 +669,16 @@ def main():
         final_excel_path = os.path.join(cwd, final_excel_filename)
     
         # Process the Excel file
-        process_excel_file(excel_path, new_data_dir, final_excel_path)
+        process_excel_file(excel_path, new_data_dir, final_excel_path, max_workers=args.workers,
+                           memory_budget=args.memory_budget)
+        status = 'ok'
     
     except Exception as e:
         logging.error(f"An unexpected error occurred in the main execution: {e}")
         print(f"An unexpected error occurred: {e}")
         sys.exit(1)
+    finally:
+        telemetry.finish(status=status)
 
 if __name__ == "__main__":
     main()
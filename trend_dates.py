@@ -0,0 +1,203 @@
+"""
+Shared date normalisation for the first column of the QDS sheets and exports.
+
+The date column arrives in several representations: real Excel dates,
+MM/DD/YYYY text written by delcsv.py, ISO text, DD-MM-YYYY text (the
+ConvertToDate macro in vbafile) and, for cells that lost their date style,
+Excel serial numbers. A sheet holds a million rows but only about 90 distinct
+dates, so normalise_dates() parses each distinct value once, detecting its
+format from its shape, and maps the results back onto the rows with a single
+vectorised take.
+
+Parsed text values are remembered across runs in ``.xlsx_cache/dates.json``
+in the working directory. Values that are not dates are reported (logged with
+their row counts, or raised with strict=True) instead of silently becoming
+empty.
+
+Usage:
+    dates = normalise_dates(table.column(0), name='Date')     # pa.Array of date32
+    df['Date'] = normalise_date_series(df['Date'])           # datetime64 Series
+"""
+
+import os
+import re
+import json
+import logging
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from xlsx_cache import CACHE_DIRNAME
+
+DATE_CACHE_PATH = os.path.join(CACHE_DIRNAME, 'dates.json')
+
+# Entries kept in the date cache; the oldest are dropped beyond this
+DATE_CACHE_SIZE = 100000
+
+# Text shapes and the format each is parsed with, tried in order.
+# None means ISO 8601, parsed with datetime.fromisoformat().
+TEXT_FORMATS = [
+    (re.compile(r'\d{1,2}/\d{1,2}/\d{4}$'), '%m/%d/%Y'),
+    (re.compile(r'\d{1,2}/\d{1,2}/\d{4} \d{1,2}:\d{2}:\d{2}$'), '%m/%d/%Y %H:%M:%S'),
+    (re.compile(r'\d{1,2}/\d{1,2}/\d{4} \d{1,2}:\d{2}$'), '%m/%d/%Y %H:%M'),
+    (re.compile(r'\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$'), None),
+    (re.compile(r'\d{1,2}-\d{1,2}-\d{4}$'), '%d-%m-%Y'),
+]
+
+# Excel serial numbers count days from 1899-12-30; this is the range Excel accepts
+EXCEL_EPOCH = date(1899, 12, 30)
+EXCEL_SERIAL_RANGE = (1, 2958466)
+
+# Distinct unparseable values listed in a report
+REPORT_SAMPLE = 10
+
+# ==========================
+# 1. Value Parsing
+# ==========================
+
+def parse_date_text(text):
+    """
+    Parses one text value by its shape. Returns a date, or None if the text is not a date.
+    """
+    text = text.strip()
+    for shape, date_format in TEXT_FORMATS:
+        if shape.match(text):
+            try:
+                if date_format is None:
+                    return datetime.fromisoformat(text).date()
+                return datetime.strptime(text, date_format).date()
+            except ValueError:
+                return None
+    return None
+
+def parse_date_value(value, cache):
+    """
+    Converts one distinct value of any representation to a date, or None.
+    Text results are looked up in and added to ``cache``.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool):
+        if EXCEL_SERIAL_RANGE[0] <= value < EXCEL_SERIAL_RANGE[1]:
+            return EXCEL_EPOCH + timedelta(days=int(value))
+        return None
+    if isinstance(value, str):
+        if value in cache:
+            cached = cache[value]
+            return date.fromisoformat(cached) if cached else None
+        parsed = parse_date_text(value)
+        cache[value] = parsed.isoformat() if parsed else None
+        return parsed
+    return None
+
+# ==========================
+# 2. Cache
+# ==========================
+
+_date_cache = None
+_date_cache_size = 0
+
+def date_cache():
+    """
+    Returns the text-to-date cache, loaded from DATE_CACHE_PATH on first use.
+    """
+    global _date_cache, _date_cache_size
+    if _date_cache is None:
+        _date_cache = {}
+        if os.path.isfile(DATE_CACHE_PATH):
+            try:
+                with open(DATE_CACHE_PATH, encoding='utf-8') as fh:
+                    _date_cache = json.load(fh)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable date cache '{DATE_CACHE_PATH}': {e}")
+        _date_cache_size = len(_date_cache)
+    return _date_cache
+
+def save_date_cache():
+    """
+    Writes the cache back if values were added since it was loaded or saved.
+    """
+    global _date_cache, _date_cache_size
+    if _date_cache is None or len(_date_cache) == _date_cache_size:
+        return
+    if len(_date_cache) > DATE_CACHE_SIZE:
+        _date_cache = dict(list(_date_cache.items())[-DATE_CACHE_SIZE:])
+    os.makedirs(os.path.dirname(DATE_CACHE_PATH), exist_ok=True)
+    tmp_path = f"{DATE_CACHE_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(_date_cache, fh)
+        os.replace(tmp_path, DATE_CACHE_PATH)
+    except OSError as e:
+        logging.warning(f"Could not save the date cache '{DATE_CACHE_PATH}': {e}")
+    _date_cache_size = len(_date_cache)
+
+# ==========================
+# 3. Column Normalisation
+# ==========================
+
+def _distinct_values(values):
+    """
+    Splits a column into (codes, distinct values); code -1 marks a missing value.
+    """
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        if isinstance(values, pa.ChunkedArray):
+            values = values.combine_chunks()
+        encoded = values if pa.types.is_dictionary(values.type) else pc.dictionary_encode(values)
+        codes = encoded.indices.fill_null(-1).to_numpy(zero_copy_only=False).astype(np.int64)
+        return codes, encoded.dictionary.to_pylist()
+    codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel=True)
+    return codes.astype(np.int64), list(uniques)
+
+def normalise_dates(values, name='', strict=False):
+    """
+    Converts a date column of any representation to an Arrow date32 array.
+
+    Parameters:
+        values: pa.Array, pa.ChunkedArray, pd.Series or sequence of values.
+        name (str): Column name used in the report of unparseable values.
+        strict (bool): Raise ValueError instead of logging unparseable values.
+
+    Returns:
+        dates (pa.Array): date32 array; missing and unparseable values are null.
+    """
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    if isinstance(values, pa.Array):
+        if pa.types.is_timestamp(values.type) or pa.types.is_date(values.type):
+            return pc.cast(values, pa.date32())
+    elif isinstance(values, pd.Series) and pd.api.types.is_datetime64_any_dtype(values):
+        return pc.cast(pa.array(values.dt.tz_localize(None) if values.dt.tz else values, from_pandas=True), pa.date32())
+
+    codes, uniques = _distinct_values(values)
+    cache = date_cache()
+    parsed = [parse_date_value(value, cache) for value in uniques]
+    save_date_cache()
+
+    unparsed = [i for i, (value, result) in enumerate(zip(uniques, parsed)) if result is None and value is not None]
+    if unparsed:
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        rows = int(counts[unparsed].sum())
+        sample = ', '.join(repr(uniques[i]) for i in unparsed[:REPORT_SAMPLE])
+        message = (f"{rows} values in date column '{name}' are not dates "
+                   f"({len(unparsed)} distinct, e.g. {sample}).")
+        if strict:
+            raise ValueError(message)
+        logging.warning(f"{message} They were left empty.")
+
+    distinct = pa.array(parsed + [None], type=pa.date32())
+    # Code -1 (missing) takes the trailing null
+    return distinct.take(pa.array(np.where(codes >= 0, codes, len(parsed))))
+
+def normalise_date_series(series, strict=False):
+    """
+    pandas counterpart of normalise_dates(): returns a datetime64 Series with
+    the same index and name.
+    """
+    dates = normalise_dates(series, name=series.name, strict=strict)
+    return pd.Series(dates.to_pandas(date_as_object=False).to_numpy(), index=series.index, name=series.name)
@@ -0,0 +1,588 @@
+"""
+One rollover engine for the NA Trend Report with pluggable backends.
+
+The nightly rollover (drop the oldest day, append the QDS-*.csv exports, keep
+the sheet under the Excel row limit, remove duplicates) is written once here
+against a small backend interface:
+
+    pandas   in-memory DataFrames; starts fastest, best for small reports
+    polars   lazy, multi-threaded query plan; the default for the full NA report
+    dask     out-of-core; the sheet is spilled to per-date Parquet files and
+             deduplicated one date at a time, so memory stays bounded
+
+With ``--backend auto`` the backend is chosen from the sheets' row counts
+(read from the workbook without parsing it) and the memory available on the
+machine. Polars and Dask are optional: a backend that is not installed is
+never chosen automatically.
+
+Usage:
+    python trend_engine.py                      # auto backend, QDS-*.csv from the current directory
+    python trend_engine.py --backend polars
+    python trend_engine.py --csv-dir drops --excel "NA Trend Report.xlsx"
+    python trend_engine.py --backfill drops/2024-07-04 drops/2024-07-05 drops/2024-07-06
+"""
+
+import sys
+import subprocess
+import importlib
+import importlib.util
+import os
+import glob
+import logging
+import argparse
+import shutil
+import tempfile
+from datetime import datetime
+from tqdm import tqdm
+
+# ==========================
+# 1. Setup and Dependencies
+# ==========================
+
+# List of required packages; polars and dask are optional backends
+required_packages = [
+    'pandas',
+    'pyarrow',
+    'tqdm'
+]
+
+# Function to install missing packages
+def install_packages(packages):
+    for package in packages:
+        try:
+            importlib.import_module(package)
+        except ImportError:
+            print(f"Package '{package}' not found. Installing...")
+            subprocess.check_call([sys.executable, "-m", "pip", "install", package])
+
+# Install missing packages
+install_packages(required_packages)
+
+# Now import the installed packages
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from xlsx_stream import StreamingWorkbookWriter, WorkbookReader, read_workbook
+from trend_rollover import plan_rollover, describe_plan, EXCEL_ROW_LIMIT
+from trend_dates import parse_date_text
+from qds_schema import apply_schema, arrow_schema, read_export
+from trend_telemetry import RunTelemetry, stage, PROFILERS
+
+# Mapping of CSV filename patterns to sheet names
+pattern_to_sheet = {
+    'QDS-above-70-crossed-40d': 'QDS above 70 G40',
+    'QDS-0-69-crossed-40d': 'QDS below 70 G40',
+    'QDS-0-69-less-40d': 'QDS below 70 L40',
+    'QDS-above-70-less-40d': 'QDS above 70 L40',
+}
+sheets_to_process = list(pattern_to_sheet.values())
+
+EXCEL_FILENAME = 'NA Trend Report.xlsx'
+
+# ==========================
+# 2. Column Types
+# ==========================
+#
+# Every backend works on the declared QDS types from qds_schema.py: the first
+# column is a date (rows whose date cannot be parsed keep a null date and are
+# never rolled over), numbers are float64 and repeated values such as
+# application and host names are dictionary-encoded. Sheet and CSV rows then
+# concatenate and compare the same way whichever backend runs.
+
+def find_sheet_csvs(csv_dir, sheet_name):
+    """
+    Returns the QDS-*.csv exports in ``csv_dir`` that belong to a sheet.
+    """
+    patterns = [p for p, s in pattern_to_sheet.items() if s == sheet_name]
+    return sorted(
+        f for f in glob.glob(os.path.join(csv_dir, '*.csv'))
+        if any(p in os.path.basename(f) for p in patterns)
+    )
+
+# ==========================
+# 3. Backends
+# ==========================
+#
+# A backend holds one "frame" per sheet in whatever form suits it and
+# implements these operations on it:
+#
+#   load_sheets(excel_path, sheet_names)  -> {sheet name: frame}
+#   date_histogram(frame)                 -> pd.Series of rows per date, oldest first
+#   columns(frame)                        -> column names
+#   num_rows(frame)                       -> total rows, undated rows included
+#   drop_through(frame, cutoff)           -> frame without rows dated on or before cutoff
+#   append(frame, table)                  -> frame plus a canonical Arrow table
+#   drop_duplicates(frame)                -> frame without duplicate rows
+#   iter_tables(frame, columns)           -> canonical Arrow tables to write, in order
+#   close()                               -> releases temporary files
+#
+# The dates in date_histogram() are the backend's own values; the engine only
+# hands them back to drop_through().
+
+class PandasBackend:
+    """
+    In-memory pandas DataFrames. No thread pool or query planning, so it
+    starts fastest and suits small regional reports.
+    """
+    name = 'pandas'
+
+    def load_sheets(self, excel_path, sheet_names):
+        tables = read_workbook(excel_path, sheet_names, max_workers=len(sheet_names))
+        return {
+            name: apply_schema(tables.pop(name)).to_pandas(date_as_object=False)
+            for name in sheet_names
+        }
+
+    def date_histogram(self, frame):
+        return frame.iloc[:, 0].value_counts(dropna=True).sort_index()
+
+    def columns(self, frame):
+        return list(frame.columns)
+
+    def num_rows(self, frame):
+        return len(frame)
+
+    def drop_through(self, frame, cutoff):
+        return frame[~(frame.iloc[:, 0] <= cutoff)]
+
+    def append(self, frame, table):
+        return pd.concat([frame, table.to_pandas(date_as_object=False)], ignore_index=True)
+
+    def drop_duplicates(self, frame):
+        return frame.drop_duplicates()
+
+    def iter_tables(self, frame, columns):
+        yield pa.Table.from_pandas(frame, schema=arrow_schema(columns), preserve_index=False)
+
+    def close(self):
+        pass
+
+class PolarsBackend:
+    """
+    Polars LazyFrames: the delete, append and deduplication are collected as
+    one multi-threaded query plan when the sheet is written.
+    """
+    name = 'polars'
+
+    def __init__(self):
+        import polars as pl
+        self.pl = pl
+
+    def load_sheets(self, excel_path, sheet_names):
+        tables = read_workbook(excel_path, sheet_names, max_workers=len(sheet_names))
+        return {name: self.pl.from_arrow(apply_schema(tables.pop(name))).lazy() for name in sheet_names}
+
+    def date_histogram(self, frame):
+        date_column = frame.collect_schema().names()[0]
+        counts = (
+            frame.filter(self.pl.col(date_column).is_not_null())
+            .group_by(date_column).len()
+            .sort(date_column)
+            .collect()
+        )
+        return pd.Series(counts['len'].to_list(), index=counts[date_column].to_list(), dtype='int64')
+
+    def columns(self, frame):
+        return frame.collect_schema().names()
+
+    def num_rows(self, frame):
+        return frame.select(self.pl.len()).collect().item()
+
+    def drop_through(self, frame, cutoff):
+        date = self.pl.col(frame.collect_schema().names()[0])
+        return frame.filter(date.is_null() | (date > cutoff))
+
+    def append(self, frame, table):
+        return self.pl.concat([frame, self.pl.from_arrow(table).lazy()], how='vertical')
+
+    def drop_duplicates(self, frame):
+        return frame.unique(maintain_order=True)
+
+    def iter_tables(self, frame, columns):
+        yield frame.collect().to_arrow().cast(arrow_schema(columns))
+
+    def close(self):
+        pass
+
+class DaskFrame(dict):
+    """
+    A DaskBackend frame: the {date: (files, rows)} mapping plus the sheet's
+    column names, which a header-only sheet has no Parquet file to carry.
+    """
+    def __init__(self, parts, columns):
+        super().__init__(parts)
+        self.columns = columns
+
+class DaskBackend:
+    """
+    Out-of-core backend. Each sheet is streamed from the workbook into one
+    Parquet file per date in a temporary directory, and the frame is just the
+    {date: files} mapping, so the oldest-day delete drops files and appends
+    write new ones. Duplicates can only occur within a date, so the final
+    Dask graph deduplicates one date partition at a time and never holds a
+    whole sheet in memory.
+    """
+    name = 'dask'
+
+    def __init__(self):
+        import dask
+        import dask.dataframe as dd
+        self.dask = dask
+        self.dd = dd
+        self.workdir = tempfile.mkdtemp(prefix='trend_engine_')
+        self._file_counter = 0
+
+    def _write_parts(self, frame, table):
+        """
+        Writes a canonical table as one new Parquet file per date into a frame.
+        """
+        date_column = table.column_names[0]
+        table = table.sort_by([(date_column, 'ascending')])
+        counts = pc.value_counts(table[date_column])
+        offset = 0
+        runs = sorted(
+            ((v.as_py(), n.as_py()) for v, n in zip(counts.field('values'), counts.field('counts'))),
+            key=lambda run: (run[0] is None, run[0]),
+        )
+        for value, rows in runs:
+            self._file_counter += 1
+            path = os.path.join(self.workdir, f"part-{self._file_counter:06d}.parquet")
+            pq.write_table(table.slice(offset, rows), path)
+            files, total = frame.get(value, ([], 0))
+            frame[value] = (files + [path], total + rows)
+            offset += rows
+        return frame
+
+    def load_sheets(self, excel_path, sheet_names):
+        frames = {}
+        with WorkbookReader(excel_path) as reader:
+            for sheet_name in sheet_names:
+                frame = None
+                for batch in reader.iter_batches(sheet_name):
+                    table = pa.Table.from_batches([batch])
+                    if frame is None:
+                        frame = DaskFrame({}, table.column_names)
+                    frame = self._write_parts(frame, apply_schema(table, columns=frame.columns))
+                frames[sheet_name] = frame if frame is not None else DaskFrame({}, [])
+        return frames
+
+    def date_histogram(self, frame):
+        dates = sorted(d for d in frame if d is not None)
+        return pd.Series([frame[d][1] for d in dates], index=dates, dtype='int64')
+
+    def columns(self, frame):
+        return frame.columns
+
+    def num_rows(self, frame):
+        return sum(total for _, total in frame.values())
+
+    def drop_through(self, frame, cutoff):
+        return DaskFrame({d: v for d, v in frame.items() if d is None or d > cutoff}, frame.columns)
+
+    def append(self, frame, table):
+        return self._write_parts(DaskFrame(frame, frame.columns), table)
+
+    def drop_duplicates(self, frame):
+        # Deduplication is part of reading each date partition in iter_tables()
+        return frame
+
+    def iter_tables(self, frame, columns):
+        schema = arrow_schema(columns)
+        keys = sorted((d for d in frame if d is not None)) + ([None] if None in frame else [])
+        if not keys:
+            # Header-only sheet, or every date was rolled off
+            yield schema.empty_table()
+            return
+
+        def read_date_partition(files):
+            parts = [pq.read_table(f).cast(schema) for f in files]
+            return pa.concat_tables(parts).to_pandas(date_as_object=False).drop_duplicates()
+
+        meta = schema.empty_table().to_pandas(date_as_object=False)
+        ddf = self.dd.from_map(read_date_partition, [frame[k][0] for k in keys], meta=meta)
+        # Partitions are computed one at a time and streamed out in date order
+        for i in range(ddf.npartitions):
+            yield pa.Table.from_pandas(ddf.get_partition(i).compute(), schema=schema, preserve_index=False)
+
+    def close(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+BACKENDS = {
+    'pandas': PandasBackend,
+    'polars': PolarsBackend,
+    'dask': DaskBackend,
+}
+
+# ==========================
+# 4. Backend Selection
+# ==========================
+
+# Reports up to this many rows over all sheets run on pandas: at this size
+# interpreter and thread-pool start-up dominate and pandas imports fastest.
+SMALL_REPORT_ROWS = 250000
+
+# Rough in-memory cost of one canonical cell, including working copies made
+# while filtering, concatenating and deduplicating.
+BYTES_PER_CELL = {'pandas': 120, 'polars': 40}
+
+# Share of the available memory an in-memory backend may plan to use
+MEMORY_HEADROOM = 0.5
+
+def backend_available(name):
+    """
+    Returns True if the package behind a backend is installed.
+    """
+    package = {'pandas': 'pandas', 'polars': 'polars', 'dask': 'dask'}[name]
+    return importlib.util.find_spec(package) is not None
+
+def available_memory():
+    """
+    Returns the memory available to this process in bytes, or None if unknown.
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo', encoding='ascii') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def choose_backend(sheet_shapes, memory=None):
+    """
+    Picks a backend from the sheets' sizes and the available memory.
+
+    Parameters:
+        sheet_shapes (dict): {sheet name: (rows, columns)}.
+        memory (int): Available memory in bytes; measured when None.
+
+    Returns:
+        name (str): 'pandas', 'polars' or 'dask'.
+    """
+    total_rows = sum(rows for rows, _ in sheet_shapes.values())
+    cells = sum(rows * columns for rows, columns in sheet_shapes.values())
+    if memory is None:
+        memory = available_memory()
+
+    def fits(name):
+        return memory is None or cells * BYTES_PER_CELL[name] <= memory * MEMORY_HEADROOM
+
+    if total_rows <= SMALL_REPORT_ROWS and fits('pandas'):
+        return 'pandas'
+    if backend_available('polars') and fits('polars'):
+        return 'polars'
+    if backend_available('dask'):
+        return 'dask'
+    fallback = 'polars' if backend_available('polars') else 'pandas'
+    logging.warning(f"Report may not fit in memory and Dask is not installed. Using {fallback}.")
+    return fallback
+
+# ==========================
+# 5. Rollover
+# ==========================
+
+def roll_sheet(backend, frame, sheet_name, new_tables, row_limit=EXCEL_ROW_LIMIT - 1, nights=1):
+    """
+    Deletes the oldest date of a sheet, plus further oldest dates if the new
+    rows would not fit under the row limit otherwise, then appends the new
+    rows and removes duplicates. All deletions are applied as one cutoff.
+    With ``nights`` > 1 (a backfill) the oldest ``nights`` dates are deleted,
+    as that many nightly runs would have done.
+
+    Returns:
+        frame: The backend frame after the rollover.
+        stats (dict): 'oldest_date', 'rows_deleted', 'rows_appended' and
+            'rows_planned' (the row count before duplicates are removed).
+    """
+    new_rows = sum(t.num_rows for t in new_tables)
+    with stage('rollover', sheet=sheet_name) as st:
+        histogram = backend.date_histogram(frame)
+        rows = st.rows_in = backend.num_rows(frame)
+
+        if histogram.empty:
+            print(f"No valid dates found in sheet '{sheet_name}'. No rows deleted.")
+            logging.warning(f"No valid dates found in sheet '{sheet_name}'. No rows deleted.")
+            plan = plan_rollover(histogram, rows, new_rows, row_limit=row_limit)
+            days_dropped = []
+        else:
+            # Every night deletes the oldest day; the plan adds any days needed for room
+            if len(histogram) < nights:
+                logging.warning(f"Sheet '{sheet_name}' holds only {len(histogram)} dates for {nights} nights. All of them are deleted.")
+            nightly = histogram.iloc[:nights]
+            plan = plan_rollover(histogram.iloc[nights:], rows - int(nightly.sum()), new_rows, row_limit=row_limit)
+            days_dropped = list(nightly.index) + plan['days_dropped']
+            plan['days_dropped'] = days_dropped
+            plan['rows_dropped'] += int(nightly.sum())
+        print(f"Sheet '{sheet_name}': {describe_plan(plan)}")
+        logging.info(f"Sheet '{sheet_name}': {describe_plan(plan)}")
+        if not plan['fits']:
+            logging.error(f"Sheet '{sheet_name}' exceeds the Excel row limit even after deleting every dated row.")
+
+        if days_dropped:
+            frame = backend.drop_through(frame, days_dropped[-1])
+        st.rows_out = rows - plan['rows_dropped']
+
+    # Lazy backends only build their plan here; the work is timed by the 'write' stage
+    with stage('append', sheet=sheet_name, rows_in=new_rows) as st:
+        for table in new_tables:
+            frame = backend.append(frame, table)
+        st.rows_out = plan['rows_after']
+    with stage('dedupe', sheet=sheet_name, rows_in=plan['rows_after']):
+        frame = backend.drop_duplicates(frame)
+    stats = {
+        'oldest_date': days_dropped[0] if days_dropped else None,
+        'rows_deleted': plan['rows_dropped'],
+        'rows_appended': new_rows,
+        'rows_planned': plan['rows_after'],
+    }
+    return frame, stats
+
+def read_backfill_sets(backfill_dirs, sheet_name, columns):
+    """
+    Reads the QDS exports of a sheet from one directory per missed night.
+    Warns about dates found in more than one set: every set counts as a
+    night and deletes one more day. Raw exports in a directory named after
+    its night (e.g. 'drops/2024-07-05') are stamped with that date.
+
+    Returns:
+        tables (list): The canonical Arrow tables of every set, oldest set first.
+    """
+    tables = []
+    seen = {}
+    for backfill_dir in backfill_dirs:
+        export_date = parse_date_text(os.path.basename(os.path.normpath(backfill_dir)))
+        set_tables = [read_export(p, columns=columns, export_date=export_date)
+                      for p in find_sheet_csvs(backfill_dir, sheet_name)]
+        if not set_tables:
+            logging.warning(f"No exports for sheet '{sheet_name}' in '{backfill_dir}'. The night still deletes a day.")
+        dates = set()
+        for table in set_tables:
+            dates.update(d for d in pc.unique(table.column(0)).to_pylist() if d is not None)
+        for d in sorted(dates):
+            if d in seen:
+                logging.warning(f"Sheet '{sheet_name}': rows dated {d} are in both '{seen[d]}' and '{backfill_dir}'.")
+            seen.setdefault(d, backfill_dir)
+        logging.info(f"Backfill set '{backfill_dir}' for sheet '{sheet_name}': {sum(t.num_rows for t in set_tables)} rows dated {sorted(dates)}.")
+        tables.extend(set_tables)
+    return tables
+
+def run_rollover(excel_path, csv_dir, output_path, backend='auto', backfill_dirs=None):
+    """
+    Runs the nightly rollover of every QDS sheet and writes the result to
+    ``output_path`` with the streaming writer.
+
+    With ``backfill_dirs`` (one directory of QDS exports per missed night)
+    the nights are run in the same single pass: as many oldest dates are
+    deleted as there are nights, and every set is appended.
+
+    Returns:
+        results (dict): {sheet name: stats}, with 'rows' and 'duplicates_removed' added.
+    """
+    nights = len(backfill_dirs) if backfill_dirs else 1
+    with WorkbookReader(excel_path) as reader:
+        present = [s for s in sheets_to_process if s in reader.sheet_names]
+        shapes = {s: reader.estimate_shape(s) for s in present}
+    for sheet_name in sheets_to_process:
+        if sheet_name not in present:
+            logging.warning(f"Sheet '{sheet_name}' not found in '{excel_path}'. Skipping.")
+
+    if backend == 'auto':
+        backend = choose_backend(shapes)
+        print(f"Selected the {backend} backend for {sum(r for r, _ in shapes.values())} rows.")
+        logging.info(f"Selected the {backend} backend for sheet shapes {shapes}.")
+    engine = BACKENDS[backend]()
+
+    results = {}
+    try:
+        print(f"Reading sheets {present} from '{excel_path}'...")
+        with stage('read workbook'):
+            frames = engine.load_sheets(excel_path, present)
+        with StreamingWorkbookWriter(output_path) as writer:
+            for sheet_name in tqdm(present, desc="Processing Sheets"):
+                frame = frames.pop(sheet_name)
+                columns = engine.columns(frame)
+                with stage('read CSVs', sheet=sheet_name) as st:
+                    if backfill_dirs:
+                        new_tables = read_backfill_sets(backfill_dirs, sheet_name, columns)
+                    else:
+                        new_tables = [read_export(p, columns=columns) for p in find_sheet_csvs(csv_dir, sheet_name)]
+                    st.rows_out = sum(t.num_rows for t in new_tables)
+                frame, stats = roll_sheet(engine, frame, sheet_name, new_tables, nights=nights)
+                with stage('write', sheet=sheet_name, rows_in=stats['rows_planned']) as st:
+                    stats['rows'] = st.rows_out = writer.write_sheet(sheet_name, engine.iter_tables(frame, columns), columns=columns)
+                stats['duplicates_removed'] = stats['rows_planned'] - stats['rows']
+                print(f"Saved sheet '{sheet_name}' with {stats['rows']} rows ({stats['duplicates_removed']} duplicates removed).")
+                logging.info(f"Saved sheet '{sheet_name}' with {stats['rows']} rows ({stats['duplicates_removed']} duplicates removed).")
+                results[sheet_name] = stats
+                del frame
+    finally:
+        engine.close()
+    return results
+
+# ==========================
+# 6. Main Execution Flow
+# ==========================
+
+def main():
+    parser = argparse.ArgumentParser(description="NA Trend Report rollover with pluggable backends.")
+    parser.add_argument('--backend', choices=['auto'] + sorted(BACKENDS), default='auto')
+    parser.add_argument('--excel', default=EXCEL_FILENAME, help="Workbook to roll over")
+    parser.add_argument('--csv-dir', default='.', help="Directory holding the QDS-*.csv exports")
+    parser.add_argument('--backfill', nargs='+', metavar='DIR',
+                        help="Catch up on missed nights in one pass: one directory of QDS-*.csv exports per night")
+    parser.add_argument('--profile', choices=PROFILERS, default=None,
+                        help="Profile the stages; the run record keeps the slowest stage's profile")
+    parser.add_argument('--telemetry', default=None, help="Run record file the stage timings are appended to (default: trend_runs.jsonl)")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename='data_processing.log',
+        filemode='w',  # Overwrite log file each run
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    cwd = os.getcwd()
+    excel_path = os.path.join(cwd, args.excel)
+    csv_dir = os.path.join(cwd, args.csv_dir)
+    if not os.path.isfile(excel_path):
+        sys.exit(f"Excel file '{excel_path}' not found.")
+    backfill_dirs = None
+    if args.backfill:
+        # Directory names sort by date when named after the night, e.g. 2024-07-05
+        backfill_dirs = sorted(os.path.join(cwd, d) for d in args.backfill)
+        missing = [d for d in backfill_dirs if not os.path.isdir(d)]
+        if missing:
+            sys.exit(f"Backfill directories not found: {missing}")
+        print(f"Backfilling {len(backfill_dirs)} nights in one pass.")
+        logging.info(f"Backfilling {len(backfill_dirs)} nights from {backfill_dirs}.")
+    if args.backend != 'auto' and not backend_available(args.backend):
+        sys.exit(f"The {args.backend} backend needs the '{args.backend}' package. Install it with pip.")
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    base = os.path.splitext(excel_path)[0]
+    backup_path = f"{base}_backup_{timestamp}.xlsx"
+    shutil.copy2(excel_path, backup_path)
+    print(f"Backup of the original Excel file created at '{backup_path}'")
+    logging.info(f"Backup of the original Excel file created at '{backup_path}'")
+
+    final_excel_path = f"{base}_Final_{timestamp}.xlsx"
+    telemetry = RunTelemetry('trend_engine.py', record_path=args.telemetry, profile=args.profile)
+    status = 'error'
+    try:
+        run_rollover(excel_path, csv_dir, final_excel_path, backend=args.backend, backfill_dirs=backfill_dirs)
+        status = 'ok'
+    finally:
+        telemetry.finish(status=status, workbook=excel_path, backend=args.backend)
+    print(f"\nFinal Excel file saved at '{final_excel_path}'")
+    logging.info(f"Final Excel file saved at '{final_excel_path}'")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+Content-addressed ingest manifest and archive of the QDS exports.
+
+The trend scripts glob every QDS-*.csv in the working directory, so exports
+left over from an earlier night used to be read, parsed and appended again
+only for the sheet-wide duplicate removal to throw the rows away.
+IngestManifest remembers every export that made it into a saved workbook by
+the SHA-256 of its content, together with its sheet, row count and dates and
+the workbook that holds it:
+
+    ingest_archive/
+        ingest.json              {hash: entry} and the last hash seen per path
+        <sha256>.parquet         the parsed export, zstd-compressed
+
+A file whose size and modification time are unchanged since it was last
+seen is recognised without reading it; a file that was touched is hashed
+again (a read, never a parse). The same content under another name is the
+same export.
+
+An export is only skipped when the workbook being read is the one that holds
+it: the saved workbook is recorded by workbook_digest(), taken from the zip
+directory, so it survives renaming or copying the _Final_ file to
+'NA Trend Report.xlsx' but not an edit. Running again from the workbook the
+exports were appended to reads them again instead of losing them. Each
+commit carries the exports of the workbook that was read over to the one
+that was written, so leftovers from earlier nights stay skipped.
+
+An export is archived as Parquet, with its declared column types, when it is
+first parsed and marked 'pending'. commit() marks the pending exports
+'ingested' once the workbook has been saved, so an export of a run that died
+is not skipped by the next run. The archive is the history of every
+ingested export and replays without parsing a CSV again.
+
+Usage:
+    ingest = IngestManifest()
+    source = workbook_digest(excel_path)
+    entry = ingest.ingested(csv_path, source)     # None if the workbook lacks the export
+    ingest.archive(csv_path, table, sheet_name)
+    ...save the workbook...
+    ingest.commit(csv_paths, source, workbook_digest(final_excel_path), workbook=final_excel_path)
+
+    for entry, table in ingest.replay(sheet='QDS above 70 G40'):
+        ...
+"""
+
+import os
+import json
+import hashlib
+import logging
+import zipfile
+from datetime import datetime
+
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from trend_journal import file_fingerprint
+
+ARCHIVE_DIRNAME = 'ingest_archive'
+MANIFEST_FILENAME = 'ingest.json'
+
+PENDING = 'pending'
+INGESTED = 'ingested'
+
+# Bytes hashed per read
+HASH_BLOCK_SIZE = 1 << 20
+
+# ==========================
+# 1. Content Hashes
+# ==========================
+
+def content_hash(path):
+    """
+    Returns the SHA-256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def workbook_digest(excel_path):
+    """
+    Returns a SHA-256 hex digest of a workbook's content, taken from the
+    name, CRC-32 and size of every part in its zip directory, so nothing is
+    decompressed. Renaming or copying the file keeps it; any edit changes it.
+    """
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(excel_path) as zf:
+        for info in sorted(zf.infolist(), key=lambda i: i.filename):
+            digest.update(f"{info.filename}:{info.CRC}:{info.file_size}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def table_dates(table):
+    """
+    Returns the distinct dates of a table's first column as sorted ISO strings.
+    """
+    if table.num_rows == 0:
+        return []
+    values = pc.unique(table.column(0)).to_pylist()
+    return sorted(v.isoformat() if hasattr(v, 'isoformat') else str(v) for v in values if v is not None)
+
+# ==========================
+# 2. Manifest
+# ==========================
+
+class IngestManifest:
+    """
+    Exports ingested into the trend report, keyed by content hash.
+
+    Parameters:
+        archive_dir (str): Archive directory; defaults to ingest_archive in
+            the working directory.
+    """
+
+    def __init__(self, archive_dir=None):
+        self.dir = archive_dir or os.path.join(os.getcwd(), ARCHIVE_DIRNAME)
+        self.path = os.path.join(self.dir, MANIFEST_FILENAME)
+        self.state = {'exports': {}, 'paths': {}}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, encoding='utf-8') as fh:
+                    self.state = json.load(fh)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable ingest manifest '{self.path}': {e}")
+
+    def _save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(self.state, fh, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def hash(self, path):
+        """
+        Returns the content hash of a file. The file is only read if its
+        size or modification time changed since it was last hashed.
+        """
+        key = os.path.abspath(path)
+        fingerprint = file_fingerprint(path)
+        seen = self.state['paths'].get(key)
+        if seen and seen['fingerprint'] == fingerprint:
+            return seen['hash']
+        digest = content_hash(path)
+        self.state['paths'][key] = {'fingerprint': fingerprint, 'hash': digest}
+        return digest
+
+    def ingested(self, path, workbook):
+        """
+        Returns the manifest entry if the file's content is already in the
+        workbook with digest ``workbook``, otherwise None.
+        """
+        entry = self.state['exports'].get(self.hash(path))
+        if entry and entry['status'] == INGESTED and entry.get('workbook_digest') == workbook:
+            return entry
+        return None
+
+    def split(self, paths, workbook):
+        """
+        Splits export paths into new ones and [(path, entry)] of ones already
+        in the workbook with digest ``workbook``.
+        """
+        new, skipped = [], []
+        for path in paths:
+            entry = self.ingested(path, workbook)
+            if entry is None:
+                new.append(path)
+            else:
+                skipped.append((path, entry))
+        return new, skipped
+
+    def archive_path(self, digest):
+        """
+        Returns the archived Parquet copy of an export.
+        """
+        return os.path.join(self.dir, f"{digest}.parquet")
+
+    def archive(self, path, table, sheet):
+        """
+        Archives a parsed export and records it as pending until commit().
+
+        Parameters:
+            path (str): The export file.
+            table (pa.Table): The export as parsed, with its declared types.
+            sheet (str): The sheet the export is appended to.
+
+        Returns:
+            entry (dict): The manifest entry.
+        """
+        digest = self.hash(path)
+        archive_path = self.archive_path(digest)
+        if not os.path.isfile(archive_path):
+            os.makedirs(self.dir, exist_ok=True)
+            tmp_path = f"{archive_path}.tmp"
+            pq.write_table(table, tmp_path, compression='zstd')
+            os.replace(tmp_path, archive_path)
+        entry = self.state['exports'].get(digest)
+        if entry is None or entry['status'] != INGESTED:
+            entry = {
+                'file': os.path.basename(path),
+                'sheet': sheet,
+                'rows': table.num_rows,
+                'dates': table_dates(table),
+                'archive': os.path.basename(archive_path),
+                'archived': datetime.now().isoformat(timespec='seconds'),
+                'status': PENDING,
+            }
+            self.state['exports'][digest] = entry
+        self._save()
+        return entry
+
+    def commit(self, paths, source, target, **info):
+        """
+        Records that the workbook with digest ``target`` was saved from the
+        one with digest ``source`` and the exports in ``paths``. Pending
+        exports among ``paths`` are marked as ingested; they and the exports
+        already in the source workbook now point at the target. Keyword
+        arguments (e.g. the workbook path) are kept with them.
+
+        Returns:
+            count (int): Number of exports marked as ingested.
+        """
+        count = 0
+        now = datetime.now().isoformat(timespec='seconds')
+        for entry in self.state['exports'].values():
+            if entry['status'] == INGESTED and entry.get('workbook_digest') == source:
+                entry.update(workbook_digest=target, **info)
+        for path in paths:
+            entry = self.state['exports'].get(self.hash(path))
+            if entry is None:
+                continue
+            if entry['status'] == PENDING:
+                entry.update(status=INGESTED, ingested=now)
+                count += 1
+            entry.update(workbook_digest=target, **info)
+        self._save()
+        return count
+
+    def entries(self, sheet=None):
+        """
+        Returns [(hash, entry)] of the ingested exports, oldest first.
+        """
+        return sorted(
+            ((digest, entry) for digest, entry in self.state['exports'].items()
+             if entry['status'] == INGESTED and (sheet is None or entry['sheet'] == sheet)),
+            key=lambda item: (item[1]['dates'][:1], item[1]['ingested']),
+        )
+
+    def replay(self, sheet=None, since=None):
+        """
+        Yields (entry, table) for every archived export, oldest first, read
+        from the Parquet copies instead of the CSVs.
+
+        Parameters:
+            sheet (str): Only the exports of this sheet.
+            since (str): Only exports with rows dated on or after this ISO date.
+        """
+        for digest, entry in self.entries(sheet):
+            if since is not None and not any(d >= since for d in entry['dates']):
+                continue
+            table = pq.read_table(self.archive_path(digest))
+            yield entry, table
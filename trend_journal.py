@@ -0,0 +1,279 @@
+"""
+Crash-resumable stage journal for the nightly rollover.
+
+A run that dies half way (out of memory while writing, a killed session)
+used to start over from re-reading the whole workbook on the next run, and
+process_new_logic.py could leave its intermediate files half updated so the
+rerun deleted another day. StageJournal records every completed stage of
+every sheet in ``<report>.journal/`` next to the workbook, together with the
+stage's output as an Arrow IPC file, so a restarted run loads the output of
+the last completed stage instead of redoing it.
+
+Stages are idempotent by construction: each one reads the recorded output of
+the previous stage (or the unchanged source workbook) and never its own
+output, and an output is renamed into place before the stage is marked done.
+A resumed run therefore never drops the oldest date twice.
+
+The journal belongs to the workbook it was started from (file size and
+modification time). Stages that read the new CSV exports are also tied to
+those files and are redone if they changed. Once the workbook has been
+written, complete() drops the stage outputs and remembers the written
+workbook and the CSVs it was built from, so rerunning a script that updates
+the workbook in place with the same CSVs does nothing.
+
+A script that replaces its source workbook writes the new one to
+staging_path() and hands it to publish(), which records the replacement in
+the journal before renaming the file over the workbook. A crash between the
+rename and complete() is finished by the next run instead of the replaced
+workbook being taken for a new one and losing another day.
+
+Usage:
+    journal = StageJournal(excel_path, inputs=csv_files)
+    if journal.done(sheet, 'rollover'):
+        df = journal.load(sheet, 'rollover').to_pandas()
+    else:
+        df = ...drop the oldest date...
+        journal.record(sheet, 'rollover', {'rows': df}, oldest_date=oldest_date)
+    ...
+    journal.complete(final_excel_path)
+    # or, when the source workbook is replaced:
+    journal.publish(staged_path, excel_path)
+"""
+
+import os
+import json
+import shutil
+import logging
+from datetime import datetime
+
+from xlsx_stream import write_ipc, read_ipc
+
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_FILENAME = 'journal.json'
+
+# ==========================
+# 1. Fingerprints
+# ==========================
+
+def journal_dir(excel_path):
+    """
+    Returns the journal directory kept next to a report, e.g. 'NA Trend Report.journal'.
+    """
+    return f"{os.path.splitext(excel_path)[0]}{JOURNAL_SUFFIX}"
+
+def file_fingerprint(path):
+    """
+    Returns [size, modification time in ns] of a file, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def files_fingerprint(paths):
+    """
+    Returns {file name: fingerprint} of the input files.
+    """
+    return {os.path.basename(path): file_fingerprint(path) for path in sorted(paths)}
+
+# ==========================
+# 2. Journal
+# ==========================
+
+class StageJournal:
+    """
+    Completed stages per sheet and their outputs for one run over a workbook.
+
+    Parameters:
+        excel_path (str): The source workbook.
+        inputs (list): Paths of the CSV exports the run appends.
+
+    Attributes:
+        resumed (bool): Stages of an interrupted run were found and are reused.
+        already_completed (bool): The workbook is the output of a completed
+            run with the same inputs; there is nothing left to do.
+    """
+
+    def __init__(self, excel_path, inputs=()):
+        self.dir = journal_dir(excel_path)
+        self.state_path = os.path.join(self.dir, JOURNAL_FILENAME)
+        self.resumed = False
+        self.already_completed = False
+        source = file_fingerprint(excel_path)
+        inputs = files_fingerprint(inputs)
+
+        state = self._read_state()
+        if state and state.get('pending') and not state.get('completed'):
+            state = self._finish_pending(state)
+            source = file_fingerprint(excel_path)
+        if state and state.get('completed'):
+            if state['completed']['fingerprint'] == source and state['inputs'] == inputs:
+                self.already_completed = True
+                self.state = state
+                return
+        elif state and state.get('source') == source:
+            self.state = state
+            if state['inputs'] != inputs:
+                logging.info("The CSV exports changed since the interrupted run. Redoing the stages that read them.")
+                for sheet, stages in state['stages'].items():
+                    for stage in [s for s, entry in stages.items() if entry['uses_inputs']]:
+                        self._remove_outputs(stages.pop(stage))
+                state['inputs'] = inputs
+            self.resumed = any(state['stages'].values())
+            if self.resumed:
+                print(f"Resuming the interrupted run recorded in '{self.dir}'.")
+                logging.info(f"Resuming the interrupted run recorded in '{self.dir}': {self.summary()}")
+            return
+        elif state:
+            logging.info(f"Journal '{self.dir}' belongs to another workbook. Starting a new run.")
+
+        if os.path.isdir(self.dir):
+            shutil.rmtree(self.dir)
+        self.state = {
+            'source': source,
+            'inputs': inputs,
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'stages': {},
+            'completed': None,
+        }
+
+    def _read_state(self):
+        if not os.path.isfile(self.state_path):
+            return None
+        try:
+            with open(self.state_path, encoding='utf-8') as fh:
+                return json.load(fh)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable journal '{self.state_path}': {e}")
+            return None
+
+    def _write_state(self):
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(self.state, fh, indent=2, default=str)
+        os.replace(tmp_path, self.state_path)
+
+    def _finish_pending(self, state):
+        """
+        Finishes a publish() interrupted after the replacement was recorded:
+        the staged workbook is renamed into place if that had not happened
+        yet, and the run is completed.
+        """
+        pending = state.pop('pending')
+        self.state = state
+        if file_fingerprint(pending['staged']) == pending['fingerprint']:
+            os.replace(pending['staged'], pending['output'])
+        if file_fingerprint(pending['output']) != pending['fingerprint']:
+            logging.warning(f"The workbook written by the interrupted run, '{pending['output']}', is gone. Resuming its stages.")
+            self._write_state()
+            return state
+        print(f"Completing the interrupted run recorded in '{self.dir}': '{pending['output']}' was already written.")
+        logging.info(f"Completing the interrupted run recorded in '{self.dir}': '{pending['output']}' was already written.")
+        self.complete(pending['output'])
+        return self.state
+
+    def _remove_outputs(self, entry):
+        for filename in entry['outputs'].values():
+            path = os.path.join(self.dir, filename)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def summary(self):
+        """
+        Returns the completed stages per sheet, e.g. {'QDS above 70 G40': ['rollover']}.
+        """
+        return {sheet: list(stages) for sheet, stages in self.state['stages'].items()}
+
+    def done(self, sheet, stage):
+        """
+        Returns True if the stage of the sheet completed in this run or the interrupted one.
+        """
+        return stage in self.state['stages'].get(sheet, {})
+
+    def info(self, sheet, stage):
+        """
+        Returns the details recorded with a completed stage (e.g. the deleted date).
+        """
+        return self.state['stages'][sheet][stage]['info']
+
+    def load(self, sheet, stage, name='rows', memory_map=False):
+        """
+        Returns an output of a completed stage as an Arrow table.
+        With ``memory_map=True`` the table maps the journal file, which is
+        only removed by complete().
+        """
+        filename = self.state['stages'][sheet][stage]['outputs'][name]
+        return read_ipc(os.path.join(self.dir, filename), memory_map=memory_map)
+
+    def record(self, sheet, stage, outputs=None, uses_inputs=False, **info):
+        """
+        Marks a stage of a sheet as completed. The outputs are written first
+        and renamed into place, so a crash leaves the stage either fully
+        recorded or not recorded at all.
+
+        Parameters:
+            sheet (str): The sheet name.
+            stage (str): The stage name, e.g. 'rollover' or 'append'.
+            outputs (dict): {name: DataFrame or Arrow table} produced by the stage.
+            uses_inputs (bool): The stage read the CSV exports and must be
+                redone if they change.
+            **info: Details kept with the stage, e.g. the deleted date.
+        """
+        os.makedirs(self.dir, exist_ok=True)
+        files = {}
+        for name, data in (outputs or {}).items():
+            filename = f"{sheet}.{stage}.{name}.arrow"
+            tmp_path = os.path.join(self.dir, f"{filename}.tmp")
+            write_ipc(data, tmp_path)
+            os.replace(tmp_path, os.path.join(self.dir, filename))
+            files[name] = filename
+        self.state['stages'].setdefault(sheet, {})[stage] = {
+            'outputs': files,
+            'uses_inputs': uses_inputs,
+            'info': info,
+            'at': datetime.now().isoformat(timespec='seconds'),
+        }
+        self._write_state()
+
+    def staging_path(self, output_path):
+        """
+        Returns the path in the journal a workbook that replaces ``output_path`` is written to before publish().
+        """
+        os.makedirs(self.dir, exist_ok=True)
+        return os.path.join(self.dir, os.path.basename(output_path))
+
+    def publish(self, staged_path, output_path):
+        """
+        Replaces ``output_path`` with the workbook written to ``staged_path``
+        and completes the run. The replacement and the staged file's
+        fingerprint are recorded first, so a run that dies after the rename
+        is completed by the next one instead of being started over.
+        """
+        self.state['pending'] = {
+            'staged': staged_path,
+            'output': output_path,
+            'fingerprint': file_fingerprint(staged_path),
+        }
+        self._write_state()
+        os.replace(staged_path, output_path)
+        self.complete(output_path)
+
+    def complete(self, output_path):
+        """
+        Ends the run after the workbook has been written: the stage outputs are
+        removed and the written workbook is remembered with the inputs it was
+        built from.
+        """
+        for stages in self.state['stages'].values():
+            for entry in stages.values():
+                self._remove_outputs(entry)
+        self.state['stages'] = {}
+        self.state.pop('pending', None)
+        self.state['completed'] = {
+            'output': output_path,
+            'fingerprint': file_fingerprint(output_path),
+            'at': datetime.now().isoformat(timespec='seconds'),
+        }
+        self._write_state()
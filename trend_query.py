@@ -0,0 +1,406 @@
+"""
+Query the NA Trend Report history kept in the Parquet trend store.
+
+Answers questions such as "what did application X look like in QDS above
+70 G40 over the last 30 days?" without opening the workbook or loading a
+whole sheet:
+
+    python trend_query.py --sheet "QDS above 70 G40" --last-days 30 --where "Application=X"
+    python trend_query.py --from 2024-07-01 --to 2024-07-31 --where "QDS>=90" -o july.xlsx
+    python trend_query.py --summary --last-days 30 --where "Application=X"
+
+Predicates are pushed down to the storage:
+    - date ranges select the date partitions from the store manifest, so
+      files of other dates are never opened (partition pruning);
+    - equality and range predicates on the stored columns are handed to the
+      Parquet reader, which skips row groups whose column statistics cannot
+      match and only decodes the projected columns.
+Predicates on the date column prune partitions like --from/--to. Numeric
+comparisons on the declared number columns (e.g. QDS, stored as text) are
+applied to the rows that remain, after the thousands separators are
+removed; ranges on other text columns compare text.
+
+Output goes to CSV on stdout, or to the file given with -o (.csv, .parquet
+or .xlsx; an .xlsx gets one sheet per queried sheet).
+"""
+
+import sys
+import subprocess
+import importlib
+import os
+import re
+import time
+import logging
+import argparse
+import operator
+from datetime import date, timedelta
+
+# ==========================
+# 1. Setup and Dependencies
+# ==========================
+
+# List of required packages
+required_packages = [
+    'pyarrow',
+]
+
+# Function to install missing packages
+def install_packages(packages):
+    for package in packages:
+        try:
+            importlib.import_module(package)
+        except ImportError:
+            print(f"Package '{package}' not found. Installing...")
+            subprocess.check_call([sys.executable, "-m", "pip", "install", package])
+
+# Install missing packages
+install_packages(required_packages)
+
+# Now import the installed packages
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from xlsx_stream import StreamingWorkbookWriter
+from qds_schema import column_kinds, parse_numbers, NUMBER
+from trend_dates import parse_date_text
+from trend_store import (read_manifest, dated_partitions, partition_path, rollup_path, sheet_schema,
+                         STORE_DIRNAME, UNDATED_PARTITION)
+from trend_rollups import SUMMARY_SHEET_NAME
+
+# ==========================
+# 2. Predicates
+# ==========================
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '<=': operator.le,
+    '>': operator.gt,
+    '<': operator.lt,
+}
+PREDICATE_RE = re.compile(r'^(.+?)(>=|<=|!=|=|>|<)(.*)$')
+
+COMPUTE_FUNCTIONS = {
+    '=': pc.equal,
+    '!=': pc.not_equal,
+    '>=': pc.greater_equal,
+    '<=': pc.less_equal,
+    '>': pc.greater,
+    '<': pc.less,
+}
+
+def parse_predicate(text):
+    """
+    Parses 'column<op>value' (op one of = != >= <= > <) into (column, op, value).
+    """
+    match = PREDICATE_RE.match(text)
+    if not match:
+        raise ValueError(f"Cannot parse predicate '{text}'. Use e.g. 'Application=X' or 'QDS>=70'.")
+    column, op, value = match.groups()
+    return column.strip(), op, value.strip()
+
+def typed_value(value, field):
+    """
+    Converts a predicate value to the type of the stored column.
+    """
+    if pa.types.is_date(field.type):
+        parsed = parse_date_text(value)
+        if parsed is None:
+            raise ValueError(f"'{value}' is not a date (column '{field.name}').")
+        return parsed
+    if pa.types.is_integer(field.type) or pa.types.is_floating(field.type):
+        return float(value)
+    return value
+
+def split_predicates(predicates, schema, numeric_text=()):
+    """
+    Splits predicates into a dataset filter expression, pushed down to the
+    Parquet reader, and predicates applied after reading (numeric comparisons
+    on columns stored as text).
+
+    Returns:
+        expression (ds.Expression): The pushed-down filter, or None.
+        residual (list): [(column, op, float value)] left to apply.
+    """
+    expression = None
+    residual = []
+    for column, op, value in predicates:
+        if column not in schema.names:
+            raise ValueError(f"Unknown column '{column}'. Columns: {schema.names}")
+        field = schema.field(column)
+        if column in numeric_text:
+            residual.append((column, op, float(value.replace(',', ''))))
+            continue
+        value = typed_value(value, field)
+        scalar = pa.scalar(value) if isinstance(value, float) else pa.scalar(value, type=field.type)
+        condition = OPERATORS[op](ds.field(column), scalar)
+        expression = condition if expression is None else expression & condition
+    return expression, residual
+
+def apply_residual(table, residual):
+    """
+    Applies numeric comparisons to text columns of the rows read.
+    """
+    for column, op, value in residual:
+        numbers, _ = parse_numbers(table.column(column))
+        table = table.filter(pc.fill_null(COMPUTE_FUNCTIONS[op](numbers, value), False))
+    return table
+
+# ==========================
+# 3. Query
+# ==========================
+
+def parse_bound(value):
+    """
+    Parses a --from/--to date; a bound that is not a date is an error rather
+    than dropped, which would turn the query into a full scan.
+    """
+    if not isinstance(value, str):
+        return value
+    parsed = parse_date_text(value)
+    if parsed is None:
+        raise ValueError(f"'{value}' is not a date.")
+    return parsed
+
+def date_window(start=None, end=None, last_days=None, newest=None):
+    """
+    Returns the (start, end) dates of a query. ``last_days`` counts back from
+    the newest date held, not from today, so a report that lags behind still
+    shows its last N days.
+    """
+    start = parse_bound(start)
+    end = parse_bound(end)
+    if last_days:
+        end = end or newest
+        if end is not None:
+            start = end - timedelta(days=last_days - 1)
+    return start, end
+
+def narrow_window(start, end, predicates, date_field):
+    """
+    Narrows the date range with the predicates on the date column, so they
+    prune partitions too. The predicates themselves are still applied.
+    """
+    for column, op, value in predicates:
+        if column != date_field.name or op == '!=':
+            continue
+        day = typed_value(value, date_field)
+        if op in ('>=', '>', '='):
+            day_start = day + timedelta(days=1) if op == '>' else day
+            start = day_start if start is None else max(start, day_start)
+        if op in ('<=', '<', '='):
+            day_end = day - timedelta(days=1) if op == '<' else day
+            end = day_end if end is None else min(end, day_end)
+    return start, end
+
+def query_sheet(store_dir, sheet_name, entry, predicates=(), start=None, end=None, last_days=None,
+                columns=None, limit=None):
+    """
+    Runs a query over one sheet of the store.
+
+    Parameters:
+        store_dir (str): The trend store.
+        sheet_name (str): The sheet.
+        entry (dict): The sheet's manifest entry.
+        predicates (list): [(column, op, value)] as from parse_predicate().
+        start, end (date or str): Inclusive date range.
+        last_days (int): The last N days held by the sheet.
+        columns (list): Columns to return; defaults to all.
+        limit (int): Return at most this many rows.
+
+    Returns:
+        table (pa.Table): The matching rows.
+        files (int): Number of date partitions read.
+    """
+    schema = sheet_schema(entry['columns'])
+    keys = dated_partitions(entry)
+    newest = date.fromisoformat(keys[-1]) if keys else None
+    start, end = date_window(start, end, last_days, newest)
+    start, end = narrow_window(start, end, predicates, schema.field(0))
+
+    # Partition pruning: only the files of the dates in range are opened
+    if start is not None:
+        keys = [k for k in keys if k >= start.isoformat()]
+    if end is not None:
+        keys = [k for k in keys if k <= end.isoformat()]
+    if start is None and end is None and UNDATED_PARTITION in entry['partitions']:
+        keys.append(UNDATED_PARTITION)
+
+    numeric_text = [c for c, kind in zip(schema.names, column_kinds(schema.names)) if kind == NUMBER]
+    expression, residual = split_predicates(predicates, schema, numeric_text)
+    columns = columns or schema.names
+    unknown = [c for c in columns if c not in schema.names]
+    if unknown:
+        raise ValueError(f"Unknown columns {unknown}. Columns: {schema.names}")
+    read_columns = columns + [c for c, _, _ in residual if c not in columns]
+
+    files = [partition_path(store_dir, sheet_name, k) for k in keys]
+    if not files:
+        return schema.empty_table().select(columns), 0
+    dataset = ds.dataset(files, schema=schema, format='parquet')
+    if limit and not residual:
+        table = dataset.head(limit, columns=read_columns, filter=expression)
+    else:
+        table = dataset.to_table(columns=read_columns, filter=expression)
+        table = apply_residual(table, residual)
+        if limit:
+            table = table.slice(0, limit)
+    logging.info(f"Query on sheet '{sheet_name}' ({start} to {end}, {predicates}) read {len(files)} partitions and returned {table.num_rows} rows.")
+    return table.select(columns), len(files)
+
+def query_summary(store_dir, sheet_names, predicates=(), start=None, end=None, last_days=None,
+                  columns=None, limit=None):
+    """
+    Runs a query over the daily rollups of the sheets (see trend_rollups.py)
+    instead of their rows. The rollups are read with the columns they were
+    built for (trend_store.py --summary-group / --summary-score).
+    """
+    files = [rollup_path(store_dir, s) for s in sheet_names if os.path.isfile(rollup_path(store_dir, s))]
+    if not files:
+        raise ValueError("No daily rollups in the store yet. Run 'python trend_store.py run' or 'export' first.")
+    schema = pq.read_schema(files[0])
+    dataset = ds.dataset(files, schema=schema, format='parquet')
+    newest = None
+    if last_days and end is None:
+        newest = pc.max(dataset.to_table(columns=['Date'])['Date']).as_py()
+    start, end = date_window(start, end, last_days, newest)
+    predicates = list(predicates)
+    if start is not None:
+        predicates.append(('Date', '>=', start.isoformat()))
+    if end is not None:
+        predicates.append(('Date', '<=', end.isoformat()))
+    expression, _ = split_predicates(predicates, schema)
+    table = dataset.to_table(columns=columns or schema.names, filter=expression)
+    order = ('Date', 'QDS Band', 'Age', schema.field(3).name)
+    table = table.sort_by([(c, 'ascending') for c in order if c in table.column_names])
+    if limit:
+        table = table.slice(0, limit)
+    return table
+
+def query(store_dir, sheets=None, predicates=(), start=None, end=None, last_days=None, columns=None,
+          limit=None, summary=False):
+    """
+    Runs a query over the trend store.
+
+    Parameters:
+        store_dir (str): The trend store.
+        sheets (list): Sheets to query; defaults to every sheet.
+        predicates (list): [(column, op, value)] or 'column<op>value' strings.
+        start, end (date or str): Inclusive date range.
+        last_days (int): The last N days held by each sheet.
+        columns (list): Columns to return.
+        limit (int): At most this many rows per sheet.
+        summary (bool): Query the daily rollups instead of the rows.
+
+    Returns:
+        results (dict): {sheet name: pa.Table}; with ``summary`` one entry
+            named 'QDS Daily Summary'.
+    """
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        raise ValueError(f"Trend store '{store_dir}' not found. Run 'python trend_store.py import' first.")
+    sheet_names = sheets or list(manifest['sheets'])
+    missing = [s for s in sheet_names if s not in manifest['sheets']]
+    if missing:
+        raise ValueError(f"Sheets {missing} not in the store. Sheets: {list(manifest['sheets'])}")
+    predicates = [parse_predicate(p) if isinstance(p, str) else p for p in predicates]
+
+    if summary:
+        return {SUMMARY_SHEET_NAME: query_summary(store_dir, sheet_names, predicates, start, end, last_days, columns, limit)}
+    results = {}
+    for sheet_name in sheet_names:
+        results[sheet_name], _ = query_sheet(store_dir, sheet_name, manifest['sheets'][sheet_name], predicates,
+                                             start, end, last_days, columns, limit)
+    return results
+
+# ==========================
+# 4. Output
+# ==========================
+
+def combined_table(results):
+    """
+    Returns the results as one table, with a leading 'Sheet' column when
+    more than one sheet was queried.
+    """
+    if len(results) == 1:
+        return next(iter(results.values()))
+    tables = []
+    for sheet_name, table in results.items():
+        tables.append(table.add_column(0, 'Sheet', pa.array([sheet_name] * table.num_rows, pa.string())))
+    return pa.concat_tables(tables, promote_options='permissive')
+
+def write_results(results, output=None):
+    """
+    Writes query results to ``output`` (.csv, .parquet or .xlsx) or as CSV to stdout.
+    """
+    if output is None:
+        pacsv.write_csv(combined_table(results), sys.stdout.buffer)
+        return
+    extension = os.path.splitext(output)[1].lower()
+    if extension == '.xlsx':
+        with StreamingWorkbookWriter(output) as writer:
+            for sheet_name, table in results.items():
+                writer.write_sheet(sheet_name, table)
+    elif extension == '.parquet':
+        pq.write_table(combined_table(results), output, compression='zstd')
+    elif extension == '.csv':
+        pacsv.write_csv(combined_table(results), output)
+    else:
+        raise ValueError(f"Unknown output format '{extension}'. Use .csv, .parquet or .xlsx.")
+
+# ==========================
+# 5. Main Execution Flow
+# ==========================
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the NA Trend Report history in the trend store.")
+    parser.add_argument('--store', default=STORE_DIRNAME, help="Store directory (default: trend_store)")
+    parser.add_argument('--sheet', action='append', dest='sheets', help="Sheet to query; repeat for several (default: all)")
+    parser.add_argument('--from', dest='start', help="First date, e.g. 2024-07-01")
+    parser.add_argument('--to', dest='end', help="Last date")
+    parser.add_argument('--last-days', type=int, help="The last N days held by the store")
+    parser.add_argument('--where', action='append', default=[],
+                        help="Predicate 'column<op>value' with op one of = != >= <= > <; repeat to combine")
+    parser.add_argument('--columns', help="Comma-separated columns to return (default: all)")
+    parser.add_argument('--limit', type=int, help="At most this many rows per sheet")
+    parser.add_argument('--summary', action='store_true', help="Query the daily rollups instead of the rows")
+    parser.add_argument('-o', '--output', help="Output file (.csv, .parquet or .xlsx); default: CSV on stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename='data_processing.log',
+        filemode='a',  # Queries add to the log of the last run
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    started = time.perf_counter()
+    try:
+        results = query(
+            os.path.join(os.getcwd(), args.store),
+            sheets=args.sheets,
+            predicates=args.where,
+            start=args.start,
+            end=args.end,
+            last_days=args.last_days,
+            columns=[c.strip() for c in args.columns.split(',')] if args.columns else None,
+            limit=args.limit,
+            summary=args.summary,
+        )
+        write_results(results, args.output)
+    except ValueError as e:
+        sys.exit(str(e))
+    rows = sum(t.num_rows for t in results.values())
+    message = f"{rows} rows from {len(results)} sheets in {time.perf_counter() - started:.3f}s"
+    if args.output:
+        print(f"Saved {message} to '{args.output}'.")
+    else:
+        print(message, file=sys.stderr)
+    logging.info(message)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Single-pass rollover planner for the Excel row limit.
+
+When the new rows of a run would not fit into a sheet, the oldest days have
+to go. Instead of repeatedly finding the minimum date and re-filtering the
+whole sheet one day at a time, plan_rollover() takes the per-date row counts
+once, picks the exact cutoff that makes room for the incoming rows, and the
+caller applies a single filter (or drops whole partitions) afterwards.
+
+Usage:
+    plan = plan_rollover(date_histogram(df[date_column]), len(df), len(new_df))
+    print(describe_plan(plan))
+    df = apply_plan(df, date_column, plan)
+"""
+
+import numpy as np
+import pandas as pd
+
+EXCEL_ROW_LIMIT = 1048576  # Includes the header row
+
+def date_histogram(dates):
+    """
+    Returns the number of rows per date of a date column, oldest date first.
+    Rows without a date are not counted: they are never rolled over.
+    """
+    return pd.Series(dates).value_counts(dropna=True).sort_index()
+
+def plan_rollover(day_counts, existing_rows, new_rows, row_limit=EXCEL_ROW_LIMIT - 1):
+    """
+    Works out which oldest days have to be dropped so that ``new_rows`` more
+    rows fit under ``row_limit``.
+
+    Parameters:
+        day_counts (pd.Series or dict): Rows per date, oldest date first.
+        existing_rows (int): Rows in the sheet, including undated rows.
+        new_rows (int): Rows about to be appended.
+        row_limit (int): Maximum number of data rows (Excel's limit minus the header).
+
+    Returns:
+        plan (dict): 'days_dropped' (list of dates, oldest first),
+            'rows_dropped', 'rows_appended', 'rows_after' and 'fits'
+            (False when even dropping every dated row leaves too little room).
+    """
+    day_counts = pd.Series(day_counts, dtype='int64')
+    excess = existing_rows + new_rows - row_limit
+    if excess <= 0:
+        drop = 0
+    else:
+        # First position where the cumulative drop covers the excess
+        drop = int(np.searchsorted(day_counts.cumsum().to_numpy(), excess)) + 1
+        drop = min(drop, len(day_counts))
+    rows_dropped = int(day_counts.iloc[:drop].sum())
+    rows_after = existing_rows - rows_dropped + new_rows
+    return {
+        'days_dropped': list(day_counts.index[:drop]),
+        'rows_dropped': rows_dropped,
+        'rows_appended': new_rows,
+        'rows_after': rows_after,
+        'fits': rows_after <= row_limit,
+    }
+
+def describe_plan(plan, date_format='%m/%d/%Y'):
+    """
+    Returns a one-line summary of a rollover plan for the console and log.
+    """
+    days = plan['days_dropped']
+    if not days:
+        dropped = "no days dropped"
+    elif len(days) == 1:
+        dropped = f"1 day dropped ({pd.Timestamp(days[0]).strftime(date_format)})"
+    else:
+        dropped = (
+            f"{len(days)} days dropped ({pd.Timestamp(days[0]).strftime(date_format)}"
+            f" to {pd.Timestamp(days[-1]).strftime(date_format)})"
+        )
+    return (
+        f"Rollover plan: {dropped}, {plan['rows_dropped']} rows dropped, "
+        f"{plan['rows_appended']} rows appended, {plan['rows_after']} rows after."
+    )
+
+def apply_plan(df, date_column, plan):
+    """
+    Removes the planned days from a DataFrame with a single filter.
+    Rows without a date are kept.
+    """
+    if not plan['days_dropped']:
+        return df
+    return df[~(df[date_column] <= plan['days_dropped'][-1])]
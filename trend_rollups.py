@@ -0,0 +1,185 @@
+"""
+Daily rollups of the QDS sheets.
+
+Readers of the NA Trend Report want per-date counts for each QDS bucket
+(above or below 70, crossed or under 40 days) per application, which used to
+come from pivots recalculated over a million rows. daily_rollup() aggregates
+the rows of one or more dates into one row per date and application:
+
+    Date | QDS Band | Age | Application | Findings | Avg QDS | Max QDS
+
+The grouped and averaged columns default to 'Application' and 'QDS' and can
+be set per call (trend_store.py --summary-group / --summary-score); the
+rollup's columns are named after them.
+
+A sheet's rollup only changes for the dates that were appended or dropped,
+so sync_rollup() recomputes just the dates whose row count differs from the
+sheet's partition counts and removes the dates that are gone; every other
+date is kept as is. summary_table() combines the sheets' rollups into the
+small summary sheet the trend charts read.
+
+Usage:
+    rollup = sync_rollup(rollup, partition_counts, load_partition, sheet_name)
+    writer.write_sheet(SUMMARY_SHEET_NAME, summary_table({sheet: rollup}))
+"""
+
+import logging
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from qds_schema import parse_numbers
+
+SUMMARY_SHEET_NAME = 'QDS Daily Summary'
+
+# Rows are grouped by date and this column, and this column's numbers are averaged
+GROUP_COLUMN = 'Application'
+SCORE_COLUMN = 'QDS'
+ROLLUP_COLUMNS = (GROUP_COLUMN, SCORE_COLUMN)
+
+# QDS band and age of each sheet's findings
+SHEET_BUCKETS = {
+    'QDS above 70 G40': ('Above 70', 'Crossed 40d'),
+    'QDS below 70 G40': ('Below 70', 'Crossed 40d'),
+    'QDS below 70 L40': ('Below 70', 'Less than 40d'),
+    'QDS above 70 L40': ('Above 70', 'Less than 40d'),
+}
+
+def rollup_schema(columns=ROLLUP_COLUMNS):
+    """
+    Returns the schema of a rollup grouped and averaged by ``columns``
+    (group column, score column).
+    """
+    group_column, score_column = columns
+    return pa.schema([
+        ('Date', pa.date32()),
+        ('QDS Band', pa.string()),
+        ('Age', pa.string()),
+        (group_column, pa.string()),
+        ('Findings', pa.int64()),
+        (f'Avg {score_column}', pa.float64()),
+        (f'Max {score_column}', pa.float64()),
+    ])
+
+ROLLUP_SCHEMA = rollup_schema()
+
+# ==========================
+# 1. Aggregation
+# ==========================
+
+def _column(table, name, fallback_type):
+    if name in table.column_names[1:]:
+        return table.column(name)
+    return pa.nulls(table.num_rows, type=fallback_type)
+
+def missing_columns(sheet_columns, columns=ROLLUP_COLUMNS):
+    """
+    Returns the rollup columns a sheet does not have; their rollup values stay empty.
+    """
+    return [c for c in columns if c not in sheet_columns[1:]]
+
+def daily_rollup(table, sheet_name, columns=ROLLUP_COLUMNS):
+    """
+    Aggregates sheet rows into one row per date and group (application).
+    Rows without a date are left out.
+
+    Parameters:
+        table (pa.Table): Sheet rows; the first column is the date.
+        sheet_name (str): The sheet, which determines the QDS band and age.
+        columns (tuple): The group and score columns.
+
+    Returns:
+        rollup (pa.Table): Rows in rollup_schema(columns), sorted by date and group.
+    """
+    group_column, score_column = columns
+    band, age = SHEET_BUCKETS.get(sheet_name, (sheet_name, None))
+    dates = pc.cast(table.column(0), pa.date32())
+    groups = _column(table, group_column, pa.string())
+    if pa.types.is_dictionary(groups.type):
+        groups = groups.cast(pa.string())
+    scores, _ = parse_numbers(_column(table, score_column, pa.string()))
+    grouped = pa.table({
+        'Date': dates,
+        'group': pc.cast(groups, pa.string()),
+        'score': scores,
+    }).filter(pc.is_valid(dates)).group_by(['Date', 'group']).aggregate([
+        ([], 'count_all'),
+        ('score', 'mean'),
+        ('score', 'max'),
+    ])
+    rows = grouped.num_rows
+    rollup = pa.Table.from_arrays([
+        grouped['Date'],
+        pa.array([band] * rows, pa.string()),
+        pa.array([age] * rows, pa.string()),
+        grouped['group'],
+        grouped['count_all'],
+        grouped['score_mean'],
+        grouped['score_max'],
+    ], schema=rollup_schema(columns))
+    return rollup.sort_by([('Date', 'ascending'), (group_column, 'ascending')])
+
+def rollup_counts(rollup):
+    """
+    Returns {date: findings} of a rollup.
+    """
+    if rollup.num_rows == 0:
+        return {}
+    totals = rollup.group_by('Date').aggregate([('Findings', 'sum')])
+    return dict(zip(totals['Date'].to_pylist(), totals['Findings_sum'].to_pylist()))
+
+# ==========================
+# 2. Incremental Maintenance
+# ==========================
+
+def sync_rollup(rollup, partition_counts, load_partition, sheet_name, columns=ROLLUP_COLUMNS):
+    """
+    Brings a sheet's rollup in line with its date partitions, touching only
+    the dates that changed: dates no longer in the sheet are removed, and
+    dates that are new or whose row count changed are aggregated again from
+    their partition.
+
+    Parameters:
+        rollup (pa.Table): The current rollup, or None if there is none yet.
+        partition_counts (dict): {date: rows} of the sheet's dated partitions.
+        load_partition (callable): Returns the rows of one date as an Arrow table.
+        sheet_name (str): The sheet.
+        columns (tuple): The group and score columns. A rollup built for
+            other columns is built again.
+
+    Returns:
+        rollup (pa.Table): The updated rollup.
+        changed (list): The dates that were removed or aggregated again.
+    """
+    schema = rollup_schema(columns)
+    if rollup is None or rollup.schema != schema:
+        rollup = schema.empty_table()
+    counts = rollup_counts(rollup)
+    stale = [d for d in counts if partition_counts.get(d) != counts[d]]
+    missing = [d for d in partition_counts if d not in counts and partition_counts[d]]
+    if not stale and not missing:
+        return rollup, []
+
+    if stale:
+        rollup = rollup.filter(pc.invert(pc.is_in(rollup['Date'], value_set=pa.array(stale, pa.date32()))))
+    added = [daily_rollup(load_partition(d), sheet_name, columns)
+             for d in sorted(set(stale + missing)) if d in partition_counts]
+    rollup = pa.concat_tables([rollup] + added)
+    rollup = rollup.sort_by([('Date', 'ascending'), (columns[0], 'ascending')])
+    changed = sorted(set(stale + missing))
+    logging.info(f"Rollup of sheet '{sheet_name}': {len(changed)} dates updated, {len(counts) - len(stale)} kept.")
+    return rollup, changed
+
+def summary_table(rollups):
+    """
+    Combines the sheets' rollups into the summary sheet, ordered by date, band, age and group.
+
+    Parameters:
+        rollups (dict): {sheet name: rollup table}.
+    """
+    tables = [t for t in rollups.values() if t is not None]
+    if not tables:
+        return ROLLUP_SCHEMA.empty_table()
+    summary = pa.concat_tables(tables)
+    return summary.sort_by([('Date', 'ascending'), ('QDS Band', 'ascending'),
+                            ('Age', 'ascending'), (summary.schema.field(3).name, 'ascending')])
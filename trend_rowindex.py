@@ -0,0 +1,242 @@
+"""
+Persistent row-hash index for incremental duplicate removal.
+
+The trend scripts used to call df.drop_duplicates() over the whole sheet on
+every run, rehashing about a million history rows that were already
+deduplicated the day before. RowHashIndex keeps one 64-bit hash per sheet row
+(with the row's date) in ``<report>.rowindex/<sheet>.parquet`` next to the
+workbook. Each run drops the hashes of the deleted oldest days and checks only
+the newly appended rows against the index, so the cost of deduplication grows
+with the daily delta instead of with the history.
+
+Rows are hashed from a canonical text form of every cell: integral floats and
+ints hash alike, and dates/timestamps hash alike regardless of resolution, so
+a sheet read from the workbook and a CSV read with pandas agree on equal rows.
+
+Usage:
+    row_index = RowHashIndex.load(index_dir, sheet, excel_path, rows=len(df))
+    if row_index is None:
+        df, row_index = RowHashIndex.build(df, date_column)
+    new_df = row_index.drop_known(new_df, date_column)
+    row_index.drop_before(df[date_column].min())
+    row_index.save(index_dir, sheet)
+    ...write the workbook...
+    commit_row_indexes(index_dir, final_excel_path, {sheet: len(row_index)})
+
+The index of a sheet is only trusted while the sheet's content and row count
+match what was recorded by commit_row_indexes(): the CRC-32 and size of the
+zip parts the sheet is built from, as the conversion cache keys sheets
+(xlsx_cache.py). A workbook edited in place, even to the same size, has the
+edited sheet deduplicated in full once and its index rebuilt.
+"""
+
+import os
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from xlsx_stream import WorkbookReader, pandas_to_batch
+from trend_dates import normalise_date_series
+
+ROW_INDEX_SUFFIX = '.rowindex'
+INDEX_STATE_FILENAME = 'index.json'
+STAGED_SUFFIX = '.new'
+
+# Multiplier used to fold per-column hashes into one row hash
+HASH_MULTIPLIER = np.uint64(1000003)
+
+# ==========================
+# 1. Row Hashing
+# ==========================
+
+def row_index_dir(excel_path):
+    """
+    Returns the index directory kept next to a report, e.g. 'NA Trend Report.rowindex'.
+    """
+    return f"{os.path.splitext(excel_path)[0]}{ROW_INDEX_SUFFIX}"
+
+def canonical_column(array):
+    """
+    Casts an Arrow column to the text form rows are hashed from.
+    Temporal values are brought to one resolution first, so a date read from
+    the workbook and the same date parsed from a CSV produce the same text.
+    """
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    if pa.types.is_temporal(array.type) and not pa.types.is_time(array.type):
+        array = pc.cast(array, pa.timestamp('ms'), safe=False)
+    return pc.cast(array, pa.string())
+
+def row_hashes(df):
+    """
+    Returns one uint64 hash per row of a DataFrame.
+    Each column is dictionary-encoded so every distinct value is hashed once;
+    the per-column hashes are then folded together positionally.
+    """
+    batch = pandas_to_batch(df)
+    hashes = np.zeros(batch.num_rows, dtype=np.uint64)
+    for column in batch.columns:
+        encoded = canonical_column(column).dictionary_encode(null_encoding='encode')
+        value_hashes = pd.util.hash_array(encoded.dictionary.to_numpy(zero_copy_only=False))
+        hashes = (hashes * HASH_MULTIPLIER) ^ value_hashes[encoded.indices.to_numpy(zero_copy_only=False)]
+    return hashes
+
+def date_values(df, date_column):
+    """
+    Returns a sheet's date column as datetime64[ns] values (NaT for non-dates).
+    """
+    return normalise_date_series(df[date_column]).to_numpy(dtype='datetime64[ns]')
+
+# ==========================
+# 2. Index
+# ==========================
+
+class RowHashIndex:
+    """
+    The row hashes of one sheet, with the date of every row so the hashes of
+    deleted days can be dropped without looking at the sheet again.
+    """
+
+    def __init__(self, dates, hashes):
+        self.dates = dates
+        self.hashes = hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @classmethod
+    def empty(cls):
+        """
+        Returns an index without rows. Feeding a sheet to drop_known() chunk by
+        chunk builds its index the same way build() does in one go.
+        """
+        return cls(np.empty(0, dtype='datetime64[ns]'), np.empty(0, dtype=np.uint64))
+
+    @classmethod
+    def build(cls, df, date_column):
+        """
+        Deduplicates a whole sheet and builds its index. This is the full-cost
+        path, used when there is no valid index for the workbook yet.
+
+        Returns:
+            df (pd.DataFrame): The sheet without duplicate rows.
+            index (RowHashIndex): The index of the remaining rows.
+        """
+        hashes = row_hashes(df)
+        keep = ~pd.Series(hashes).duplicated().to_numpy()
+        if not keep.all():
+            df = df[keep]
+        return df, cls(date_values(df, date_column), hashes[keep])
+
+    @classmethod
+    def load(cls, index_dir, sheet_name, excel_path, rows):
+        """
+        Loads the index of one sheet, or returns None if it does not describe
+        this workbook (sheet content or row count changed, or no index at all).
+        """
+        state_path = os.path.join(index_dir, INDEX_STATE_FILENAME)
+        index_path = os.path.join(index_dir, f"{sheet_name}.parquet")
+        if not (os.path.isfile(state_path) and os.path.isfile(index_path)):
+            return None
+        with open(state_path, encoding='utf-8') as fh:
+            state = json.load(fh)
+        with WorkbookReader(excel_path) as reader:
+            fingerprint = reader.sheet_fingerprint(sheet_name) if sheet_name in reader.sheet_names else None
+        if fingerprint is None or state.get('fingerprints', {}).get(sheet_name) != fingerprint:
+            logging.info(f"Row index of sheet '{sheet_name}' was written for another version of the sheet. Rebuilding.")
+            return None
+        if state['sheets'].get(sheet_name) != rows:
+            logging.info(f"Row index of sheet '{sheet_name}' does not match its {rows} rows. Rebuilding.")
+            return None
+        table = pq.read_table(index_path)
+        if table.num_rows != rows:
+            return None
+        return cls.from_table(table)
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Rebuilds an index from the table written by to_table().
+        """
+        return cls(
+            table['date'].to_numpy().astype('datetime64[ns]'),
+            table['hash'].to_numpy(),
+        )
+
+    def to_table(self):
+        """
+        Returns the index as an Arrow table of (date, hash) rows.
+        """
+        return pa.table({
+            'date': pa.array(self.dates, type=pa.timestamp('ns')),
+            'hash': pa.array(self.hashes, type=pa.uint64()),
+        })
+
+    def drop_before(self, oldest_kept):
+        """
+        Drops the hashes of rows dated before ``oldest_kept`` (the oldest date
+        still in the sheet). Rows without a date are never deleted from the
+        sheet, so their hashes are kept.
+        """
+        if pd.isna(oldest_kept):
+            return
+        keep = ~(self.dates < np.datetime64(pd.Timestamp(oldest_kept), 'ns'))
+        if not keep.all():
+            self.dates = self.dates[keep]
+            self.hashes = self.hashes[keep]
+
+    def drop_known(self, new_df, date_column):
+        """
+        Removes rows of ``new_df`` that are already in the sheet or repeat an
+        earlier row of ``new_df``, and adds the remaining rows to the index.
+        Only the new rows are hashed.
+
+        Returns:
+            new_df (pd.DataFrame): The rows to append.
+        """
+        hashes = row_hashes(new_df)
+        keep = ~(np.isin(hashes, self.hashes) | pd.Series(hashes).duplicated().to_numpy())
+        if not keep.all():
+            new_df = new_df[keep]
+        self.dates = np.concatenate([self.dates, date_values(new_df, date_column)])
+        self.hashes = np.concatenate([self.hashes, hashes[keep]])
+        return new_df
+
+    def save(self, index_dir, sheet_name):
+        """
+        Stages the index of one sheet. It only replaces the current index file
+        when commit_row_indexes() runs after the workbook has been written.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        pq.write_table(self.to_table(), os.path.join(index_dir, f"{sheet_name}.parquet{STAGED_SUFFIX}"))
+
+# ==========================
+# 3. Commit
+# ==========================
+
+def commit_row_indexes(index_dir, excel_path, sheet_rows):
+    """
+    Moves the staged sheet indexes into place and records the workbook they
+    describe. Call this only after the workbook has been written successfully.
+
+    Parameters:
+        index_dir (str): Index directory from row_index_dir().
+        excel_path (str): The workbook that was just written.
+        sheet_rows (dict): {sheet name: row count} of the written sheets.
+    """
+    for sheet_name in sheet_rows:
+        staged_path = os.path.join(index_dir, f"{sheet_name}.parquet{STAGED_SUFFIX}")
+        if os.path.isfile(staged_path):
+            os.replace(staged_path, os.path.join(index_dir, f"{sheet_name}.parquet"))
+    with WorkbookReader(excel_path) as reader:
+        fingerprints = {s: reader.sheet_fingerprint(s) for s in sheet_rows if s in reader.sheet_names}
+    state = {'fingerprints': fingerprints, 'sheets': sheet_rows}
+    tmp_path = os.path.join(index_dir, f"{INDEX_STATE_FILENAME}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        json.dump(state, fh, indent=2)
+    os.replace(tmp_path, os.path.join(index_dir, INDEX_STATE_FILENAME))
@@ -0,0 +1,855 @@
+"""
+Persistent Parquet history store for the NA Trend Report.
+
+The four QDS sheets are kept as date-partitioned Parquet files under
+``trend_store/`` and become the source of truth: the nightly oldest-date
+rollover and the QDS-*.csv append run against the store, and
+``NA Trend Report.xlsx`` is only produced as an export at the end of the run.
+Each sheet also keeps its daily rollup (findings per date and application,
+see trend_rollups.py), updated for the changed dates only and exported as
+the 'QDS Daily Summary' sheet. After each run the newest day is compared
+with the day before across all four sheets, and the findings that are new,
+resolved or moved to another aging bucket are written to
+``trend_store/_transitions/`` (see trend_transitions.py).
+
+Usage:
+    python trend_store.py import    # seed the store once from NA Trend Report.xlsx
+    python trend_store.py run       # rollover + append QDS-*.csv, then export
+    python trend_store.py export    # export the current store to a new workbook
+    python trend_store.py watch     # ingest each export as it lands, export when all sheets are in
+    python trend_store.py transitions   # compare the newest day with the day before
+"""
+
+import sys
+import subprocess
+import importlib
+import os
+import glob
+import json
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, date
+import shutil
+from tqdm import tqdm
+import gc  # For garbage collection
+
+# ==========================
+# 1. Setup and Dependencies
+# ==========================
+
+# List of required packages
+required_packages = [
+    'pandas',
+    'pyarrow',
+    'tqdm'
+]
+
+# Function to install missing packages
+def install_packages(packages):
+    for package in packages:
+        try:
+            importlib.import_module(package)
+        except ImportError:
+            print(f"Package '{package}' not found. Installing...")
+            subprocess.check_call([sys.executable, "-m", "pip", "install", package])
+
+# Install missing packages
+install_packages(required_packages)
+
+# Now import the installed packages
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from xlsx_stream import StreamingWorkbookWriter, WorkbookReader, read_workbook
+from trend_rollover import plan_rollover, describe_plan
+from qds_schema import read_export
+from trend_telemetry import RunTelemetry, stage, collect_stages, add_stages, active_profile, PROFILERS
+from trend_dates import normalise_dates
+from trend_journal import file_fingerprint
+from trend_watch import DropFolder, SETTLE_SECONDS, POLL_INTERVAL
+from trend_rollups import (sync_rollup, summary_table, missing_columns, SUMMARY_SHEET_NAME,
+                           GROUP_COLUMN, SCORE_COLUMN, ROLLUP_COLUMNS)
+from trend_transitions import keyed_findings, compare_days, describe_counts, DEFAULT_KEY
+
+# Mapping of CSV filename patterns to sheet names
+pattern_to_sheet = {
+    'QDS-above-70-crossed-40d': 'QDS above 70 G40',
+    'QDS-0-69-crossed-40d': 'QDS below 70 G40',
+    'QDS-0-69-less-40d': 'QDS below 70 L40',
+    'QDS-above-70-less-40d': 'QDS above 70 L40',
+}
+sheets_to_process = list(pattern_to_sheet.values())
+
+EXCEL_FILENAME = 'NA Trend Report.xlsx'
+STORE_DIRNAME = 'trend_store'
+EXCEL_ROW_LIMIT = 1048576  # Includes the header row
+
+# ==========================
+# 2. Store Layout
+# ==========================
+#
+# trend_store/
+#     manifest.json                 sheet order
+#     QDS above 70 G40/
+#         _sheet.json               columns and per-date row counts of this sheet,
+#                                   the night it was last rolled over and the
+#                                   exports ingested since
+#         _rollup.parquet           findings per date and application
+#         2024-01-02.parquet        one partition per first-column date
+#         2024-01-03.parquet
+#         undated.parquet           rows whose date could not be parsed
+#     _transitions/
+#         2024-01-03.parquet        findings new, resolved or moved on that day
+#         2024-01-03.json           their counts
+#
+# Dropping the oldest day removes one file and appending a day writes one file,
+# so neither operation depends on how much history the store holds. Each sheet
+# keeps its own entry file, so the sheets can be rolled by separate processes
+# without any of them rewriting another sheet's bookkeeping.
+
+UNDATED_PARTITION = 'undated'
+SHEET_ENTRY_FILENAME = '_sheet.json'
+ROLLUP_FILENAME = '_rollup.parquet'
+TRANSITIONS_DIRNAME = '_transitions'
+
+def sheet_dir(store_dir, sheet_name):
+    """
+    Returns the directory holding the date partitions of one sheet.
+    """
+    return os.path.join(store_dir, sheet_name)
+
+def partition_path(store_dir, sheet_name, key):
+    """
+    Returns the Parquet file of one date partition ('YYYY-MM-DD' or 'undated').
+    """
+    return os.path.join(sheet_dir(store_dir, sheet_name), f"{key}.parquet")
+
+def _write_json(path, data):
+    """
+    Atomically writes a JSON file through a temporary file and os.replace().
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        json.dump(data, fh, indent=2)
+    os.replace(tmp_path, path)
+
+def write_sheet_entry(store_dir, sheet_name, entry):
+    """
+    Atomically writes the manifest entry (columns and partition row counts) of
+    one sheet. This is the only bookkeeping a sheet's rollover touches.
+    """
+    os.makedirs(sheet_dir(store_dir, sheet_name), exist_ok=True)
+    _write_json(os.path.join(sheet_dir(store_dir, sheet_name), SHEET_ENTRY_FILENAME), entry)
+
+def write_manifest(store_dir, manifest):
+    """
+    Atomically writes the store manifest.
+    The manifest records the sheet order, column order and the row count of
+    every date partition, so row-limit checks never need to open a data file.
+    Sheet entries are written first, then the sheet order in manifest.json.
+    """
+    for sheet_name, entry in manifest['sheets'].items():
+        write_sheet_entry(store_dir, sheet_name, entry)
+    manifest['updated'] = datetime.now().isoformat(timespec='seconds')
+    _write_json(
+        os.path.join(store_dir, 'manifest.json'),
+        {'updated': manifest['updated'], 'sheets': list(manifest['sheets'])},
+    )
+
+def read_manifest(store_dir):
+    """
+    Returns the store manifest as {'updated': ..., 'sheets': {sheet: entry}},
+    or None if the store has not been seeded.
+    """
+    manifest_path = os.path.join(store_dir, 'manifest.json')
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, encoding='utf-8') as fh:
+        manifest = json.load(fh)
+    if isinstance(manifest['sheets'], dict):
+        # Stores seeded before the per-sheet entry files keep everything inline
+        return manifest
+    sheets = {}
+    for sheet_name in manifest['sheets']:
+        with open(os.path.join(sheet_dir(store_dir, sheet_name), SHEET_ENTRY_FILENAME), encoding='utf-8') as fh:
+            sheets[sheet_name] = json.load(fh)
+    manifest['sheets'] = sheets
+    return manifest
+
+def sheet_schema(columns):
+    """
+    Returns the Arrow schema of a sheet: a date32 first column, strings after.
+    """
+    return pa.schema([(columns[0], pa.date32())] + [(c, pa.string()) for c in columns[1:]])
+
+def dated_partitions(entry):
+    """
+    Returns the date partition keys of a manifest entry, oldest first.
+    """
+    return sorted(k for k in entry['partitions'] if k != UNDATED_PARTITION)
+
+def sheet_row_count(entry):
+    """
+    Returns the total number of data rows of a sheet from its manifest entry.
+    """
+    return sum(entry['partitions'].values())
+
+def load_partition(store_dir, sheet_name, key):
+    """
+    Loads one date partition as an Arrow table.
+    """
+    return pq.read_table(partition_path(store_dir, sheet_name, key))
+
+def iter_sheet_partitions(store_dir, sheet_name, entry):
+    """
+    Yields a sheet's partitions one at a time, oldest date first and undated rows last.
+    """
+    keys = dated_partitions(entry)
+    if UNDATED_PARTITION in entry['partitions']:
+        keys.append(UNDATED_PARTITION)
+    for key in keys:
+        yield load_partition(store_dir, sheet_name, key)
+
+def load_sheet(store_dir, sheet_name, entry):
+    """
+    Loads a sheet's full history as a single Arrow table.
+    """
+    tables = list(iter_sheet_partitions(store_dir, sheet_name, entry))
+    if not tables:
+        return sheet_schema(entry['columns']).empty_table()
+    return pa.concat_tables(tables)
+
+def save_partition(store_dir, sheet_name, key, table):
+    """
+    Atomically writes one date partition.
+    The table is written to a temporary file first so a crash can never leave
+    a truncated Parquet file behind.
+    """
+    os.makedirs(sheet_dir(store_dir, sheet_name), exist_ok=True)
+    final_path = partition_path(store_dir, sheet_name, key)
+    tmp_path = f"{final_path}.tmp"
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, final_path)
+
+def drop_partition(store_dir, manifest, sheet_name, key):
+    """
+    Removes one date partition from the store and returns its row count.
+    The manifest is updated before the file is deleted, so an interrupted drop
+    leaves at worst an orphaned file rather than a dangling manifest entry.
+    """
+    entry = manifest['sheets'][sheet_name]
+    rows = entry['partitions'].pop(key)
+    write_sheet_entry(store_dir, sheet_name, entry)
+    os.remove(partition_path(store_dir, sheet_name, key))
+    return rows
+
+def split_by_date(table):
+    """
+    Splits a table into per-date tables keyed by 'YYYY-MM-DD' (or 'undated').
+    Uses one stable sort and contiguous slices instead of one filter per date.
+    """
+    date_column = table.column_names[0]
+    table = table.sort_by([(date_column, 'ascending')])  # Nulls sort last
+    counts = pc.value_counts(table[date_column])
+    runs = sorted(
+        ((v.as_py(), n.as_py()) for v, n in zip(counts.field('values'), counts.field('counts'))),
+        key=lambda run: (run[0] is None, run[0]),
+    )
+    parts = {}
+    offset = 0
+    for value, rows in runs:
+        key = UNDATED_PARTITION if value is None else value.isoformat()
+        parts[key] = table.slice(offset, rows)
+        offset += rows
+    return parts
+
+# ==========================
+# 3. Type Normalisation
+# ==========================
+
+def to_date_array(values):
+    """
+    Converts a pandas Series or Arrow array of dates/strings to an Arrow date32 array
+    with the shared date normalisation (see trend_dates.py): real Excel dates are
+    kept as is, each distinct text value is parsed once by its shape, and values
+    that are not dates become nulls and are reported.
+    """
+    return normalise_dates(values)
+
+def normalise_frame(df):
+    """
+    Converts a sheet or CSV DataFrame into the store's canonical Arrow layout:
+    the first column as date32 and every other column as nullable strings.
+    """
+    arrays = [to_date_array(df.iloc[:, 0])]
+    for i in range(1, df.shape[1]):
+        arrays.append(pa.array(df.iloc[:, i].astype('string'), type=pa.string(), from_pandas=True))
+    return pa.Table.from_arrays(arrays, names=[str(c) for c in df.columns])
+
+def normalise_table(table):
+    """
+    Arrow counterpart of normalise_frame() for sheets read with WorkbookReader.
+    """
+    arrays = [to_date_array(table.column(0))]
+    arrays += [pc.cast(table.column(i), pa.string()) for i in range(1, table.num_columns)]
+    return pa.Table.from_arrays(arrays, names=table.column_names)
+
+def align_to_columns(table, columns):
+    """
+    Aligns a new table to the store's column order.
+    The first column is always the date column regardless of its header;
+    other missing columns are filled with nulls and extra columns are dropped.
+    """
+    table = table.rename_columns([columns[0]] + table.column_names[1:])
+    arrays = []
+    for col in columns:
+        if col in table.column_names:
+            arrays.append(table[col])
+        else:
+            logging.warning(f"Column '{col}' missing in new data. Filled with nulls.")
+            arrays.append(pa.nulls(table.num_rows, type=pa.string()))
+    extra = set(table.column_names) - set(columns)
+    if extra:
+        logging.warning(f"Dropping columns not present in the store: {sorted(extra)}")
+    return pa.Table.from_arrays(arrays, names=columns)
+
+# ==========================
+# 4. Rollover and Append
+# ==========================
+
+def drop_duplicate_rows(table):
+    """
+    Removes duplicate rows from a single partition.
+    Rows of different dates can never be duplicates, so deduplicating each
+    partition on its own is equivalent to deduplicating the whole sheet.
+    """
+    df = table.to_pandas().drop_duplicates()
+    return pa.Table.from_pandas(df, preserve_index=False).cast(table.schema)
+
+def drop_oldest_date(store_dir, manifest, sheet_name):
+    """
+    Removes the partition holding the oldest date of a sheet.
+
+    Returns:
+        oldest_date (str): The date that was removed, or None.
+        rows_deleted (int): Number of rows removed.
+    """
+    keys = dated_partitions(manifest['sheets'][sheet_name])
+    if not keys:
+        return None, 0
+    return keys[0], drop_partition(store_dir, manifest, sheet_name, keys[0])
+
+def append_rows(store_dir, manifest, sheet_name, new_table, row_limit=EXCEL_ROW_LIMIT - 1):
+    """
+    Appends new rows to a sheet, one partition write per date. If the result
+    would not fit into an Excel sheet, further oldest dates are dropped first;
+    how many is planned up front from the manifest's partition row counts.
+
+    Returns:
+        rows_appended (int): Number of new rows kept after deduplication.
+    """
+    entry = manifest['sheets'][sheet_name]
+    # The partition row counts are the per-date histogram; plan the cutoff once
+    plan = plan_rollover(
+        {key: entry['partitions'][key] for key in dated_partitions(entry)},
+        sheet_row_count(entry),
+        new_table.num_rows,
+        row_limit=row_limit,
+    )
+    if plan['days_dropped']:
+        print(f"Sheet '{sheet_name}': {describe_plan(plan)}")
+        logging.info(f"Sheet '{sheet_name}': {describe_plan(plan)}")
+        for key in plan['days_dropped']:
+            drop_partition(store_dir, manifest, sheet_name, key)
+        print(f"Deleted {plan['rows_dropped']} rows with {len(plan['days_dropped'])} oldest dates to make space.")
+        logging.info(f"Deleted {plan['rows_dropped']} rows with {len(plan['days_dropped'])} oldest dates to make space.")
+    if not plan['fits']:
+        logging.error("No valid dates to delete. Cannot append more data.")
+
+    rows_appended = 0
+    schema = sheet_schema(entry['columns'])
+    for key, part in split_by_date(new_table.cast(schema)).items():
+        existing_rows = entry['partitions'].get(key, 0)
+        if existing_rows:
+            # Re-running a day only touches that day's partition
+            part = pa.concat_tables([load_partition(store_dir, sheet_name, key), part])
+        part = drop_duplicate_rows(part)
+        save_partition(store_dir, sheet_name, key, part)
+        entry['partitions'][key] = part.num_rows
+        rows_appended += part.num_rows - existing_rows
+    write_sheet_entry(store_dir, sheet_name, entry)
+    return rows_appended
+
+def find_sheet_csvs(csv_dir, sheet_name):
+    """
+    Returns the QDS-*.csv exports in ``csv_dir`` that belong to a sheet.
+    """
+    patterns = [p for p, s in pattern_to_sheet.items() if s == sheet_name]
+    return sorted(
+        f for f in glob.glob(os.path.join(csv_dir, '*.csv'))
+        if any(p in os.path.basename(f) for p in patterns)
+    )
+
+def read_new_csv(csv_path, columns):
+    """
+    Reads a QDS export, raw or prepared by delcsv.py, and aligns it to the store columns.
+    The declared column types are applied while parsing, so dates and numbers
+    are normalised the same way as the imported sheet cells before they are
+    stored as text.
+    """
+    return align_to_columns(normalise_table(read_export(csv_path)), columns)
+
+def rollover_sheet(store_dir, manifest, sheet_name, night=None):
+    """
+    Drops the oldest date partition of a sheet and records the night it was
+    rolled over for. Both are written in the same entry update, so a crash
+    never drops a second day for the same night.
+    """
+    entry = manifest['sheets'][sheet_name]
+    entry['rolled_on'] = night or date.today().isoformat()
+    with stage('rollover', sheet=sheet_name, rows_in=sheet_row_count(entry)) as st:
+        oldest_date, rows_deleted = drop_oldest_date(store_dir, manifest, sheet_name)
+        st.rows_out = sheet_row_count(entry)
+    if oldest_date is None:
+        write_sheet_entry(store_dir, sheet_name, entry)
+        print(f"No valid dates found in sheet '{sheet_name}'. No rows deleted.")
+        logging.warning(f"No valid dates found in sheet '{sheet_name}'. No rows deleted.")
+    else:
+        print(f"Deleted {rows_deleted} rows with the oldest date '{oldest_date}' from sheet '{sheet_name}'.")
+        logging.info(f"Deleted {rows_deleted} rows with the oldest date '{oldest_date}' from sheet '{sheet_name}'.")
+
+def append_csv(store_dir, manifest, sheet_name, csv_path):
+    """
+    Appends one QDS export to a sheet and records it as ingested.
+
+    Returns:
+        rows_appended (int): Number of new rows kept after deduplication.
+    """
+    entry = manifest['sheets'][sheet_name]
+    with stage('read CSVs', sheet=sheet_name) as st:
+        new_table = read_new_csv(csv_path, entry['columns'])
+        st.rows_out = new_table.num_rows
+    # Duplicates are dropped per date partition while appending
+    with stage('append', sheet=sheet_name, rows_in=new_table.num_rows) as st:
+        entry.setdefault('ingested', {})[os.path.basename(csv_path)] = file_fingerprint(csv_path)
+        rows_appended = st.rows_out = append_rows(store_dir, manifest, sheet_name, new_table)
+    duplicates_removed = new_table.num_rows - rows_appended
+    print(f"Appended {rows_appended} rows from '{os.path.basename(csv_path)}' to sheet '{sheet_name}'.")
+    logging.info(f"Appended {rows_appended} rows from '{csv_path}' to sheet '{sheet_name}'.")
+    if duplicates_removed > 0:
+        print(f"Removed {duplicates_removed} duplicate rows from sheet '{sheet_name}'.")
+        logging.info(f"Removed {duplicates_removed} duplicate rows from sheet '{sheet_name}'.")
+    return rows_appended
+
+def roll_sheet(store_dir, manifest, sheet_name, csv_dir, night=None, rollup_columns=ROLLUP_COLUMNS):
+    """
+    Runs the nightly rollover for one sheet against the store: drop the oldest
+    date partition and append the matching QDS exports as new partitions.
+    A sheet already rolled over for the night (by watch or an earlier run) is
+    not rolled over again, and exports already ingested unchanged are skipped.
+
+    Returns:
+        rollup (pa.Table): The sheet's updated daily rollup.
+    """
+    night = night or date.today().isoformat()
+    entry = manifest['sheets'][sheet_name]
+    if entry.get('rolled_on') == night:
+        print(f"Sheet '{sheet_name}' was already rolled over for {night}. No rows deleted.")
+        logging.info(f"Sheet '{sheet_name}' was already rolled over for {night}. No rows deleted.")
+    else:
+        rollover_sheet(store_dir, manifest, sheet_name, night)
+    for csv_path in find_sheet_csvs(csv_dir, sheet_name):
+        if entry.get('ingested', {}).get(os.path.basename(csv_path)) == file_fingerprint(csv_path):
+            print(f"Skipping '{os.path.basename(csv_path)}': already ingested into sheet '{sheet_name}'.")
+            logging.info(f"Skipping '{csv_path}': already ingested into sheet '{sheet_name}'.")
+            continue
+        append_csv(store_dir, manifest, sheet_name, csv_path)
+    return update_rollup(store_dir, manifest, sheet_name, rollup_columns)
+
+# ==========================
+# 5. Daily Rollups
+# ==========================
+
+def rollup_path(store_dir, sheet_name):
+    """
+    Returns the Parquet file holding a sheet's daily rollup.
+    """
+    return os.path.join(sheet_dir(store_dir, sheet_name), ROLLUP_FILENAME)
+
+def update_rollup(store_dir, manifest, sheet_name, rollup_columns=ROLLUP_COLUMNS):
+    """
+    Updates a sheet's daily rollup from its partitions. Only the dates whose
+    row count changed since the rollup was written (the appended day, the
+    dropped oldest day) are aggregated again, so the cost does not grow with
+    the history. A missing rollup, or one built for other ``rollup_columns``
+    (group column, score column), is built once from every partition.
+
+    Returns:
+        rollup (pa.Table): The sheet's rollup.
+    """
+    entry = manifest['sheets'][sheet_name]
+    missing = missing_columns(entry['columns'], rollup_columns)
+    if missing:
+        print(f"Warning: sheet '{sheet_name}' has no column {missing}; its daily summary leaves them empty.")
+        logging.warning(f"Sheet '{sheet_name}' has no column {missing}; its daily summary leaves them empty. "
+                        f"Pick the columns with --summary-group and --summary-score.")
+    path = rollup_path(store_dir, sheet_name)
+    rollup = pq.read_table(path) if os.path.isfile(path) else None
+    counts = {date.fromisoformat(key): entry['partitions'][key] for key in dated_partitions(entry)}
+    with stage('rollup', sheet=sheet_name) as st:
+        rollup, changed = sync_rollup(
+            rollup, counts, lambda d: load_partition(store_dir, sheet_name, d.isoformat()), sheet_name,
+            rollup_columns,
+        )
+        st.rows_out = rollup.num_rows
+    if changed or not os.path.isfile(path):
+        tmp_path = f"{path}.tmp"
+        pq.write_table(rollup, tmp_path, compression='zstd')
+        os.replace(tmp_path, path)
+        logging.info(f"Updated the rollup of sheet '{sheet_name}' for {len(changed)} dates.")
+    return rollup
+
+def run_transitions(store_dir, manifest, key=DEFAULT_KEY):
+    """
+    Compares the newest day in the store with the day before across all
+    sheets and writes the findings that are new, resolved or moved to another
+    sheet as ``_transitions/<day>.parquet``, with their counts in
+    ``_transitions/<day>.json``. Only the key columns of those two days'
+    partitions are read.
+
+    Returns:
+        counts (dict): The transition counts, or None if there is nothing to compare.
+    """
+    key = list(key)
+    sheets = manifest['sheets']
+    missing = {s: [k for k in key if k not in entry['columns']] for s, entry in sheets.items()}
+    missing = {s: cols for s, cols in missing.items() if cols}
+    if missing:
+        print(f"Transitions skipped: key columns missing in {missing}.")
+        logging.warning(f"Transitions skipped: key columns missing in {missing}.")
+        return None
+    days = sorted({k for entry in sheets.values() for k in dated_partitions(entry)})
+    if len(days) < 2:
+        logging.info("Transitions skipped: fewer than two days in the store.")
+        return None
+    previous_day, current_day = days[-2], days[-1]
+
+    def day_tables(day):
+        return {s: pq.read_table(partition_path(store_dir, s, day), columns=key)
+                for s, entry in sheets.items() if day in entry['partitions']}
+
+    with stage('transitions') as st:
+        previous = keyed_findings(day_tables(previous_day), key)
+        current = keyed_findings(day_tables(current_day), key)
+        st.rows_in = previous.num_rows + current.num_rows
+        rows, counts = compare_days(previous, current, key)
+        st.rows_out = rows.num_rows
+
+    out_dir = os.path.join(store_dir, TRANSITIONS_DIRNAME)
+    os.makedirs(out_dir, exist_ok=True)
+    rows_path = os.path.join(out_dir, f"{current_day}.parquet")
+    pq.write_table(rows, f"{rows_path}.tmp", compression='zstd')
+    os.replace(f"{rows_path}.tmp", rows_path)
+    _write_json(os.path.join(out_dir, f"{current_day}.json"),
+                {'day': current_day, 'previous_day': previous_day, 'key': key, **counts})
+    print(f"Transitions {previous_day} -> {current_day}: {describe_counts(counts)}.")
+    logging.info(f"Transitions {previous_day} -> {current_day}: {describe_counts(counts)}. Rows saved to '{rows_path}'.")
+    return counts
+
+# ==========================
+# 6. Import and Export
+# ==========================
+
+def import_workbook(excel_path, store_dir):
+    """
+    Seeds the store from an existing NA Trend Report workbook.
+    This is a one-off step; afterwards the workbook is only written, never read.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    with WorkbookReader(excel_path) as reader:
+        available = reader.sheet_names
+    for sheet_name in sheets_to_process:
+        if sheet_name not in available:
+            logging.warning(f"Sheet '{sheet_name}' not found in '{excel_path}'. Skipping.")
+    present = [s for s in sheets_to_process if s in available]
+
+    # The QDS sheets are parsed concurrently, one process per sheet
+    print(f"Reading sheets {present} from '{excel_path}'...")
+    with stage('read workbook') as st:
+        sheet_tables = read_workbook(excel_path, present, max_workers=len(present))
+        st.rows_out = sum(t.num_rows for t in sheet_tables.values())
+
+    manifest = {'sheets': {}}
+    for sheet_name in tqdm(present, desc="Importing Sheets"):
+        table = normalise_table(sheet_tables.pop(sheet_name))
+        if os.path.isdir(sheet_dir(store_dir, sheet_name)):
+            shutil.rmtree(sheet_dir(store_dir, sheet_name))
+        entry = {'columns': table.column_names, 'partitions': {}}
+        for key, part in split_by_date(table).items():
+            part = drop_duplicate_rows(part)
+            save_partition(store_dir, sheet_name, key, part)
+            entry['partitions'][key] = part.num_rows
+        manifest['sheets'][sheet_name] = entry
+        print(f"Imported sheet '{sheet_name}' with {sheet_row_count(entry)} rows in {len(entry['partitions'])} partitions.")
+        logging.info(f"Imported sheet '{sheet_name}' with {sheet_row_count(entry)} rows in {len(entry['partitions'])} partitions.")
+        del table
+        gc.collect()
+    write_manifest(store_dir, manifest)
+
+def export_workbook(store_dir, original_excel_path, rollup_columns=ROLLUP_COLUMNS, rollups=None):
+    """
+    Exports the store as ``<report>_Final_<timestamp>.xlsx`` after backing up
+    the current workbook, matching the naming used by the trend scripts.
+    ``rollups`` are the {sheet name: rollup} a run just updated; without them
+    every sheet's rollup is brought up to date here.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    base = os.path.splitext(original_excel_path)[0]
+    if os.path.isfile(original_excel_path):
+        backup_path = f"{base}_backup_{timestamp}.xlsx"
+        shutil.copy2(original_excel_path, backup_path)
+        print(f"Backup of the original Excel file created at '{backup_path}'")
+        logging.info(f"Backup of the original Excel file created at '{backup_path}'")
+
+    final_excel_path = f"{base}_Final_{timestamp}.xlsx"
+    manifest = read_manifest(store_dir)
+    # Partitions are streamed into the sheet XML one at a time
+    with StreamingWorkbookWriter(final_excel_path) as writer:
+        for sheet_name, entry in manifest['sheets'].items():
+            with stage('write', sheet=sheet_name, rows_in=sheet_row_count(entry)) as st:
+                partitions = iter_sheet_partitions(store_dir, sheet_name, entry)
+                rows = st.rows_out = writer.write_sheet(sheet_name, partitions, columns=entry['columns'])
+            print(f"Saved sheet '{sheet_name}' with {rows} rows.")
+            logging.info(f"Saved sheet '{sheet_name}' with {rows} rows.")
+
+        # The trend charts read the small summary instead of the rows above
+        if rollups is None:
+            rollups = {sheet_name: update_rollup(store_dir, manifest, sheet_name, rollup_columns)
+                       for sheet_name in manifest['sheets']}
+        rollups = {sheet_name: rollups[sheet_name] for sheet_name in manifest['sheets']}
+        with stage('write', sheet=SUMMARY_SHEET_NAME) as st:
+            rows = st.rows_out = writer.write_sheet(SUMMARY_SHEET_NAME, summary_table(rollups))
+        print(f"Saved sheet '{SUMMARY_SHEET_NAME}' with {rows} rows.")
+        logging.info(f"Saved sheet '{SUMMARY_SHEET_NAME}' with {rows} rows.")
+    print(f"\nFinal Excel file saved at '{final_excel_path}'")
+    logging.info(f"Final Excel file saved at '{final_excel_path}'")
+    return final_excel_path
+
+# ==========================
+# 7. Main Execution Flow
+# ==========================
+
+def _roll_sheet_worker(store_dir, sheet_name, csv_dir, night, profile=None, rollup_columns=ROLLUP_COLUMNS):
+    """
+    Process-pool entry point: rolls one sheet in its own process.
+    The new partitions and the sheet's entry file are written to the store by
+    the worker itself, so only the final row count, the small daily rollup and
+    the stage timings travel back to the parent.
+    """
+    logging.basicConfig(
+        filename='data_processing.log',
+        filemode='a',  # Workers started with 'spawn' append to the parent's log
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    manifest = read_manifest(store_dir)
+    with collect_stages(profile) as telemetry:
+        rollup = roll_sheet(store_dir, manifest, sheet_name, csv_dir, night, rollup_columns)
+    return sheet_row_count(manifest['sheets'][sheet_name]), rollup, telemetry.result()
+
+def run(store_dir, csv_dir, excel_path, max_workers=1, transition_key=DEFAULT_KEY,
+        rollup_columns=ROLLUP_COLUMNS):
+    """
+    Nightly run: rollover and append every sheet in the store, compare the
+    new day with the previous one across the sheets, then export.
+    The sheets share nothing, so with ``max_workers`` > 1 each one is rolled
+    in its own process.
+    """
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        sys.exit(f"Trend store '{store_dir}' not found. Run 'python trend_store.py import' first.")
+    # Moves stores with an inline manifest over to per-sheet entry files
+    write_manifest(store_dir, manifest)
+
+    # One night for every sheet, even if the run crosses midnight
+    night = date.today().isoformat()
+    sheet_names = list(manifest['sheets'])
+    rollups = {}
+    if max_workers <= 1 or len(sheet_names) <= 1:
+        for sheet_name in tqdm(sheet_names, desc="Processing Sheets"):
+            rollups[sheet_name] = roll_sheet(store_dir, manifest, sheet_name, csv_dir, night, rollup_columns)
+    else:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(sheet_names))) as pool:
+            futures = {
+                pool.submit(_roll_sheet_worker, store_dir, sheet_name, csv_dir, night, active_profile(),
+                            rollup_columns): sheet_name
+                for sheet_name in sheet_names
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing Sheets"):
+                rows, rollups[futures[future]], telemetry = future.result()
+                add_stages(telemetry)
+                logging.info(f"Sheet '{futures[future]}' now holds {rows} rows.")
+
+    # The workers updated their own sheet entries
+    run_transitions(store_dir, read_manifest(store_dir), transition_key)
+    # The rollups were updated with each sheet; the export only writes them out
+    export_workbook(store_dir, excel_path, rollup_columns, rollups=rollups)
+
+def sheet_for_csv(csv_path):
+    """
+    Returns the sheet a QDS export belongs to, or None.
+    """
+    name = os.path.basename(csv_path)
+    for pattern, sheet_name in pattern_to_sheet.items():
+        if pattern in name:
+            return sheet_name
+    return None
+
+def ingest_exports(store_dir, manifest, csv_paths, excel_path, night, transition_key=DEFAULT_KEY,
+                   rollup_columns=ROLLUP_COLUMNS):
+    """
+    Ingests exports that just landed. The first export of the night for a
+    sheet rolls the sheet over; later ones for the same night are only
+    appended. Once every sheet has been rolled over for the night the
+    transitions are computed and the workbook is exported.
+
+    Returns:
+        final_excel_path (str): The exported workbook, or None if sheets are still missing.
+    """
+    for csv_path in csv_paths:
+        sheet_name = sheet_for_csv(csv_path)
+        print(f"\nIngesting '{os.path.basename(csv_path)}' into sheet '{sheet_name}'.")
+        logging.info(f"Ingesting '{csv_path}' into sheet '{sheet_name}'.")
+        if manifest['sheets'][sheet_name].get('rolled_on') != night:
+            rollover_sheet(store_dir, manifest, sheet_name, night)
+        append_csv(store_dir, manifest, sheet_name, csv_path)
+
+    waiting = [s for s, entry in manifest['sheets'].items() if entry.get('rolled_on') != night]
+    if waiting:
+        print(f"Waiting for the exports of {waiting} before exporting the workbook.")
+        logging.info(f"Waiting for the exports of {waiting} before exporting the workbook.")
+        return None
+    run_transitions(store_dir, manifest, transition_key)
+    return export_workbook(store_dir, excel_path, rollup_columns)
+
+def watch(store_dir, csv_dir, excel_path, settle_seconds=SETTLE_SECONDS, poll_interval=POLL_INTERVAL,
+          use_inotify=True, idle_exit=None, record_path=None, profile=None, transition_key=DEFAULT_KEY,
+          rollup_columns=ROLLUP_COLUMNS):
+    """
+    Long-running ingest: every QDS export is ingested into the store as soon
+    as it has been completely written to ``csv_dir``, and the workbook is
+    exported as soon as the last sheet's export is in. Exports ingested
+    before (by an earlier watch or run) are not ingested again unless they
+    change. One run record is written per batch of ingested exports.
+    """
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        sys.exit(f"Trend store '{store_dir}' not found. Run 'python trend_store.py import' first.")
+    write_manifest(store_dir, manifest)
+
+    seen = {}
+    for entry in manifest['sheets'].values():
+        seen.update({name: fp for name, fp in entry.get('ingested', {}).items() if fp})
+    drop = DropFolder(
+        csv_dir,
+        match=lambda name: name.endswith('.csv') and sheet_for_csv(name) in manifest['sheets'],
+        settle_seconds=settle_seconds,
+        poll_interval=poll_interval,
+        use_inotify=use_inotify,
+        seen=seen,
+    )
+    try:
+        for csv_paths in drop.batches(idle_timeout=idle_exit):
+            telemetry = RunTelemetry("trend_store.py watch", record_path=record_path, profile=profile)
+            status = 'error'
+            final_excel_path = None
+            try:
+                final_excel_path = ingest_exports(store_dir, manifest, csv_paths, excel_path, date.today().isoformat(),
+                                                  transition_key, rollup_columns)
+                status = 'ok'
+            except Exception as e:
+                # A bad export must not stop the watcher; it is retried once it changes
+                print(f"Error ingesting {[os.path.basename(p) for p in csv_paths]}: {e}")
+                logging.exception(f"Error ingesting {csv_paths}: {e}")
+                manifest = read_manifest(store_dir)
+            finally:
+                telemetry.finish(status=status, workbook=final_excel_path,
+                                 exports=[os.path.basename(p) for p in csv_paths])
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+        logging.info("Stopped watching.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Parquet history store for the NA Trend Report.")
+    parser.add_argument('command', choices=['import', 'run', 'export', 'watch', 'transitions'])
+    parser.add_argument('--store', default=STORE_DIRNAME, help="Store directory (default: trend_store)")
+    parser.add_argument('--excel', default=EXCEL_FILENAME, help="Workbook to import from / export next to")
+    parser.add_argument('--csv-dir', default='.', help="Directory holding the QDS-*.csv exports")
+    parser.add_argument('--workers', type=int, default=len(sheets_to_process),
+                        help="Sheets rolled in parallel processes (default: one per QDS sheet, 1 = serial)")
+    parser.add_argument('--profile', choices=PROFILERS, default=None,
+                        help="Profile the stages; the run record keeps the slowest stage's profile")
+    parser.add_argument('--telemetry', default=None, help="Run record file the stage timings are appended to (default: trend_runs.jsonl)")
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS,
+                        help=f"watch: seconds an export must stay unchanged before it is ingested (default: {SETTLE_SECONDS})")
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                        help=f"watch: seconds between scans when inotify is not available (default: {POLL_INTERVAL})")
+    parser.add_argument('--poll', action='store_true', help="watch: poll the folder even if inotify is available")
+    parser.add_argument('--idle-exit', type=float, default=None,
+                        help="watch: stop after this many seconds without new exports (default: run until interrupted)")
+    parser.add_argument('--transition-key', default=','.join(DEFAULT_KEY),
+                        help=f"Comma-separated columns identifying a finding across the sheets (default: {','.join(DEFAULT_KEY)})")
+    parser.add_argument('--summary-group', default=GROUP_COLUMN,
+                        help=f"Column the daily summary counts findings by (default: {GROUP_COLUMN})")
+    parser.add_argument('--summary-score', default=SCORE_COLUMN,
+                        help=f"Number column the daily summary averages (default: {SCORE_COLUMN})")
+    args = parser.parse_args()
+    transition_key = [c.strip() for c in args.transition_key.split(',')]
+    rollup_columns = (args.summary_group.strip(), args.summary_score.strip())
+
+    logging.basicConfig(
+        filename='data_processing.log',
+        filemode='w',  # Overwrite log file each run
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    cwd = os.getcwd()
+    store_dir = os.path.join(cwd, args.store)
+    excel_path = os.path.join(cwd, args.excel)
+    csv_dir = os.path.join(cwd, args.csv_dir)
+
+    if args.command == 'watch':
+        # One run record per ingested batch instead of one for the whole session
+        watch(store_dir, csv_dir, excel_path, settle_seconds=args.settle, poll_interval=args.poll_interval,
+              use_inotify=not args.poll, idle_exit=args.idle_exit, record_path=args.telemetry, profile=args.profile,
+              transition_key=transition_key, rollup_columns=rollup_columns)
+        return
+
+    telemetry = RunTelemetry(f"trend_store.py {args.command}", record_path=args.telemetry, profile=args.profile)
+    status = 'error'
+    try:
+        if args.command == 'import':
+            if not os.path.isfile(excel_path):
+                sys.exit(f"Excel file '{excel_path}' not found.")
+            import_workbook(excel_path, store_dir)
+        elif args.command == 'run':
+            run(store_dir, csv_dir, excel_path, max_workers=args.workers, transition_key=transition_key,
+                rollup_columns=rollup_columns)
+        elif args.command == 'transitions':
+            manifest = read_manifest(store_dir)
+            if manifest is None:
+                sys.exit(f"Trend store '{store_dir}' not found. Run 'python trend_store.py import' first.")
+            run_transitions(store_dir, manifest, transition_key)
+        else:
+            if read_manifest(store_dir) is None:
+                sys.exit(f"Trend store '{store_dir}' not found. Run 'python trend_store.py import' first.")
+            export_workbook(store_dir, excel_path, rollup_columns)
+        status = 'ok'
+    finally:
+        telemetry.finish(status=status, workbook=excel_path)
+
+if __name__ == "__main__":
+    main()
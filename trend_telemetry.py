@@ -0,0 +1,311 @@
+"""
+Per-stage performance telemetry for the trend scripts.
+
+Every pipeline stage (read workbook, read CSVs, rollover, append, dedupe,
+write) is wrapped in ``stage()``, which records its wall time, CPU time, the
+growth of the process's peak RSS and the rows going in and out, per sheet.
+At the end of a run the stages are appended as one JSON line to
+``trend_runs.jsonl`` in the working directory, so the file accumulates one
+record per night and regressions show up as the report grows.
+
+Optionally the stages are profiled with cProfile or tracemalloc; the run
+record then carries the top entries of the slowest stage only.
+
+Usage:
+    telemetry = RunTelemetry('trend-po-csv.py', profile=args.profile)
+    with stage('read workbook', sheet=sheet) as st:
+        df = reader.read_sheet(sheet).to_pandas()
+        st.rows_out = len(df)
+    ...
+    telemetry.finish()
+
+Stages recorded in worker processes are collected with collect_stages(),
+returned to the parent process and merged with add_stages().
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import socket
+import logging
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+RUN_RECORD_FILENAME = 'trend_runs.jsonl'
+PROFILERS = ('cprofile', 'tracemalloc')
+
+# Entries of the slowest stage's profile kept in the run record
+PROFILE_TOP = 25
+
+MB = 1024 * 1024
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# ==========================
+# 1. Process Measurements
+# ==========================
+
+def peak_rss():
+    """
+    Returns the peak resident memory of this process in bytes, or None if unknown.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        return None
+
+def current_rss():
+    """
+    Returns the resident memory of this process in bytes, or None if unknown.
+    """
+    try:
+        with open('/proc/self/statm', encoding='ascii') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+def cpu_time():
+    """
+    Returns the CPU time used by this process and its finished worker processes, in seconds.
+    """
+    if resource is None:
+        return time.process_time()
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def _mb(value):
+    return None if value is None else round(value / MB, 1)
+
+# ==========================
+# 2. Stages
+# ==========================
+
+class Stage:
+    """
+    Measurements of one stage. ``rows_in`` and ``rows_out`` are set by the
+    caller inside the ``with stage(...)`` block.
+    """
+
+    def __init__(self, name, sheet=None, rows_in=None):
+        self.name = name
+        self.sheet = sheet
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.record = None
+        self.profile = None
+
+    def as_dict(self):
+        return dict(self.record, stage=self.name, sheet=self.sheet, rows_in=self.rows_in, rows_out=self.rows_out)
+
+class _Collector:
+    """
+    Receives the stages of one process and the profile of its slowest stage.
+    """
+
+    def __init__(self, profile=None):
+        if profile not in (None,) + PROFILERS:
+            raise ValueError(f"Unknown profiler '{profile}'. Use one of {PROFILERS}.")
+        self.profile = profile
+        self.stages = []
+        self.slowest = None
+        self.depth = 0
+
+    def add(self, stage):
+        self.stages.append(stage.as_dict())
+        if stage.profile is not None:
+            self.add_profile({'stage': stage.name, 'sheet': stage.sheet,
+                              'wall_s': stage.record['wall_s'], 'profile': stage.profile})
+
+    def add_profile(self, profile):
+        if profile is not None and (self.slowest is None or profile['wall_s'] > self.slowest['wall_s']):
+            self.slowest = profile
+
+    def result(self):
+        return {'stages': self.stages, 'slowest': self.slowest}
+
+_collector = None
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+def _profile_summary(profiler, snapshot_before):
+    """
+    Returns the top entries of a finished cProfile run or tracemalloc stage as text lines.
+    """
+    if isinstance(profiler, cProfile.Profile):
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        return [line for line in out.getvalue().splitlines() if line.strip()]
+    stats = _snapshot().compare_to(snapshot_before, 'lineno')
+    return [str(stat) for stat in stats[:PROFILE_TOP]]
+
+@contextmanager
+def stage(name, sheet=None, rows_in=None):
+    """
+    Measures one pipeline stage. Without an active RunTelemetry (or
+    collect_stages()) in this process the stage runs unmeasured.
+
+    Parameters:
+        name (str): Stage name, e.g. 'read workbook', 'rollover', 'write'.
+        sheet (str): Sheet the stage works on, if any.
+        rows_in (int): Rows going into the stage, if known up front.
+    """
+    st = Stage(name, sheet, rows_in)
+    collector = _collector
+    if collector is None:
+        yield st
+        return
+
+    # Nested stages are measured, but only the outermost one is profiled
+    profiler = snapshot_before = None
+    if collector.profile and collector.depth == 0:
+        if collector.profile == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            snapshot_before = _snapshot()
+            profiler = tracemalloc
+            tracemalloc.reset_peak()
+    collector.depth += 1
+    peak_before = peak_rss()
+    wall_start = time.perf_counter()
+    cpu_start = cpu_time()
+    try:
+        yield st
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = cpu_time() - cpu_start
+        collector.depth -= 1
+        peak_after = peak_rss()
+        st.record = {
+            'wall_s': round(wall, 3),
+            'cpu_s': round(cpu, 3),
+            'peak_rss_delta_mb': None if peak_before is None else _mb(peak_after - peak_before),
+            'rss_mb': _mb(current_rss()),
+            'pid': os.getpid(),
+        }
+        if profiler is not None:
+            if profiler is not tracemalloc:
+                profiler.disable()
+            else:
+                st.record['py_alloc_peak_mb'] = _mb(tracemalloc.get_traced_memory()[1])
+            st.profile = _profile_summary(profiler, snapshot_before)
+        collector.add(st)
+
+def active_profile():
+    """
+    Returns the profiler of the run being recorded in this process, to be
+    passed on to collect_stages() in worker processes.
+    """
+    return None if _collector is None else _collector.profile
+
+@contextmanager
+def collect_stages(profile=None):
+    """
+    Collects the stages of a worker process. Yields a collector whose
+    result() is returned to the parent process and passed to add_stages().
+    """
+    global _collector
+    previous = _collector
+    _collector = collector = _Collector(profile)
+    started_tracing = profile == 'tracemalloc' and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        yield collector
+    finally:
+        _collector = previous
+        if started_tracing:
+            tracemalloc.stop()
+
+def add_stages(result):
+    """
+    Merges the stages a worker process collected into the run being recorded.
+    """
+    if _collector is not None and result:
+        _collector.stages.extend(result['stages'])
+        _collector.add_profile(result['slowest'])
+
+# ==========================
+# 3. Run Record
+# ==========================
+
+class RunTelemetry:
+    """
+    Collects the stages of one run and appends them as a JSON line to the run record.
+
+    Parameters:
+        script (str): Name of the script being run.
+        record_path (str): JSON Lines file; defaults to trend_runs.jsonl in the working directory.
+        profile (str): 'cprofile' or 'tracemalloc' to profile the stages, or None.
+    """
+
+    def __init__(self, script, record_path=None, profile=None):
+        global _collector
+        self.script = script
+        self.record_path = record_path or os.path.join(os.getcwd(), RUN_RECORD_FILENAME)
+        self.started = datetime.now()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = cpu_time()
+        self._collector = _Collector(profile)
+        if profile == 'tracemalloc':
+            tracemalloc.start()
+        _collector = self._collector
+
+    def finish(self, status='ok', **extra):
+        """
+        Appends the run record and stops collecting. Extra keyword arguments
+        (e.g. the workbook path) are stored in the record.
+
+        Returns:
+            record (dict): The record written.
+        """
+        global _collector
+        stages = self._collector.stages
+        record = {
+            'script': self.script,
+            'host': socket.gethostname(),
+            'started': self.started.isoformat(timespec='seconds'),
+            'status': status,
+            'wall_s': round(time.perf_counter() - self._wall_start, 3),
+            'cpu_s': round(cpu_time() - self._cpu_start, 3),
+            'peak_rss_mb': _mb(peak_rss()),
+            'argv': sys.argv[1:],
+            **extra,
+            'stages': stages,
+        }
+        if stages:
+            slowest = max(stages, key=lambda s: s['wall_s'])
+            record['slowest_stage'] = {'stage': slowest['stage'], 'sheet': slowest['sheet'], 'wall_s': slowest['wall_s']}
+        if self._collector.slowest is not None:
+            record['slowest_stage_profile'] = self._collector.slowest
+        if _collector is self._collector:
+            _collector = None
+        if self._collector.profile == 'tracemalloc':
+            tracemalloc.stop()
+
+        try:
+            with open(self.record_path, 'a', encoding='utf-8') as fh:
+                fh.write(json.dumps(record, default=str) + '\n')
+            logging.info(f"Run telemetry appended to '{self.record_path}'.")
+        except OSError as e:
+            logging.warning(f"Could not write run telemetry to '{self.record_path}': {e}")
+        return record
@@ -0,0 +1,139 @@
+"""
+Aging-bucket transitions between the four QDS sheets.
+
+The QDS sheets are buckets of the same findings: QDS below or above 70
+crossed with less or more than 40 days. From one day to the next a finding
+can appear, disappear, or move to another bucket (e.g. from 'QDS below 70
+L40' to 'QDS below 70 G40' once it ages past 40 days). The rollover treats
+the sheets as unrelated, so these movements were invisible.
+
+compare_days() takes the key columns of one day's rows of every sheet and of
+the previous day's, and classifies every finding with a single hash join:
+
+    new         only in the current day
+    resolved    only in the previous day
+    moved       in both, in another sheet
+    unchanged   in both, in the same sheet
+
+Everything is vectorised Arrow compute (hash join, group by), so the stage
+costs seconds even for a million rows per day. Only the key columns are
+read from storage.
+
+Usage:
+    previous = keyed_findings({sheet: table_of_previous_day, ...}, key)
+    current = keyed_findings({sheet: table_of_current_day, ...}, key)
+    rows, counts = compare_days(previous, current, key)
+"""
+
+import logging
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Columns identifying a finding across the sheets: a QID on a host
+DEFAULT_KEY = ('Host', 'QID')
+
+NEW = 'new'
+RESOLVED = 'resolved'
+MOVED = 'moved'
+UNCHANGED = 'unchanged'
+STATUSES = (NEW, RESOLVED, MOVED, UNCHANGED)
+
+# ==========================
+# 1. Keyed Findings
+# ==========================
+
+def keyed_findings(tables, key):
+    """
+    Stacks the key columns of one day's rows of every sheet, with the sheet
+    as an extra column. A key found more than once in a day (e.g. on several
+    ports) counts once; if it is in several sheets, the first sheet in
+    alphabetical order is kept.
+
+    Parameters:
+        tables (dict): {sheet name: Arrow table with at least the key columns}.
+        key (list): The key columns.
+
+    Returns:
+        findings (pa.Table): One row per key: the key columns and 'Sheet'.
+    """
+    key = list(key)
+    parts = []
+    for sheet_name, table in tables.items():
+        columns = [table.column(k).cast(pa.string()) if pa.types.is_dictionary(table.column(k).type)
+                   else table.column(k) for k in key]
+        part = pa.Table.from_arrays(columns, names=key)
+        part = part.append_column('Sheet', pa.array([sheet_name] * part.num_rows, pa.string()))
+        parts.append(part)
+    if not parts:
+        return pa.table({**{k: pa.array([], pa.string()) for k in key}, 'Sheet': pa.array([], pa.string())})
+    stacked = pa.concat_tables(parts, promote_options='permissive')
+    # Rows without a complete key cannot be followed from one day to the next
+    valid = None
+    for k in key:
+        condition = pc.is_valid(stacked.column(k))
+        valid = condition if valid is None else pc.and_(valid, condition)
+    dropped = stacked.num_rows - pc.sum(valid).as_py() if stacked.num_rows else 0
+    if dropped:
+        logging.info(f"{dropped} rows without a complete key {key} left out of the transitions.")
+    stacked = stacked.filter(valid)
+    return stacked.group_by(key).aggregate([('Sheet', 'min')]).rename_columns(key + ['Sheet'])
+
+# ==========================
+# 2. Comparison
+# ==========================
+
+def compare_days(previous, current, key):
+    """
+    Classifies every finding of two consecutive days with one full outer hash join.
+
+    Parameters:
+        previous (pa.Table): keyed_findings() of the previous day.
+        current (pa.Table): keyed_findings() of the current day.
+        key (list): The key columns.
+
+    Returns:
+        rows (pa.Table): Key columns, 'From', 'To' and 'Status' of every
+            finding that is new, resolved or moved.
+        counts (dict): {'new': n, 'resolved': n, 'moved': n, 'unchanged': n,
+            'moves': [{'from': sheet, 'to': sheet, 'count': n}, ...]}.
+    """
+    key = list(key)
+    joined = previous.rename_columns(key + ['From']).join(
+        current.rename_columns(key + ['To']), keys=key, join_type='full outer',
+    )
+    from_sheet = joined.column('From')
+    to_sheet = joined.column('To')
+    status = pc.case_when(
+        pc.make_struct(
+            pc.is_null(from_sheet),
+            pc.is_null(to_sheet),
+            pc.not_equal(from_sheet, to_sheet),
+        ),
+        NEW, RESOLVED, MOVED, UNCHANGED,
+    )
+    joined = joined.append_column('Status', status)
+
+    status_counts = joined.group_by('Status').aggregate([([], 'count_all')])
+    counts = {s: 0 for s in STATUSES}
+    counts.update(zip(status_counts['Status'].to_pylist(), status_counts['count_all'].to_pylist()))
+
+    changed = joined.filter(pc.not_equal(joined.column('Status'), UNCHANGED))
+    moved = changed.filter(pc.equal(changed.column('Status'), MOVED))
+    moves = moved.group_by(['From', 'To']).aggregate([([], 'count_all')]).sort_by(
+        [('count_all', 'descending'), ('From', 'ascending'), ('To', 'ascending')])
+    counts['moves'] = [
+        {'from': f, 'to': t, 'count': n}
+        for f, t, n in zip(moves['From'].to_pylist(), moves['To'].to_pylist(), moves['count_all'].to_pylist())
+    ]
+    rows = changed.select(key + ['From', 'To', 'Status']).sort_by(
+        [('Status', 'ascending')] + [(k, 'ascending') for k in key])
+    return rows, counts
+
+def describe_counts(counts):
+    """
+    Returns a one-line description of transition counts.
+    """
+    moves = ', '.join(f"{m['from']} -> {m['to']}: {m['count']}" for m in counts['moves'][:4])
+    text = f"{counts[NEW]} new, {counts[RESOLVED]} resolved, {counts[MOVED]} moved, {counts[UNCHANGED]} unchanged"
+    return f"{text} ({moves})" if moves else text
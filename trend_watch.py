@@ -0,0 +1,253 @@
+"""
+Drop-folder watching for the QDS exports.
+
+Instead of someone running delcsv.py and a trend script by hand once the
+exports have landed (each run rescanning the folder with os.listdir()),
+DropFolder waits for new or rewritten files in a directory and hands each
+one over as soon as it is complete.
+
+New files are detected with inotify on Linux (through ctypes, nothing to
+install) and by polling the directory everywhere else, or when inotify is
+not available. An export is still being written while its size or
+modification time keeps changing, so a file is only reported once it has
+been unchanged for ``settle_seconds`` and can be opened for reading. Each
+version of a file (size and modification time) is reported once.
+
+Usage:
+    drop = DropFolder('drops', match=lambda name: name.endswith('.csv'))
+    for paths in drop.batches():
+        ...ingest paths...
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+# Seconds a file must stay unchanged before it is considered complete
+SETTLE_SECONDS = 2.0
+
+# Seconds between directory scans when polling
+POLL_INTERVAL = 5.0
+
+# inotify event flags (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, name length
+READ_SIZE = 64 * 1024
+
+# ==========================
+# 1. Watchers
+# ==========================
+
+class InotifyWatcher:
+    """
+    Reports the names of files changed in a directory using Linux inotify.
+
+    Raises:
+        OSError: inotify is not available on this system.
+    """
+
+    method = 'inotify'
+
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, "C library not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not supported on this system")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"Cannot watch '{directory}'")
+
+    def wait(self, timeout):
+        """
+        Blocks for up to ``timeout`` seconds until files change.
+
+        Returns:
+            names (set): Names of the changed files (empty on timeout), or
+                None if events were lost and the whole directory must be rescanned.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                if mask & IN_Q_OVERFLOW:
+                    names = None
+                elif names is not None and length:
+                    names.add(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+                offset += length
+            if names is None:
+                return None
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Fallback watcher that asks for a full rescan every ``interval`` seconds.
+    """
+
+    method = 'polling'
+
+    def __init__(self, directory, interval=POLL_INTERVAL):
+        self.interval = interval
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        return None
+
+    def close(self):
+        pass
+
+def open_watcher(directory, poll_interval=POLL_INTERVAL, use_inotify=True):
+    """
+    Returns an InotifyWatcher for the directory, or a PollingWatcher if
+    inotify is disabled or not available.
+    """
+    if use_inotify:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError) as e:
+            logging.info(f"inotify not available ({e}). Polling '{directory}' every {poll_interval}s.")
+    return PollingWatcher(directory, poll_interval)
+
+# ==========================
+# 2. Drop Folder
+# ==========================
+
+def _fingerprint(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+def _readable(path):
+    # Exports still held open for writing on Windows shares cannot be opened yet
+    try:
+        with open(path, 'rb'):
+            return True
+    except OSError:
+        return False
+
+class DropFolder:
+    """
+    Complete files arriving in a directory.
+
+    Parameters:
+        directory (str): The drop folder.
+        match (callable): Returns True for the file names to report.
+        settle_seconds (float): How long a file must stay unchanged.
+        poll_interval (float): Seconds between scans when polling.
+        use_inotify (bool): Set to False to always poll.
+        seen (dict): {name: (size, mtime_ns)} of files already handled, e.g.
+            by an earlier run; those versions are not reported again.
+    """
+
+    def __init__(self, directory, match, settle_seconds=SETTLE_SECONDS, poll_interval=POLL_INTERVAL,
+                 use_inotify=True, seen=None):
+        self.directory = directory
+        self.match = match
+        self.settle_seconds = settle_seconds
+        self.watcher = open_watcher(directory, poll_interval, use_inotify)
+        self.seen = {name: tuple(fp) for name, fp in (seen or {}).items()}
+        # name -> (fingerprint, monotonic time it was first seen with it)
+        self.pending = {}
+        print(f"Watching '{directory}' for new exports ({self.watcher.method}).")
+        logging.info(f"Watching '{directory}' for new exports ({self.watcher.method}).")
+
+    def _scan(self, names=None):
+        """
+        Updates the pending files from the given names, or from the whole directory.
+        """
+        if names is None:
+            names = os.listdir(self.directory)
+        now = time.monotonic()
+        for name in names:
+            if not self.match(name):
+                continue
+            fingerprint = _fingerprint(os.path.join(self.directory, name))
+            if fingerprint is None or self.seen.get(name) == fingerprint:
+                self.pending.pop(name, None)
+            elif name not in self.pending or self.pending[name][0] != fingerprint:
+                # New or still growing: restart its settle time
+                self.pending[name] = (fingerprint, now)
+
+    def _ready(self):
+        """
+        Returns the pending files that have settled, and marks them as seen.
+        """
+        now = time.monotonic()
+        ready = []
+        for name, (fingerprint, since) in sorted(self.pending.items()):
+            if now - since < self.settle_seconds:
+                continue
+            path = os.path.join(self.directory, name)
+            if _fingerprint(path) != fingerprint:
+                # Changed since the last event; the next scan restarts its settle time
+                continue
+            if not _readable(path):
+                continue
+            del self.pending[name]
+            self.seen[name] = fingerprint
+            ready.append(path)
+        return ready
+
+    def batches(self, idle_timeout=None):
+        """
+        Yields lists of complete files as they arrive. Files that settle
+        together are yielded together. Files already in the folder are
+        reported first.
+
+        Parameters:
+            idle_timeout (float): Stop after this many seconds without any
+                pending file; None watches until interrupted.
+        """
+        self._scan()
+        idle_since = time.monotonic()
+        try:
+            while True:
+                ready = self._ready()
+                if ready:
+                    yield ready
+                    idle_since = time.monotonic()
+                if self.pending:
+                    next_due = min(since for _, since in self.pending.values()) + self.settle_seconds
+                    timeout = max(next_due - time.monotonic(), 0.1)
+                else:
+                    if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                        return
+                    timeout = idle_timeout if idle_timeout is not None else 3600
+                names = self.watcher.wait(timeout)
+                if names is None:
+                    self._scan()
+                else:
+                    # Pending files are checked again even without events (e.g. on network shares)
+                    self._scan(names | set(self.pending))
+        finally:
+            self.watcher.close()
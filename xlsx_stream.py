@@ -0,0 +1,1291 @@
+"""
+Streaming xlsx reader and writer for the NA Trend Report.
+
+pd.ExcelWriter(engine='openpyxl') builds an object for every cell before the
+file is saved, so writing four sheets close to the Excel row limit needs many
+GB of RAM. StreamingWorkbookWriter instead serialises each batch of rows
+straight into the sheet XML inside the zip file: cell XML is built column by
+column with Arrow compute kernels and the batch is written out before the next
+one is converted, so peak memory depends on the batch size, not the row count.
+
+WorkbookReader is the reading counterpart: it iterparses each sheet's XML
+once, keeps the shared strings as a single Arrow array that string columns
+reference as a dictionary, and yields typed Arrow record batches.
+
+Usage:
+    with StreamingWorkbookWriter('NA Trend Report_Final.xlsx') as writer:
+        writer.write_sheet('QDS above 70 G40', df_or_table_or_batches)
+
+    tables = read_workbook('NA Trend Report.xlsx', max_workers=4)
+
+patch_workbook() rewrites only the QDS sheet parts of an existing workbook
+(oldest day removed, new rows appended) and streams every other part of the
+zip through unchanged, so pivots, charts and formatting survive.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import datetime
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape, quoteattr
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+EXCEL_ROW_LIMIT = 1048576  # Includes the header row
+DEFAULT_BATCH_SIZE = 50000
+SHEET_NAME_MAX_LENGTH = 31
+SHEET_NAME_INVALID_CHARS = '[]:*?/\\'
+
+# Days between the Excel epoch (1899-12-30) and the Unix epoch
+EXCEL_EPOCH_OFFSET = 25569
+
+# Style indexes defined in STYLES_XML
+STYLE_DATE = 1
+STYLE_DATETIME = 2
+
+# Characters that are not allowed anywhere in an XML 1.0 document
+ILLEGAL_XML_CHARS = r'[\x00-\x08\x0b\x0c\x0e-\x1f]'
+
+CONTENT_TYPES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '{sheets}'
+    '</Types>'
+)
+
+ROOT_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+STYLES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<numFmts count="2">'
+    '<numFmt numFmtId="164" formatCode="mm/dd/yyyy"/>'
+    '<numFmt numFmtId="165" formatCode="mm/dd/yyyy hh:mm:ss"/>'
+    '</numFmts>'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="3">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '</cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+SHEET_HEADER_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<sheetData>'
+)
+SHEET_FOOTER_XML = '</sheetData></worksheet>'
+
+# ==========================
+# 1. Batch Sources
+# ==========================
+
+def iter_record_batches(source, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Yields Arrow record batches of at most ``batch_size`` rows from a pandas
+    DataFrame, a Polars DataFrame, an Arrow table/record batch, or an iterable
+    of any of those. Pandas frames are converted one slice at a time so the
+    whole frame is never duplicated in Arrow memory.
+    """
+    if isinstance(source, pa.RecordBatch):
+        source = pa.Table.from_batches([source])
+    if isinstance(source, pa.Table):
+        yield from source.to_batches(max_chunksize=batch_size)
+    elif hasattr(source, 'to_arrow'):  # Polars DataFrame
+        yield from source.to_arrow().to_batches(batch_size)
+    elif hasattr(source, 'iloc'):  # pandas DataFrame
+        for start in range(0, len(source), batch_size):
+            yield pandas_to_batch(source.iloc[start:start + batch_size])
+    else:
+        for item in source:
+            yield from iter_record_batches(item, batch_size)
+
+def source_columns(source):
+    """
+    Returns the column names of a single-frame source, or None for iterables.
+    """
+    if isinstance(source, (pa.Table, pa.RecordBatch)):
+        return source.schema.names
+    if hasattr(source, 'columns'):  # pandas or Polars DataFrame
+        return [str(c) for c in source.columns]
+    return None
+
+def pandas_to_batch(df):
+    """
+    Converts a pandas DataFrame slice to a record batch. Object columns that
+    mix types (common after pd.read_excel) are written as text.
+    """
+    arrays = []
+    for col in df.columns:
+        try:
+            array = pa.array(df[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            array = pa.array(df[col].astype('string'), type=pa.string(), from_pandas=True)
+        # Arrow-backed pandas columns come back chunked
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks()
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, names=[str(c) for c in df.columns])
+
+def write_ipc(source, path, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Writes a batch source to an Arrow IPC file and returns its row count.
+    Worker processes hand their results back this way: the parent maps the
+    file instead of unpickling a DataFrame sent through a pipe.
+    """
+    if isinstance(source, pa.RecordBatch):
+        table = pa.Table.from_batches([source])
+    elif isinstance(source, pa.Table):
+        table = source
+    elif hasattr(source, 'to_arrow'):  # Polars DataFrame
+        table = source.to_arrow()
+    elif hasattr(source, 'iloc'):  # pandas DataFrame, one schema for the whole frame
+        table = pa.Table.from_batches([pandas_to_batch(source)])
+    else:
+        table = unify_batches(list(iter_record_batches(source, batch_size)))
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as ipc_writer:
+        ipc_writer.write_table(table, max_chunksize=batch_size)
+    return table.num_rows
+
+def read_ipc(path, memory_map=False):
+    """
+    Reads an Arrow IPC file written by write_ipc().
+    With ``memory_map=True`` the table references the file's pages directly and
+    the file must outlive it; otherwise the data is read into memory once.
+    """
+    source = pa.memory_map(path) if memory_map else pa.OSFile(path)
+    with source:
+        return pa.ipc.open_file(source).read_all()
+
+# ==========================
+# 2. Vectorised Cell Serialisation
+# ==========================
+
+def _wrap(values, prefix, suffix):
+    """
+    Wraps every value of a string array in ``prefix``/``suffix``; nulls become empty cells.
+    """
+    cells = pc.binary_join_element_wise(prefix, values, suffix, '')
+    return pc.fill_null(cells, '<c/>')
+
+def string_cells(values, s_attr=''):
+    """
+    Serialises a string array as inline-string cells with XML escaping.
+    Inline strings avoid holding a shared-strings table for the whole sheet.
+    """
+    values = pc.replace_substring_regex(values, ILLEGAL_XML_CHARS, '')
+    values = pc.replace_substring(values, '&', '&amp;')
+    values = pc.replace_substring(values, '<', '&lt;')
+    values = pc.replace_substring(values, '>', '&gt;')
+    return _wrap(values, f'<c{s_attr} t="inlineStr"><is><t xml:space="preserve">', '</t></is></c>')
+
+def column_cells(array, style=None, temporal_styles=(STYLE_DATE, STYLE_DATETIME)):
+    """
+    Serialises one Arrow column of a batch into an array of ``<c>`` elements.
+    ``style`` overrides the cell style index (used when patching a workbook
+    whose styles.xml is not ours); otherwise dates and timestamps get the
+    (date, date-time) ``temporal_styles``, STYLE_DATE/STYLE_DATETIME of our own
+    styles.xml by default. A None style leaves the cells unstyled.
+    """
+    s_attr = '' if style is None else f' s="{style}"'
+    typ = array.type
+    if pa.types.is_dictionary(typ):
+        array = array.cast(typ.value_type)
+        typ = array.type
+    if pa.types.is_null(typ):
+        return pa.array(['<c/>'] * len(array), type=pa.string())
+    if pa.types.is_boolean(typ):
+        return _wrap(pc.cast(pc.cast(array, pa.int8()), pa.string()), f'<c{s_attr} t="b"><v>', '</v></c>')
+    if pa.types.is_integer(typ):
+        return _wrap(pc.cast(array, pa.string()), f'<c{s_attr}><v>', '</v></c>')
+    if pa.types.is_floating(typ):
+        # NaN and infinities have no Excel representation
+        array = pc.if_else(pc.is_finite(array), array, pa.scalar(None, typ))
+        return _wrap(pc.cast(array, pa.string()), f'<c{s_attr}><v>', '</v></c>')
+    if pa.types.is_date(typ):
+        serial = pc.add(pc.cast(pc.cast(array, pa.date32()), pa.int32()), EXCEL_EPOCH_OFFSET)
+        if not s_attr and temporal_styles[0] is not None:
+            s_attr = f' s="{temporal_styles[0]}"'
+        return _wrap(pc.cast(serial, pa.string()), f'<c{s_attr}><v>', '</v></c>')
+    if pa.types.is_timestamp(typ):
+        micros = pc.cast(pc.cast(array, pa.timestamp('us', tz=typ.tz)), pa.int64())
+        serial = pc.add(pc.divide(pc.cast(micros, pa.float64()), 86400e6), float(EXCEL_EPOCH_OFFSET))
+        if not s_attr and temporal_styles[1] is not None:
+            s_attr = f' s="{temporal_styles[1]}"'
+        return _wrap(pc.cast(serial, pa.string()), f'<c{s_attr}><v>', '</v></c>')
+    return string_cells(pc.cast(array, pa.string()), s_attr)
+
+def batch_to_xml(batch, styles=None, first_row=None, temporal_styles=(STYLE_DATE, STYLE_DATETIME)):
+    """
+    Serialises a record batch into contiguous ``<row>`` XML bytes.
+    Cells carry no references; Excel places them left to right, which is why
+    nulls are written as empty ``<c/>`` elements rather than skipped. Rows are
+    numbered from ``first_row`` when given (needed when appending after
+    existing numbered rows), ``styles`` sets a style index per column and
+    ``temporal_styles`` the styles of unstyled date and timestamp columns.
+    """
+    cells = [
+        column_cells(batch.column(i), styles[i] if styles and i < len(styles) else None, temporal_styles)
+        for i in range(batch.num_columns)
+    ]
+    if first_row is None:
+        row_open = '<row>'
+    else:
+        numbers = pa.array(range(first_row, first_row + batch.num_rows), type=pa.int64())
+        row_open = pc.binary_join_element_wise('<row r="', pc.cast(numbers, pa.string()), '">', '')
+    rows = pc.binary_join_element_wise(row_open, *cells, '</row>', '')
+    if len(rows) == 0:
+        return b''
+    # The joined rows are contiguous in the data buffer, so no Python join is needed
+    offsets = memoryview(rows.buffers()[1]).cast('q' if pa.types.is_large_string(rows.type) else 'i')
+    start = offsets[rows.offset]
+    end = offsets[rows.offset + len(rows)]
+    return memoryview(rows.buffers()[2])[start:end]
+
+def header_xml(columns):
+    """
+    Serialises the header row of a sheet.
+    """
+    cells = ''.join(
+        f'<c t="inlineStr"><is><t xml:space="preserve">{escape(str(c))}</t></is></c>' for c in columns
+    )
+    return f'<row>{cells}</row>'.encode('utf-8')
+
+# ==========================
+# 3. Workbook Writer
+# ==========================
+
+def validate_sheet_name(sheet_name):
+    """
+    Raises ValueError for a name Excel does not accept for a sheet: empty,
+    longer than 31 characters, containing any of []:*?/\\, starting or ending
+    with an apostrophe, or the reserved name 'History'.
+    """
+    if not isinstance(sheet_name, str) or not sheet_name:
+        raise ValueError("Sheet name must be a non-empty string.")
+    if len(sheet_name) > SHEET_NAME_MAX_LENGTH:
+        raise ValueError(f"Sheet name '{sheet_name}' is longer than {SHEET_NAME_MAX_LENGTH} characters.")
+    invalid = sorted(set(sheet_name) & set(SHEET_NAME_INVALID_CHARS))
+    if invalid:
+        raise ValueError(f"Sheet name '{sheet_name}' contains invalid characters {invalid}.")
+    if sheet_name.startswith("'") or sheet_name.endswith("'"):
+        raise ValueError(f"Sheet name '{sheet_name}' cannot start or end with an apostrophe.")
+    if sheet_name.lower() == 'history':
+        raise ValueError("'History' is a reserved sheet name.")
+
+class StreamingWorkbookWriter:
+    """
+    Writes an xlsx workbook sheet by sheet with bounded memory.
+
+    Parameters:
+        path (str): Destination .xlsx path.
+        batch_size (int): Rows serialised per batch; bounds peak memory.
+    """
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.sheet_names = []
+        self._tmp_path = f"{path}.tmp"
+        self._zip = zipfile.ZipFile(self._tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+    def write_sheet(self, sheet_name, source, columns=None):
+        """
+        Streams one sheet into the workbook.
+
+        Parameters:
+            sheet_name (str): Sheet name; see validate_sheet_name().
+            source: DataFrame, Arrow table/record batch, or an iterable of them.
+            columns (list): Header names; defaults to the first batch's schema.
+
+        Returns:
+            rows_written (int): Number of data rows written.
+        """
+        validate_sheet_name(sheet_name)
+        if sheet_name.lower() in (name.lower() for name in self.sheet_names):
+            raise ValueError(f"Sheet '{sheet_name}' already written.")
+        self.sheet_names.append(sheet_name)
+        part = f"xl/worksheets/sheet{len(self.sheet_names)}.xml"
+
+        if columns is None:
+            columns = source_columns(source)
+        rows_written = 0
+        with self._zip.open(part, 'w', force_zip64=True) as stream:
+            stream.write(SHEET_HEADER_XML.encode('utf-8'))
+            header_written = False
+            if columns is not None:
+                stream.write(header_xml(columns))
+                header_written = True
+            for batch in iter_record_batches(source, self.batch_size):
+                if not header_written:
+                    stream.write(header_xml(batch.schema.names))
+                    header_written = True
+                rows_written += batch.num_rows
+                if rows_written > EXCEL_ROW_LIMIT - 1:
+                    raise ValueError(
+                        f"Sheet '{sheet_name}' exceeds the Excel row limit of {EXCEL_ROW_LIMIT} rows."
+                    )
+                stream.write(batch_to_xml(batch))
+            stream.write(SHEET_FOOTER_XML.encode('utf-8'))
+        return rows_written
+
+    def close(self):
+        """
+        Writes the workbook parts and moves the finished file into place.
+        """
+        sheets = ''.join(
+            f'<sheet name={quoteattr(name)} sheetId="{i}" r:id="rId{i}"/>'
+            for i, name in enumerate(self.sheet_names, start=1)
+        )
+        rels = ''.join(
+            f'<Relationship Id="rId{i}" '
+            f'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            f'Target="worksheets/sheet{i}.xml"/>'
+            for i in range(1, len(self.sheet_names) + 1)
+        )
+        styles_id = len(self.sheet_names) + 1
+        rels += (
+            f'<Relationship Id="rId{styles_id}" '
+            f'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+            f'Target="styles.xml"/>'
+        )
+        overrides = ''.join(
+            f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+            f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for i in range(1, len(self.sheet_names) + 1)
+        )
+        self._zip.writestr('[Content_Types].xml', CONTENT_TYPES_XML.format(sheets=overrides))
+        self._zip.writestr('_rels/.rels', ROOT_RELS_XML)
+        self._zip.writestr(
+            'xl/workbook.xml',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets>{sheets}</sheets></workbook>'
+        )
+        self._zip.writestr(
+            'xl/_rels/workbook.xml.rels',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'{rels}</Relationships>'
+        )
+        self._zip.writestr('xl/styles.xml', STYLES_XML)
+        self._zip.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """
+        Discards a partially written workbook.
+        """
+        self._zip.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+# ==========================
+# 4. Workbook Reader
+# ==========================
+
+NS_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+NS_DOC_REL = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+NS_PKG_REL = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# Built-in number formats that display a date or time
+BUILTIN_DATE_FORMATS = set(range(14, 23)) | {45, 46, 47}
+
+# Used by WorkbookReader.estimate_rows() on the first bytes of a sheet
+SAMPLE_DIMENSION_RE = re.compile(rb'<dimension ref="[A-Z]+\d+:([A-Z]+)(\d+)"')
+SAMPLE_ROW_RE = re.compile(rb'<row[\s>/]')
+SAMPLE_FIRST_ROW_RE = re.compile(rb'<row\b.*?</row>', re.S)
+SAMPLE_CELL_RE = re.compile(rb'<c[\s>/]')
+
+_column_index_cache = {}
+
+def column_index(ref):
+    """
+    Converts a cell reference such as 'AB12' to a zero-based column index.
+    """
+    letters = ref.rstrip('0123456789')
+    index = _column_index_cache.get(letters)
+    if index is None:
+        index = 0
+        for ch in letters:
+            index = index * 26 + (ord(ch) - 64)
+        index -= 1
+        _column_index_cache[letters] = index
+    return index
+
+def is_date_format(format_code):
+    """
+    Returns True if a custom number format displays a date or time.
+    Quoted literals, [colour]/[locale] blocks and escaped characters are ignored.
+    """
+    code = re.sub(r'"[^"]*"|\[[^\]]*\]|\\.', '', format_code)
+    return re.search(r'[dmyhs]', code, re.IGNORECASE) is not None
+
+def mangle_duplicate_names(names):
+    """
+    Makes header names unique the way pandas does ('Sales', 'Sales.1', ...).
+    """
+    seen = {}
+    result = []
+    for name in names:
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        result.append(name)
+    return result
+
+def excel_serial_to_timestamp(values):
+    """
+    Converts an array of Excel serial dates to timestamp[ms].
+    """
+    millis = pc.round(pc.multiply(pc.subtract(values, float(EXCEL_EPOCH_OFFSET)), 86400000.0))
+    return pc.cast(pc.cast(millis, pa.int64()), pa.timestamp('ms'))
+
+def iso_to_excel_serial(text):
+    """
+    Converts an ISO 8601 cell value (t="d", as openpyxl writes with
+    iso_dates=True) to an Excel serial date, or returns None if it is not one.
+    Times without a date become fractions of a day.
+    """
+    try:
+        value = datetime.datetime.fromisoformat(text)
+    except ValueError:
+        try:
+            value = datetime.time.fromisoformat(text)
+        except ValueError:
+            return None
+        return (value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1e6) / 86400
+    value = value.replace(tzinfo=None)
+    return (value - datetime.datetime(1970, 1, 1)) / datetime.timedelta(days=1) + EXCEL_EPOCH_OFFSET
+
+class WorkbookReader:
+    """
+    Reads xlsx sheets as Arrow record batches with a single pass over each sheet's XML.
+
+    The zip file, the shared-strings table and the date styles are loaded once
+    and reused for every sheet, so reading all four QDS sheets decompresses the
+    workbook once rather than once per sheet as pd.read_excel does.
+
+    Parameters:
+        path (str): Path to the .xlsx workbook.
+        batch_size (int): Rows per yielded record batch.
+    """
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._zip = zipfile.ZipFile(path)
+        self._parts = self._load_sheet_parts()
+        self._date_styles = self._load_date_styles()
+        self._strings = None
+        self._strings_array = None
+
+    @property
+    def sheet_names(self):
+        return list(self._parts)
+
+    @property
+    def date_styles(self):
+        """Cell style indexes whose number format displays a date."""
+        return set(self._date_styles)
+
+    def sheet_part(self, sheet_name):
+        """Returns the zip part name holding a sheet's XML."""
+        return self._parts[sheet_name]
+
+    def sheet_fingerprint(self, sheet_name):
+        """
+        Returns the CRC-32 and size of every zip part a sheet's values depend
+        on: its XML, the shared strings and the styles (which decide dates).
+        The zip directory already stores these, so nothing is decompressed.
+        """
+        names = set(self._zip.namelist())
+        fingerprint = {}
+        for part in (self._parts[sheet_name], 'xl/sharedStrings.xml', 'xl/styles.xml'):
+            if part in names:
+                info = self._zip.getinfo(part)
+                fingerprint[part] = [info.CRC, info.file_size]
+        return fingerprint
+
+    def estimate_shape(self, sheet_name, sample_bytes=1 << 18):
+        """
+        Returns (data rows, columns) of a sheet without parsing it: taken from
+        the sheet's <dimension> when present, otherwise the rows are
+        extrapolated from the first ``sample_bytes`` of its XML and the columns
+        counted in its first row. Exact for sheets that fit in the sample.
+        """
+        part = self._parts[sheet_name]
+        with self._zip.open(part) as stream:
+            sample = stream.read(sample_bytes)
+            complete = not stream.read(1)
+        match = SAMPLE_DIMENSION_RE.search(sample)
+        if match and int(match.group(2)) > 1:
+            return int(match.group(2)) - 1, column_index(match.group(1).decode()) + 1
+        first_row = SAMPLE_FIRST_ROW_RE.search(sample)
+        columns = len(SAMPLE_CELL_RE.findall(first_row.group(0))) if first_row else 0
+        rows = len(SAMPLE_ROW_RE.findall(sample))
+        if not complete and sample:
+            rows = int(rows * self._zip.getinfo(part).file_size / len(sample))
+        return max(rows - 1, 0), columns
+
+    def _load_sheet_parts(self):
+        """
+        Returns an ordered {sheet name: zip part} mapping from workbook.xml.
+        """
+        rels = ET.fromstring(self._zip.read('xl/_rels/workbook.xml.rels'))
+        targets = {rel.get('Id'): rel.get('Target') for rel in rels.iter(f'{NS_PKG_REL}Relationship')}
+        workbook = ET.fromstring(self._zip.read('xl/workbook.xml'))
+        parts = {}
+        for sheet in workbook.iter(f'{NS_MAIN}sheet'):
+            target = targets[sheet.get(f'{NS_DOC_REL}id')]
+            target = target.lstrip('/') if target.startswith('/') else posixpath.join('xl', target)
+            parts[sheet.get('name')] = posixpath.normpath(target)
+        return parts
+
+    def _load_date_styles(self):
+        """
+        Returns the set of cell style indexes whose number format is a date.
+        """
+        if 'xl/styles.xml' not in self._zip.namelist():
+            return set()
+        styles = ET.fromstring(self._zip.read('xl/styles.xml'))
+        date_formats = set(BUILTIN_DATE_FORMATS)
+        for fmt in styles.iter(f'{NS_MAIN}numFmt'):
+            if is_date_format(fmt.get('formatCode', '')):
+                date_formats.add(int(fmt.get('numFmtId')))
+        cell_xfs = styles.find(f'{NS_MAIN}cellXfs')
+        if cell_xfs is None:
+            return set()
+        return {i for i, xf in enumerate(cell_xfs) if int(xf.get('numFmtId', 0)) in date_formats}
+
+    def _load_shared_strings(self):
+        """
+        Decodes the shared-strings table once into a Python list (for header and
+        mixed columns) and an Arrow array (the dictionary for string columns).
+        """
+        strings = []
+        if 'xl/sharedStrings.xml' in self._zip.namelist():
+            si_tag, t_tag, r_tag = f'{NS_MAIN}si', f'{NS_MAIN}t', f'{NS_MAIN}r'
+            with self._zip.open('xl/sharedStrings.xml') as stream:
+                for _, elem in ET.iterparse(stream):
+                    if elem.tag != si_tag:
+                        continue
+                    t = elem.find(t_tag)
+                    if t is not None:
+                        strings.append(t.text or '')
+                    else:
+                        # Rich text: concatenate the runs, skipping phonetic hints
+                        strings.append(''.join(r.findtext(t_tag, '') for r in elem.iter(r_tag)))
+                    elem.clear()
+        self._strings = strings
+        self._strings_array = pa.array(strings, type=pa.string())
+
+    def _build_column(self, values, is_date):
+        """
+        Builds a typed Arrow array from one column of parsed cell values.
+        Shared-string indexes (ints) become dictionary arrays over the
+        shared-strings table; numbers become int64/float64 or timestamps for
+        date-formatted cells; columns mixing kinds fall back to text.
+        """
+        kinds = set(map(type, values))
+        kinds.discard(type(None))
+        if not kinds:
+            return pa.nulls(len(values))
+        if kinds == {int}:
+            indices = pa.array(values, type=pa.int32())
+            return pa.DictionaryArray.from_arrays(indices, self._strings_array)
+        if kinds == {float}:
+            array = pa.array(values, type=pa.float64())
+            if is_date:
+                return excel_serial_to_timestamp(array)
+            integral = pc.all(pc.equal(pc.floor(array), array)).as_py()
+            if integral is not False and (pc.max(pc.abs(array)).as_py() or 0) < 2 ** 53:
+                return pc.cast(array, pa.int64())
+            return array
+        if kinds == {bool}:
+            return pa.array(values, type=pa.bool_())
+        if kinds == {str}:
+            return pa.array(values, type=pa.string())
+        return pa.array([self._format_value(v, is_date) for v in values], type=pa.string())
+
+    def _format_value(self, value, is_date):
+        """
+        Renders one cell value as text for columns that mix kinds.
+        """
+        kind = type(value)
+        if kind is int:
+            return self._strings[value]
+        if kind is float:
+            if is_date:
+                return excel_serial_to_timestamp(pa.array([value])).cast(pa.string())[0].as_py()
+            return str(int(value)) if value.is_integer() else repr(value)
+        if kind is bool:
+            return 'TRUE' if value else 'FALSE'
+        return value
+
+    def _make_batch(self, rows, names, date_columns):
+        """
+        Transposes buffered rows into a typed record batch.
+        """
+        width = max(len(names), max(len(row) for row in rows))
+        for row in rows:
+            if len(row) < width:
+                row.extend([None] * (width - len(row)))
+        if width > len(names):
+            names.extend(f"Unnamed: {i}" for i in range(len(names), width))
+        columns = [self._build_column(list(col), i in date_columns) for i, col in enumerate(zip(*rows))]
+        return pa.RecordBatch.from_arrays(columns, names=list(names))
+
+    def iter_batches(self, sheet_name, header=True):
+        """
+        Yields a sheet's rows as Arrow record batches of at most ``batch_size`` rows.
+
+        Each batch is typed on its own; use read_sheet() for a single table with
+        column types unified across batches. Whether a column holds dates is
+        decided by its first numeric or date cell, so every batch of a
+        column gets the same type.
+        """
+        if sheet_name not in self._parts:
+            raise KeyError(f"Sheet '{sheet_name}' not found in '{self.path}'.")
+        if self._strings is None:
+            self._load_shared_strings()
+
+        row_tag, c_tag, v_tag, t_tag = f'{NS_MAIN}row', f'{NS_MAIN}c', f'{NS_MAIN}v', f'{NS_MAIN}t'
+        sheet_data_tag = f'{NS_MAIN}sheetData'
+        date_styles = self._date_styles
+        names = None if header else []
+        # Column index -> whether it holds dates, set by the column's first numeric cell
+        column_is_date = {}
+        date_columns = set()
+        rows = []
+        batches_yielded = 0
+        sheet_data = None
+
+        with self._zip.open(self._parts[sheet_name]) as stream:
+            for event, elem in ET.iterparse(stream, events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag == sheet_data_tag:
+                        sheet_data = elem
+                    continue
+                if elem.tag != row_tag:
+                    continue
+
+                row = []
+                col = -1
+                for c in elem.iter(c_tag):
+                    # Cells without a reference follow the previous cell
+                    ref = c.get('r')
+                    col = column_index(ref) if ref else col + 1
+                    cell_type = c.get('t')
+                    if cell_type == 'inlineStr':
+                        value = ''.join(t.text or '' for t in c.iter(t_tag))
+                    else:
+                        text = c.findtext(v_tag)
+                        # Formula cells saved without a cached value have an empty <v/>
+                        if not text or cell_type == 'e':
+                            continue
+                        if cell_type == 's':
+                            value = int(text)
+                        elif cell_type == 'str':
+                            value = text
+                        elif cell_type == 'b':
+                            value = text == '1'
+                        elif cell_type == 'd':
+                            # ISO date cells are kept as serials in date columns, as text elsewhere
+                            value = iso_to_excel_serial(text)
+                            if names is not None and col not in column_is_date:
+                                column_is_date[col] = value is not None
+                                if value is not None:
+                                    date_columns.add(col)
+                            if value is None or col not in date_columns:
+                                value = text
+                        else:
+                            value = float(text)
+                            if names is not None and col not in column_is_date:
+                                column_is_date[col] = int(c.get('s', 0)) in date_styles
+                                if column_is_date[col]:
+                                    date_columns.add(col)
+                    if col >= len(row):
+                        row.extend([None] * (col - len(row) + 1))
+                    row[col] = value
+
+                # Rows are processed at their end tag, then dropped from the tree
+                sheet_data.clear()
+
+                if names is None:
+                    names = mangle_duplicate_names([
+                        '' if v is None else self._format_value(v, False) for v in row
+                    ])
+                    continue
+                rows.append(row)
+                if len(rows) >= self.batch_size:
+                    yield self._make_batch(rows, names, date_columns)
+                    batches_yielded += 1
+                    rows = []
+
+        if rows:
+            yield self._make_batch(rows, names, date_columns)
+        elif names and not batches_yielded:
+            # Header-only sheet: an empty batch still carries the column names
+            yield pa.RecordBatch.from_arrays([pa.nulls(0) for _ in names], names=names)
+
+    def read_sheet(self, sheet_name, header=True):
+        """
+        Reads a whole sheet into one Arrow table.
+        Column types that differ between batches are unified (ints with floats
+        become float64, anything else mixed becomes text), and dictionary
+        columns are compacted to the strings the sheet actually uses.
+        """
+        return unify_batches(list(self.iter_batches(sheet_name, header=header)))
+
+    def close(self):
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+def compact_dictionary(array):
+    """
+    Shrinks a dictionary array's dictionary to the values it references.
+    """
+    used = pc.drop_null(pc.unique(array.indices))
+    indices = pc.cast(pc.index_in(array.indices, value_set=used), pa.int32())
+    return pa.DictionaryArray.from_arrays(indices, array.dictionary.take(used))
+
+def unify_batches(batches):
+    """
+    Concatenates independently typed record batches into one table.
+    """
+    if not batches:
+        return pa.table({})
+    names = max((b.schema.names for b in batches), key=len)
+    columns = []
+    for i in range(len(names)):
+        chunks = [b.column(i) if i < b.num_columns else pa.nulls(b.num_rows) for b in batches]
+        types = {c.type for c in chunks if not pa.types.is_null(c.type)}
+        if not types:
+            target = pa.null()
+        elif len(types) == 1:
+            target = types.pop()
+        elif all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+            target = pa.float64()
+        else:
+            target = pa.string()
+        if pa.types.is_dictionary(target):
+            # Batches where the column is blank are all-null; give them the same dictionary
+            dictionary = next(c.dictionary for c in chunks if pa.types.is_dictionary(c.type))
+            chunks = [
+                pa.DictionaryArray.from_arrays(pa.nulls(len(c), target.index_type), dictionary)
+                if pa.types.is_null(c.type) else c
+                for c in chunks
+            ]
+            combined = pa.concat_arrays(chunks) if len(chunks) > 1 else chunks[0]
+            columns.append(compact_dictionary(combined))
+        else:
+            columns.append(pa.chunked_array([c.cast(target) for c in chunks], type=target))
+    return pa.table(columns, names=names)
+
+def _read_sheet_worker(path, sheet_name, batch_size, ipc_path):
+    """
+    Process-pool entry point: reads one sheet in its own process and writes it
+    to an Arrow IPC file for the parent.
+    """
+    with WorkbookReader(path, batch_size=batch_size) as reader:
+        return write_ipc(reader.read_sheet(sheet_name), ipc_path, batch_size)
+
+def read_workbook(path, sheet_names=None, max_workers=1, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Reads several sheets into a {sheet name: pa.Table} dictionary.
+
+    Parameters:
+        path (str): Path to the .xlsx workbook.
+        sheet_names (list): Sheets to read; defaults to all sheets.
+        max_workers (int): Sheets parsed concurrently in separate processes.
+            XML parsing is CPU-bound, so threads would not help here. Workers
+            return their sheets as Arrow IPC files rather than pickles.
+    """
+    with WorkbookReader(path, batch_size=batch_size) as reader:
+        if sheet_names is None:
+            sheet_names = reader.sheet_names
+        missing = [s for s in sheet_names if s not in reader.sheet_names]
+        if missing:
+            raise KeyError(f"Sheets {missing} not found in '{path}'.")
+        if max_workers <= 1 or len(sheet_names) <= 1:
+            return {name: reader.read_sheet(name) for name in sheet_names}
+
+    with tempfile.TemporaryDirectory(prefix='xlsx_read_') as ipc_dir:
+        ipc_paths = {name: os.path.join(ipc_dir, f"{i}.arrow") for i, name in enumerate(sheet_names)}
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(sheet_names))) as pool:
+            futures = [
+                pool.submit(_read_sheet_worker, path, name, batch_size, ipc_paths[name])
+                for name in sheet_names
+            ]
+            for future in futures:
+                future.result()
+        return {name: read_ipc(ipc_paths[name]) for name in sheet_names}
+
+# ==========================
+# 5. In-place Workbook Patching
+# ==========================
+
+SHEET_DATA_OPEN_RE = re.compile(rb'<sheetData\s*(/?)>')
+ROW_RE = re.compile(rb'<row\b[^>]*?/>|<row\b.*?</row>', re.S)
+ROW_NUMBER_RE = re.compile(rb'^(<row\b[^>]*?\br=")(\d+)"')
+CELL_RE = re.compile(rb'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+CELL_REF_RE = re.compile(rb'(<c\b[^>]*?\br="[A-Z]+)\d+"')
+REF_ATTR_RE = re.compile(rb'\br="([A-Z]+)\d*"')
+STYLE_ATTR_RE = re.compile(rb'\bs="(\d+)"')
+TYPE_ATTR_RE = re.compile(rb'\bt="(\w+)"')
+VALUE_RE = re.compile(rb'<v>([^<]*)</v>')
+DIMENSION_RE = re.compile(rb'(<dimension ref="[A-Z]+\d+:[A-Z]+)\d+"')
+RANGE_END_RE = re.compile(rb'(\bref="\$?[A-Z]+\$?\d+:\$?[A-Z]+\$?)\d+"')
+SHEET_RANGE_RE = re.compile(rb'(<(autoFilter|mergeCell|conditionalFormatting|dataValidation)\b[^>]*?\b(?:sq)?ref=")([^"]*)"')
+CELL_RANGE_RE = re.compile(rb'(\$?[A-Z]+\$?)(\d*)(?::(\$?[A-Z]+\$?)(\d*))?')
+CELL_XFS_END_RE = re.compile(rb'</(\w+:)?cellXfs>')
+CELL_XFS_COUNT_RE = re.compile(rb'(<(?:\w+:)?cellXfs\b[^>]*?\bcount=")\d+"')
+PATCH_CHUNK_SIZE = 1 << 22
+
+EXCEL_EPOCH = datetime.date(1899, 12, 30)
+
+def iter_sheet_xml(stream, chunk_size=PATCH_CHUNK_SIZE):
+    """
+    Splits a worksheet XML stream into ('prefix', bytes), ('row', bytes) and
+    ('suffix', bytes) pieces without parsing it. The prefix excludes the
+    <sheetData> tag and the suffix excludes </sheetData>. Only one chunk plus
+    one partial row is held in memory at a time.
+    """
+    buf = b''
+    while True:
+        match = SHEET_DATA_OPEN_RE.search(buf)
+        if match:
+            break
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            raise ValueError("Worksheet XML has no <sheetData> element.")
+        buf += chunk
+    yield 'prefix', buf[:match.start()]
+    if match.group(1):  # <sheetData/>
+        yield 'suffix', buf[match.end():] + stream.read()
+        return
+
+    buf = buf[match.end():]
+    while True:
+        end = buf.find(b'</sheetData>')
+        if end >= 0:
+            for row in ROW_RE.finditer(buf, 0, end):
+                yield 'row', row.group()
+            yield 'suffix', buf[end + len(b'</sheetData>'):] + stream.read()
+            return
+        cut = buf.rfind(b'</row>')
+        if cut >= 0:
+            cut += len(b'</row>')
+            for row in ROW_RE.finditer(buf, 0, cut):
+                yield 'row', row.group()
+            buf = buf[cut:]
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            raise ValueError("Worksheet XML has an unterminated <sheetData> element.")
+        buf += chunk
+
+def row_number(row, previous):
+    """
+    Returns a row's 1-based number from its r attribute, or previous + 1.
+    """
+    match = ROW_NUMBER_RE.match(row)
+    return int(match.group(2)) if match else previous + 1
+
+def row_day(row, date_styles):
+    """
+    Returns the Excel day serial of a row's first cell if it holds a real
+    (date-formatted numeric) date, else None. Text dates are ignored, as in
+    process.py, which only rolls over cells that openpyxl reads as datetimes.
+    """
+    match = CELL_RE.search(row)
+    if not match:
+        return None
+    attrs = match.group(1)
+    ref = REF_ATTR_RE.search(attrs)
+    if ref and ref.group(1) != b'A':
+        return None
+    cell_type = TYPE_ATTR_RE.search(attrs)
+    if cell_type and cell_type.group(1) != b'n':
+        return None
+    style = STYLE_ATTR_RE.search(attrs)
+    if not style or int(style.group(1)) not in date_styles:
+        return None
+    value = VALUE_RE.search(match.group(2) or b'')
+    if not value or not value.group(1):
+        return None
+    return int(float(value.group(1)))
+
+def row_styles(row):
+    """
+    Returns the style index of each cell in a row, by column position.
+    """
+    styles = []
+    for match in CELL_RE.finditer(row):
+        attrs = match.group(1)
+        ref = REF_ATTR_RE.search(attrs)
+        col = column_index(ref.group(1).decode()) if ref else len(styles)
+        style = STYLE_ATTR_RE.search(attrs)
+        styles.extend([None] * (col + 1 - len(styles)))
+        styles[col] = int(style.group(1)) if style else None
+    return styles
+
+def renumber_row(row, number):
+    """
+    Rewrites the r attributes of a row and its cells to a new row number.
+    """
+    n = str(number).encode()
+    row = ROW_NUMBER_RE.sub(lambda m: m.group(1) + n + b'"', row, count=1)
+    return CELL_REF_RE.sub(lambda m: m.group(1) + n + b'"', row)
+
+def scan_sheet(zf, part, date_styles):
+    """
+    First pass over a sheet: finds the oldest day, the rows it covers and the
+    cell styles of the last data row, and checks that no formulas would need
+    re-basing after rows move.
+    """
+    oldest_day = None
+    last_number = 0
+    last_data_row = None
+    has_formulas = False
+    day_counts = {}
+    day_first_row = {}
+    with zf.open(part) as stream:
+        for kind, piece in iter_sheet_xml(stream):
+            if kind != 'row':
+                continue
+            last_number = row_number(piece, last_number)
+            if last_number > 1:
+                last_data_row = piece
+            if b'<f' in piece:
+                has_formulas = True
+            day = row_day(piece, date_styles)
+            if day is not None:
+                day_counts[day] = day_counts.get(day, 0) + 1
+                day_first_row.setdefault(day, last_number)
+                if oldest_day is None or day < oldest_day:
+                    oldest_day = day
+    return {
+        'oldest_day': oldest_day,
+        'day_counts': day_counts,
+        'day_first_row': day_first_row,
+        'last_number': last_number,
+        'styles': row_styles(last_data_row) if last_data_row else [],
+        'has_formulas': has_formulas,
+    }
+
+def append_styles(template, date_styles):
+    """
+    Chooses the style of each appended column from the last existing data
+    row, making sure the first (date) column keeps a date number format.
+    """
+    styles = list(template)
+    if not styles:
+        styles = [None]
+    if styles[0] not in date_styles:
+        styles[0] = min(date_styles) if date_styles else None
+    return styles
+
+def add_temporal_styles(styles_xml, date_styles):
+    """
+    Picks the cell styles for appended date and timestamp columns from a
+    workbook's own styles.xml: an existing date style for dates, an existing
+    m/d/yyyy h:mm style for timestamps. Missing ones are added as new
+    ``<xf>`` entries with the built-in format (14 or 22), since our own
+    STYLE_DATE/STYLE_DATETIME indexes may not exist in that file.
+
+    Returns:
+        (styles_xml, temporal_styles): The updated styles.xml (None if
+            unchanged) and the (date, date-time) style indexes, which are None
+            when the workbook has no cell styles to extend.
+    """
+    if styles_xml is None:
+        return None, (None, None)
+    cell_xfs = ET.fromstring(styles_xml).find(f'{NS_MAIN}cellXfs')
+    end = CELL_XFS_END_RE.search(styles_xml)
+    if cell_xfs is None or end is None:
+        return None, (None, None)
+    num_fmts = [int(xf.get('numFmtId', 0)) for xf in cell_xfs]
+    new_xfs = []
+
+    def style_for(num_fmt_id, existing):
+        if existing:
+            return min(existing)
+        new_xfs.append(num_fmt_id)
+        return len(num_fmts) + len(new_xfs) - 1
+
+    date_style = style_for(14, date_styles)
+    datetime_style = style_for(22, [i for i, fmt in enumerate(num_fmts) if fmt == 22])
+    if not new_xfs:
+        return None, (date_style, datetime_style)
+    prefix = end.group(1) or b''
+    xfs = b''.join(
+        b'<' + prefix + b'xf numFmtId="%d" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>' % fmt
+        for fmt in new_xfs
+    )
+    styles_xml = styles_xml[:end.start()] + xfs + styles_xml[end.start():]
+    count = str(len(num_fmts) + len(new_xfs)).encode()
+    styles_xml = CELL_XFS_COUNT_RE.sub(lambda m: m.group(1) + count + b'"', styles_xml, count=1)
+    return styles_xml, (date_style, datetime_style)
+
+def rebase_sheet_ranges(xml, first_moved, old_last, new_last):
+    """
+    Rewrites the sheet-level ranges in a piece of worksheet XML (auto filter,
+    merged cells, conditional formats, data validations) for a patch that
+    moves every row from ``first_moved`` on (None if no row moves) and ends
+    the data at ``new_last`` instead of ``old_last``. Whole-column ranges and
+    ranges above the first moved row are kept. Filters, conditional formats
+    and validations running from the first moved row or above to the old last
+    row are moved to end at the new last row; ones reaching beyond it are only
+    extended when the data now runs further.
+
+    Raises:
+        ValueError: A range points into rows that move; like formulas, it
+            would need re-basing row by row.
+    """
+    first_moved = first_moved or old_last + 1
+
+    def rebase_ref(ref, kind):
+        match = CELL_RANGE_RE.fullmatch(ref)
+        if not match or not match.group(2):
+            return ref
+        start_row = int(match.group(2))
+        end_row = int(match.group(4)) if match.group(4) else start_row
+        if kind != b'mergeCell' and start_row <= first_moved and end_row >= old_last:
+            # Ranges ending at the old last row follow the data, whether it grew or shrank
+            end_row = new_last if end_row == old_last else max(end_row, new_last)
+            return match.group(1) + match.group(2) + b':' + (match.group(3) or match.group(1)) + str(end_row).encode()
+        if end_row < first_moved:
+            return ref
+        raise ValueError(f"The sheet's {kind.decode()} '{ref.decode()}' covers rows that would move.")
+
+    def rebase(match):
+        refs = b' '.join(rebase_ref(ref, match.group(2)) for ref in match.group(3).split())
+        return match.group(1) + refs + b'"'
+
+    return SHEET_RANGE_RE.sub(rebase, xml)
+
+def write_patched_sheet(zf, zout, info, scan, drop_day, source, date_styles, batch_size, temporal_styles):
+    """
+    Second pass over a sheet: copies kept rows verbatim (renumbered only when
+    rows above them were removed) and appends the new rows after them, with
+    unstyled date and timestamp columns in the workbook's ``temporal_styles``.
+    The dimension and the sheet-level ranges are moved to the new last row.
+    Returns (rows_deleted, rows_appended, last_row_number).
+    """
+    rows_deleted = scan['day_counts'].get(drop_day, 0) if drop_day is not None else 0
+    final_last = scan['last_number'] - rows_deleted
+    batches = list(iter_record_batches(source, batch_size)) if source is not None else []
+    rows_to_append = sum(b.num_rows for b in batches)
+    if final_last + rows_to_append > EXCEL_ROW_LIMIT:
+        raise ValueError(
+            f"Sheet would hold {final_last + rows_to_append} rows, over the Excel limit of {EXCEL_ROW_LIMIT}."
+        )
+    final_last += rows_to_append
+    styles = append_styles(scan['styles'], date_styles)
+    first_moved = scan['day_first_row'].get(drop_day) if rows_deleted else None
+
+    number = 0
+    shift = 0
+    with zf.open(info) as stream, zout.open(_copy_info(info), 'w', force_zip64=True) as out:
+        for kind, piece in iter_sheet_xml(stream):
+            if kind == 'prefix':
+                piece = rebase_sheet_ranges(piece, first_moved, scan['last_number'], final_last)
+                out.write(DIMENSION_RE.sub(lambda m: m.group(1) + str(final_last).encode() + b'"', piece, count=1))
+                out.write(b'<sheetData>')
+            elif kind == 'row':
+                number = row_number(piece, number)
+                if drop_day is not None and row_day(piece, date_styles) == drop_day:
+                    shift += 1
+                    continue
+                out.write(renumber_row(piece, number - shift) if shift else piece)
+            else:
+                next_row = number - shift + 1
+                for batch in batches:
+                    out.write(batch_to_xml(batch, styles=styles, first_row=next_row, temporal_styles=temporal_styles))
+                    next_row += batch.num_rows
+                out.write(b'</sheetData>')
+                out.write(rebase_sheet_ranges(piece, first_moved, scan['last_number'], final_last))
+    return rows_deleted, rows_to_append, final_last
+
+def _copy_info(info):
+    """
+    Returns a fresh ZipInfo for re-writing a part with its original name,
+    timestamp and compression method.
+    """
+    new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.external_attr = info.external_attr
+    return new_info
+
+def _sheet_relations(zf, part):
+    """
+    Returns the parts a worksheet links to (tables, drawings, ...) keyed by type suffix.
+    """
+    rels_part = posixpath.join(posixpath.dirname(part), '_rels', posixpath.basename(part) + '.rels')
+    if rels_part not in zf.namelist():
+        return []
+    rels = ET.fromstring(zf.read(rels_part))
+    targets = []
+    for rel in rels.iter(f'{NS_PKG_REL}Relationship'):
+        if rel.get('TargetMode') == 'External':
+            continue
+        target = rel.get('Target')
+        target = target.lstrip('/') if target.startswith('/') else posixpath.join(posixpath.dirname(part), target)
+        targets.append((rel.get('Type').rsplit('/', 1)[-1], posixpath.normpath(target)))
+    return targets
+
+def _extend_range(data, last_row):
+    """
+    Moves the end row of every ref="A1:X9" range in a small XML part.
+    """
+    return RANGE_END_RE.sub(lambda m: m.group(1) + str(last_row).encode() + b'"', data)
+
+def patch_workbook(path, sheet_names, appends=None, drop_oldest=True, output_path=None,
+                   batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Applies the nightly rollover to an xlsx file at the zip level.
+
+    Only the worksheet parts of ``sheet_names`` are regenerated: their rows
+    carrying the oldest real date in the first column are removed and the new
+    rows are appended. Tables on those sheets and pivot caches sourced from
+    them have their ranges extended to the new last row (pivots are flagged to
+    refresh on open), as have the sheets' auto filters, conditional formats
+    and data validations. Sheets with formulas, or with merged cells or other
+    ranges inside rows that move, are refused. Appended dates use the
+    workbook's own date style, or one added to its styles.xml. Every other
+    part is streamed through unchanged, so the cost grows with the QDS sheets,
+    not with the rest of the workbook.
+
+    Parameters:
+        path (str): Workbook to patch.
+        sheet_names (list): Sheets to roll over.
+        appends (dict): {sheet name: DataFrame, Arrow table or iterable of them}.
+            Columns are appended by position, like openpyxl's sheet.append().
+        drop_oldest (bool): Remove the oldest date's rows from each sheet.
+        output_path (str): Destination; defaults to replacing ``path`` atomically.
+
+    Returns:
+        results (dict): {sheet name: {'oldest_date', 'rows_deleted', 'rows_appended', 'rows'}}.
+    """
+    appends = appends or {}
+    output_path = output_path or path
+    with WorkbookReader(path) as reader:
+        date_styles = reader.date_styles
+        parts = {}
+        for sheet_name in sheet_names:
+            if sheet_name not in reader.sheet_names:
+                raise KeyError(f"Sheet '{sheet_name}' not found in '{path}'.")
+            parts[reader.sheet_part(sheet_name)] = sheet_name
+
+    results = {}
+    range_updates = {}
+    tmp_path = f"{output_path}.tmp"
+    try:
+        with zipfile.ZipFile(path) as zf, \
+                zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zout:
+            # First pass over the patched sheets only
+            scans = {}
+            for part, sheet_name in parts.items():
+                scan = scan_sheet(zf, part, date_styles)
+                if scan['has_formulas']:
+                    raise ValueError(f"Sheet '{sheet_name}' contains formulas; rows cannot be moved safely.")
+                scans[part] = scan
+                for kind, target in _sheet_relations(zf, part):
+                    if kind == 'table':
+                        range_updates[target] = sheet_name
+
+            # Appended dates need a date style that exists in this workbook's styles.xml
+            styles_xml = zf.read('xl/styles.xml') if 'xl/styles.xml' in zf.namelist() else None
+            patched_styles, temporal_styles = add_temporal_styles(styles_xml, date_styles)
+
+            for info in zf.infolist():
+                if info.filename == 'xl/styles.xml' and patched_styles is not None:
+                    zout.writestr(_copy_info(info), patched_styles)
+                elif info.filename in parts:
+                    sheet_name = parts[info.filename]
+                    scan = scans[info.filename]
+                    drop_day = scan['oldest_day'] if drop_oldest else None
+                    rows_deleted, rows_appended, last_row = write_patched_sheet(
+                        zf, zout, info, scan, drop_day, appends.get(sheet_name), date_styles, batch_size,
+                        temporal_styles,
+                    )
+                    results[sheet_name] = {
+                        'oldest_date': EXCEL_EPOCH + datetime.timedelta(days=drop_day) if drop_day is not None else None,
+                        'rows_deleted': rows_deleted,
+                        'rows_appended': rows_appended,
+                        'rows': last_row - 1,
+                    }
+                elif info.filename in range_updates or info.filename.startswith('xl/pivotCache/pivotCacheDefinition'):
+                    # Small parts whose ranges point into a patched sheet; resolved below
+                    continue
+                else:
+                    # Unchanged parts are streamed through as-is
+                    with zf.open(info) as src, zout.open(_copy_info(info), 'w', force_zip64=True) as dst:
+                        shutil.copyfileobj(src, dst, PATCH_CHUNK_SIZE)
+
+            last_rows = {name: results[name]['rows'] + 1 for name in results}
+            for info in zf.infolist():
+                if info.filename in range_updates:
+                    data = _extend_range(zf.read(info), last_rows[range_updates[info.filename]])
+                    zout.writestr(_copy_info(info), data)
+                elif info.filename.startswith('xl/pivotCache/pivotCacheDefinition'):
+                    data = zf.read(info)
+                    for sheet_name, last_row in last_rows.items():
+                        source = b'sheet=' + quoteattr(sheet_name).encode('utf-8')
+                        if source in data:
+                            data = _extend_range(data, last_row)
+                            if b'refreshOnLoad=' not in data:
+                                data = data.replace(b'<pivotCacheDefinition ', b'<pivotCacheDefinition refreshOnLoad="1" ', 1)
+                    zout.writestr(_copy_info(info), data)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return results